@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Sender and recipient addresses of the stored messages, normalised into the address
+and messageaddress tables so that the mail of a contact is an indexed lookup
+"""
+
+import email.header
+import email.parser
+import email.policy
+import email.utils
+import logging
+import re
+
+from sqlalchemy import and_, distinct, exists, func, select
+
+import storage
+import util_logger
+
+logger = logging.getLogger('ar3_mailrepo.addresses')
+
+# Header read for each role of messageaddress
+ROLE_HEADERS = {
+  'from': 'From',
+  'to': 'To',
+  'cc': 'Cc',
+  'bcc': 'Bcc',
+}
+
+MAX_EMAIL_LENGTH = 320
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+
+def normalize_email(address: str):
+  return address.strip().strip('<>').strip().lower()[:MAX_EMAIL_LENGTH]
+
+
+def _decode_name(name: str):
+  if '=?' in name:
+    try:
+      name = str(email.header.make_header(email.header.decode_header(name)))
+    except Exception:  # pylint: disable=broad-except
+      pass
+  return ' '.join(name.split()) or None
+
+
+def parse_headers(raw_data: bytes):
+  """
+  Parses only the header block of a raw message, which is much cheaper than
+  parsing the whole message for the address and threading headers
+  """
+  match = _HEADER_END.search(raw_data)
+  header_block = raw_data[:match.start()] if match else raw_data
+  return email.parser.HeaderParser(policy=email.policy.compat32).parsestr(
+    header_block.decode('utf-8', 'replace').replace('\x00', ''), headersonly=True)
+
+
+def parse_addresses(raw_data: bytes):
+  """
+  Returns [(role, email, display name)] from the From, To, Cc and Bcc headers of a
+  raw message, each address once per role
+  """
+  if not raw_data:
+    return []
+  headers = parse_headers(raw_data)
+  result = []
+  for role, header in ROLE_HEADERS.items():
+    values = headers.get_all(header)
+    if not values:
+      continue
+    seen = set()
+    for name, addr in email.utils.getaddresses([str(x) for x in values]):
+      addr = normalize_email(addr)
+      if not addr or addr in seen:
+        continue
+      seen.add(addr)
+      result.append((role, addr, _decode_name(name)))
+  return result
+
+
+def _select_address_ids(conn, emails):
+  ids = {}
+  for start in range(0, len(emails), storage.UUID_QUERY_CHUNK):
+    smt = select([storage.address.c.email, storage.address.c.id]).where(
+      storage.address.c.email.in_(emails[start:start + storage.UUID_QUERY_CHUNK]))
+    ids.update((x['email'], x['id']) for x in conn.execute(smt).fetchall())
+  return ids
+
+
+def address_ids(conn, names_by_email: dict):
+  """
+  Returns {email: address id}, adding the addresses not stored yet with their
+  display name
+  """
+  # Sorted, so that concurrent writers lock new addresses in the same order
+  emails = sorted(names_by_email)
+  ids = _select_address_ids(conn, emails)
+  missing = [x for x in emails if x not in ids]
+  if missing:
+    conn.execute(storage.insert_ignore_statement(conn.dialect.name, storage.address, 'email'),
+                 [{'email': x, 'display_name': names_by_email[x]} for x in missing])
+    ids.update(_select_address_ids(conn, missing))
+  return ids
+
+
+def link_messages(conn, messages):
+  """
+  Stores the addresses of messages given as [(messagedata id, raw_data)]. Returns
+  the number of links added
+  """
+  parsed = [(msg_id, parse_addresses(raw_data)) for msg_id, raw_data in messages]
+  names_by_email = {}
+  for _, found in parsed:
+    for _, addr, name in found:
+      if names_by_email.get(addr) is None:
+        names_by_email[addr] = name
+  if not names_by_email:
+    return 0
+  ids = address_ids(conn, names_by_email)
+  links = [{'message_id': msg_id, 'role': role, 'address_id': ids[addr]}
+           for msg_id, found in parsed for role, addr, _ in found]
+  conn.execute(storage.messageaddress.insert(None), links)
+  return len(links)
+
+
+def _not_linked():
+  return ~exists().where(storage.messageaddress.c.message_id == storage.messagedata.c.id)
+
+
+def link_inserted_messages(conn, store_list):
+  """
+  Ingest hook, see storage.insert_message_batch: links the messages just inserted
+  to their addresses, in the same transaction
+  """
+  md = storage.messagedata
+  raw_by_uuid = {x['msg_uuid']: x['raw_data'] for x in store_list}
+  rows = conn.execute(select([md.c.id, md.c.msg_uuid]).where(and_(
+    md.c.msg_uuid.in_(list(raw_by_uuid)), _not_linked()))).fetchall()
+  if rows:
+    link_messages(conn, [(x['id'], raw_by_uuid[x['msg_uuid']]) for x in rows])
+
+
+def backfill(dbconn, batch_size=200):
+  """
+  Links the messages stored before the address tables existed. Can be re-run,
+  linked messages are skipped. Returns the number of messages read
+  """
+  md = storage.messagedata
+  progress = util_logger.ProgressReporter(logger, 'Linking message addresses')
+  after_id = 0
+  while True:
+    rows = dbconn.execute(select([md.c.id, md.c.raw_data]).where(and_(
+      md.c.id > after_id, _not_linked())).order_by(md.c.id).limit(batch_size)).fetchall()
+    if not rows:
+      break
+    with storage.unit_of_work(dbconn) as conn:
+      link_messages(conn, [(x['id'], x['raw_data']) for x in rows])
+    after_id = rows[-1]['id']
+    progress.update(len(rows))
+  progress.done()
+  logger.debug(f'Linked the addresses of {progress.count} message(s)')
+  return progress.count
+
+
+def messages_with_address(dbconn, email_address: str, role=None, email_account=None,
+                          limit=20, offset=0):
+  """
+  Messages from or to an address, newest first, as dicts of the messagedata id,
+  msg_uuid, email_account, msg_ts, msg_subj and the roles of the address
+  """
+  md = storage.messagedata
+  ma = storage.messageaddress
+  conditions = [storage.address.c.email == normalize_email(email_address)]
+  if role:
+    conditions.append(ma.c.role == role)
+  if email_account:
+    conditions.append(md.c.email_account == email_account)
+  joined = storage.address.join(ma, ma.c.address_id == storage.address.c.id).join(
+    md, md.c.id == ma.c.message_id)
+  smt = select([md.c.id, md.c.msg_uuid, md.c.email_account, md.c.msg_ts,
+                md.c.msg_subj]).select_from(joined).where(and_(*conditions)).distinct() \
+    .order_by(md.c.msg_ts.desc(), md.c.id.desc()).limit(limit).offset(offset)
+  messages = [dict(x) for x in dbconn.execute(smt).fetchall()]
+  if messages:
+    roles = {}
+    smt = select([ma.c.message_id, ma.c.role]).select_from(joined).where(and_(
+      conditions[0], ma.c.message_id.in_([x['id'] for x in messages])))
+    for row in dbconn.execute(smt).fetchall():
+      roles.setdefault(row['message_id'], []).append(row['role'])
+    for msg in messages:
+      msg['roles'] = sorted(roles.get(msg['id'], []), key=list(ROLE_HEADERS).index)
+  return messages
+
+
+def top_correspondents(dbconn, email_account=None, role=None, limit=20):
+  """
+  [(email, display name, message count)] of the addresses in the most messages.
+  For an email_account the account's own address is left out
+  """
+  md = storage.messagedata
+  ma = storage.messageaddress
+  message_count = func.count(distinct(ma.c.message_id)).label('message_count')
+  conditions = []
+  source = ma
+  if role:
+    conditions.append(ma.c.role == role)
+  if email_account:
+    source = ma.join(md, md.c.id == ma.c.message_id)
+    conditions.append(md.c.email_account == email_account)
+    own_address = select([storage.address.c.id]).where(
+      storage.address.c.email == normalize_email(email_account))
+    conditions.append(~ma.c.address_id.in_(own_address))
+  counts = select([ma.c.address_id, message_count]).select_from(source)
+  if conditions:
+    counts = counts.where(and_(*conditions))
+  # address_id breaks ties, so that the limit cuts the same addresses every time
+  counts = counts.group_by(ma.c.address_id).order_by(message_count.desc(),
+                                                     ma.c.address_id) \
+    .limit(limit).alias('counts')
+  smt = select([storage.address.c.email, storage.address.c.display_name,
+                counts.c.message_count]).select_from(
+    counts.join(storage.address, storage.address.c.id == counts.c.address_id)).order_by(
+    counts.c.message_count.desc(), storage.address.c.email)
+  return [(x['email'], x['display_name'], x['message_count'])
+          for x in dbconn.execute(smt).fetchall()]
@@ -18,60 +18,39 @@
 
 """
 Main module to execute mail manager
+
+Commands are registered with their command line option and import the modules they
+need when they run, so that light commands such as --list_emails or a --search
+answered by the search service start without loading SQLAlchemy, whoosh or the
+Google libraries.
 """
 
+# pylint: disable=import-outside-toplevel
+
 import argparse
-import datetime
+import concurrent.futures
 import logging
 import platform
+import sys
 from pathlib import Path
 
-import mailparser
-import sqlalchemy
-
 import ar3_mailrepo_config
-import ar3_mailrepo_lib
 import ar3_mailrepo_version_info
-
-import searcher
-import storage
 import util_lib
 import util_logger
-from ar3_mailrepo_lib import get_folders_for_email
-
-util_logger.apply_logger_handler()
 
 logger = logging.getLogger('ar3_mailrepo')
 
 
-def create_dupefilter_list(dbconn, emaillabel: str, lookback_days=2):
-  stmt = sqlalchemy.select(
-    [storage.messagedata.c.msg_id,
-     storage.messagedata.c.msg_ts,
-     storage.messagedata.c.id]).where \
-    (storage.messagedata.c.email_account == emaillabel)
-  result = dbconn.execute(stmt)
-  resultset = []
-  for item in result.fetchall():
-    if item['msg_id'] and item['msg_ts']:
-      resultset.append({'id': item[0], 'date': item[1]})
-  if len(resultset) < 1:
-    return datetime.date(1970, 1, 1), set()
-  since_date = (max([x['date'] for x in resultset])).date() - datetime.timedelta(
-    days=lookback_days)
-  dupelist = {x['id'] for x in resultset if x['date'].date() >= since_date}
-  logger.debug(
-    f'Dupe List for {emaillabel} and lookback {lookback_days}: '
-    f'{since_date} and len {len(dupelist)}')
-  return since_date, dupelist
-
-
 def download_emails_to_cache(dbconn, emaillabel: str, cachepath_root: Path,
                              credentials_root: Path):
+  import ar3_mailrepo_lib
+  import storage
   generic_creds = util_lib.load_generic_credentials(credentials_root, emaillabel)
   svr_conn = ar3_mailrepo_lib.create_server_connection(generic_creds)
   new_cache = storage.create_new_timestamped_cache_path(Path(cachepath_root / emaillabel))
-  since_dt, dupefilterlist = create_dupefilter_list(dbconn=dbconn, emaillabel=emaillabel)
+  since_dt, dupefilterlist = storage.create_dupefilter_list(dbconn=dbconn,
+                                                            emaillabel=emaillabel)
   svr_conn.retrieve_messages_to_cache(new_cache, since_dt, dupefilterlist)
   svr_conn.close()
   cachefolder = storage.DataCacheFolder(new_cache)
@@ -79,12 +58,99 @@ def download_emails_to_cache(dbconn, emaillabel: str, cachepath_root: Path,
   # logger.debug(f'Downloaded and stored {stored_in_db} messages for {emaillabel}')
 
 
-def arg_command_rebuild_search(index_root: Path, dbconn):
-  searcher.build_index_from_scratch(index_root, dbconn)
-
-
-def arg_command_search(index_root: Path, search_string):
-  searcher.search_and_print(index_root, search_string)
+def arg_command_rebuild_search(backend: 'search_backends.SearchBackend', dbconn):
+  backend.build(dbconn)
+
+
+def arg_command_rebuild_search_shard(index_root: Path, dbconn, email_label: str,
+                                     build_options: dict):
+  import search_shards
+  search_shards.rebuild_shard(index_root, dbconn, email_label, **build_options)
+
+
+def arg_command_update_search(backend: 'search_backends.SearchBackend', dbconn):
+  backend.update(dbconn)
+
+
+def auto_update_search(app_config: ar3_mailrepo_config.AppConfig,
+                       db_engine: 'storage.DBEngine'):
+  # Runs after commands that add messages, so that new mail becomes searchable
+  if app_config.auto_update_index():
+    import search_backends
+    arg_command_update_search(search_backends.create_backend(app_config, db_engine),
+                              db_engine.conn())
+
+
+def arg_command_search(app_config: ar3_mailrepo_config.AppConfig, search_string,
+                       sort_by=None, page=1, pagelen=20, highlight=False,
+                       db_engine_for=None):
+  import search_service
+  # A configured search service answers from a warm index, otherwise search locally.
+  # The service is asked first, the local search backend loads whoosh or the database
+  if app_config.search_backend() == 'whoosh' and app_config.search_service_configured():
+    service_options = app_config.search_service_options()
+    try:
+      search_service.print_search_page(search_service.query_service(
+        search_string, host=service_options['host'], port=service_options['port'],
+        page=page, pagelen=pagelen, sort_by=sort_by, highlight=highlight))
+      return
+    except ConnectionError:
+      logger.debug('No search service running, searching the index directly')
+  import search_backends
+  import storage
+  db_engine = db_engine_for()
+  backend = search_backends.create_backend(app_config, db_engine)
+  body_text_loader = None
+  if highlight:
+    body_text_loader = lambda uuids: storage.body_text_by_uuid(db_engine.conn(), uuids)
+  search_service.print_search_page(backend.search(search_string, page=page,
+                                                  pagelen=pagelen, sort_by=sort_by,
+                                                  highlight=highlight,
+                                                  body_text_loader=body_text_loader).as_dict())
+
+
+def arg_command_serve_search(backend: 'search_backends.SearchBackend', index_root: Path,
+                             db_engine: 'storage.DBEngine', service_options: dict,
+                             maintenance_options: dict = None):
+  import search_service
+  import storage
+  if not backend.uses_search_service:
+    raise RuntimeError('The search service only serves the whoosh search backend')
+  # Bodies are not stored in the index, highlights read them from the text cache
+  search_service.serve(index_root, host=service_options['host'],
+                       port=service_options['port'],
+                       cache_size=service_options['cache_size'],
+                       maintenance_options=maintenance_options,
+                       body_text_loader=lambda uuids: storage.body_text_by_uuid(
+                         db_engine.conn(), uuids))
+
+
+def _index_stats_text(stats: dict):
+  # The database backend reports pages instead of segments and deletions
+  parts = []
+  if stats.get('segments') is not None:
+    parts.append(f"{stats['segments']} segment(s)")
+  parts.append(f"{stats['doc_count']} document(s)")
+  if stats.get('deleted_ratio') is not None:
+    parts.append(f"{stats['deleted_ratio']:.1%} deleted")
+  if stats.get('pages') is not None:
+    parts.append(f"{stats['pages']} page(s)")
+  parts.append(f"{stats['size_bytes'] / (1024 * 1024):.1f} MB")
+  return ', '.join(parts)
+
+
+def arg_command_index_maintenance(backend: 'search_backends.SearchBackend',
+                                  maintenance_options: dict, optimize=False):
+  for report in backend.maintain(optimize=optimize,
+                                 max_segments=maintenance_options['max_segments'],
+                                 max_deleted_ratio=maintenance_options['max_deleted_ratio']):
+    before = report['before']
+    if before:
+      print(f"{before['index']}: {_index_stats_text(before)}")
+    if report['after']:
+      print(f"  {report['action']}: now {_index_stats_text(report['after'])}")
+    else:
+      print(f"  {report['action'] or 'within thresholds, nothing to do'}")
 
 
 def arg_command_list_all_emails(credentials_root_path: Path):
@@ -101,6 +167,7 @@ def arg_command_list_folders_for_email(credential_root_path: Path, emaillabel: s
 
 
 def arg_command_list_folders_for_single_email(credsl_root_path: Path, emaillabel: str):
+  from ar3_mailrepo_lib import get_folders_for_email
   try:
     print(emaillabel)
     print('-' * len(emaillabel) * 2)
@@ -114,17 +181,72 @@ def arg_command_list_folders_for_single_email(credsl_root_path: Path, emaillabel
 def arg_command_download_and_store_emails(emaillabel: str,
                                           cacheeroot: Path,
                                           credentials_root: Path,
-                                          db_engine=storage.DBEngine):
+                                          db_engine: 'storage.DBEngine',
+                                          workers=1):
   if emaillabel == 'ALL':
     emails = util_lib.retrieve_all_email_labels(credentials_root)
   else:
     emails = [emaillabel]
-  for email in emails:
-    logger.debug(f'Executing download for email {email}')
-    download_emails_to_cache(db_engine.conn(), email, cacheeroot, credentials_root)
-
-
-def rebuild_data_base_from_cache_for_email(cache_root: Path, email_label: str, dbconn):
+  # Accounts are downloaded in parallel threads sharing the engine's connection pool
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = {}
+    for email in emails:
+      logger.debug(f'Executing download for email {email}')
+      futures[pool.submit(download_emails_to_cache, db_engine.conn(), email, cacheeroot,
+                          credentials_root)] = email
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        future.result()
+      except Exception:  # pylint: disable=broad-except
+        logger.exception(f'Download failed for email {futures[future]}')
+
+
+def arg_command_download_pipeline(emaillabel: str, app_config: ar3_mailrepo_config.AppConfig,
+                                  db_engine: 'storage.DBEngine'):
+  import pipeline
+  import search_backends
+  if emaillabel == 'ALL':
+    emails = util_lib.retrieve_all_email_labels(app_config.credentials_root())
+  else:
+    emails = [emaillabel]
+  download_pipeline = pipeline.DownloadPipeline.from_config(
+    app_config, db_engine, backend=search_backends.create_backend(app_config, db_engine))
+  report = download_pipeline.run(emails)
+  for email, account_report in report['accounts'].items():
+    if 'error' in account_report:
+      print(f"{email}: failed: {account_report['error']}")
+    else:
+      print(f"{email}: {account_report['ok_count']} new, "
+            f"{account_report['dupe_count']} dupe(s), "
+            f"{account_report['error_count_msg']} error(s)")
+  for stage, stats in report['stages'].items():
+    print(f"{stage}: {stats['items']} in {report['seconds']:.1f}s "
+          f"({stats['items_per_second']}/s, {stats['mb_per_second']} MB/s, "
+          f"busy {stats['utilisation']:.0%})")
+  print(f"Queue: max depth {report['queue']['max_depth']} of {report['queue']['size']}")
+
+
+def arg_command_sync_daemon(emaillabel: str, app_config: ar3_mailrepo_config.AppConfig,
+                            db_engine: 'storage.DBEngine'):
+  import pipeline
+  import search_backends
+  import sync_daemon
+  if emaillabel == 'ALL':
+    emails = util_lib.retrieve_all_email_labels(app_config.credentials_root())
+  else:
+    emails = [emaillabel]
+  daemon = sync_daemon.SyncDaemon(
+    db_engine, emails,
+    lambda x: util_lib.load_generic_credentials(app_config.credentials_root(), x),
+    pipeline.DownloadPipeline.from_config(
+      app_config, db_engine, backend=search_backends.create_backend(app_config, db_engine)),
+    app_config.sync_daemon_options())
+  daemon.run_forever()
+
+
+def rebuild_data_base_from_cache_for_email(cache_root: Path, email_label: str, dbconn,
+                                           writer=None):
+  import storage
   logger.debug(f'Rebuilding DB for email label {email_label} in {cache_root} -  BEGIN')
   total_stored = 0
   for datafolder in util_lib.list_avilable_cache_data_for_email(cache_root,
@@ -134,32 +256,34 @@ def rebuild_data_base_from_cache_for_email(cache_root: Path, email_label: str, d
     if not thisfolder.has_download_report():
       logger.debug(f'Ignoring folder as it has no download report: {thisfolder.name}')
     else:
-      total_stored += thisfolder.store_messages_in_database(dbconn)
+      total_stored += thisfolder.store_messages_in_database(dbconn, writer=writer)
   logger.debug(
     f'Rebuilding DB for email label {email_label} in '
     f'{cache_root}: {total_stored} total message(s) - END')
   return total_stored
 
 
-def arg_command_rebuild_database(db_engine: storage.DBEngine, datacache_root: Path,
-                                 email_label_or_all: str):
-  total_stored = 0
+def arg_command_rebuild_database(db_engine: 'storage.DBEngine', datacache_root: Path,
+                                 email_label_or_all: str, workers=1):
   if email_label_or_all.upper() == 'ALL':
-    emailfolders = util_lib.list_all_available_cache_data(datacache_root)
-    for email in emailfolders:
-      total_stored += rebuild_data_base_from_cache_for_email(dbconn=db_engine.conn(),
-                                                             cache_root=datacache_root,
-                                                             email_label=email)
+    emails = list(util_lib.list_all_available_cache_data(datacache_root))
   else:
-    total_stored += rebuild_data_base_from_cache_for_email(dbconn=db_engine.conn(),
+    emails = [email_label_or_all]
+  writer = db_engine.writer()
+  # Accounts are loaded in parallel threads, inserts go through the writer thread
+  # (SQLite) or the shared connection pool
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    total_stored = sum(pool.map(
+      lambda email: rebuild_data_base_from_cache_for_email(dbconn=db_engine.conn(),
                                                            cache_root=datacache_root,
-                                                           email_label=email_label_or_all)
+                                                           email_label=email,
+                                                           writer=writer), emails))
   logger.debug(
     f'Imported {total_stored} Messages into '
     f'Database for email label(s): {email_label_or_all}')
 
 
-def arg_command_create_db(db_engine: storage.DBEngine):
+def arg_command_create_db(db_engine: 'storage.DBEngine'):
   logger.debug(f'Attemtping tp create database {db_engine.description()}')
   db_engine.establish_conn()
   if not db_engine.is_db_a_mailrepo():
@@ -169,13 +293,13 @@ def arg_command_create_db(db_engine: storage.DBEngine):
 
 
 def arg_command_init_cache(data_cache_dir: Path, credential_root_dir: Path,
-                           db_engine: storage.DBEngine):
+                           db_engine: 'storage.DBEngine'):
   logger.debug(
     f'Attempt to init cache in {data_cache_dir} using creds from{credential_root_dir}')
   if data_cache_dir.exists():
     logger.debug(f'Cache directory already exists. Not doing anything: f{data_cache_dir}')
   else:
-    conf.cache_dir().mkdir(parents=True)
+    data_cache_dir.mkdir(parents=True)
   create_count = 0
   emails = util_lib.retrieve_all_email_labels(credential_root_dir)
   for emailpath in emails:
@@ -189,50 +313,31 @@ def arg_command_init_cache(data_cache_dir: Path, credential_root_dir: Path,
 
 
 def arg_command_extract_email(dbconn, msg_uuid, email_export_root: Path):
+  import mailparser
+  import exporter
+  import storage
   logger.debug(f'Extracting Msg {msg_uuid} into folder {email_export_root}')
   result = storage.extract_msg_from_db_by_uuid(dbconn, msg_uuid)
   outpath = util_lib.safe_create_path(email_export_root, msg_uuid)
   logger.debug(f'Storing Msg Data for {msg_uuid} into folder {outpath}')
-  return store_message_as_extract(mailparser.parse_from_bytes(result['raw_data']),
-                                  msg_uuid)
+  return exporter.store_message_as_extract(
+    mailparser.parse_from_bytes(result['raw_data']), outpath, msg_uuid)
 
 
 def arg_command_extract_pickle_obj(pickle_file_name: Path, extra_root: Path):
+  import mailparser
+  import exporter
+  import storage
   outpath = util_lib.safe_create_path(extra_root, Path(pickle_file_name.name))
   logger.debug(f'Storing Msg Data for {pickle_file_name} into folder {outpath}')
   msg_object = storage.load_pickle_object_as_data(pickle_file_name)['raw_data']
-  return store_message_as_extract(mailparser.parse_from_bytes(msg_object), outpath)
-
-
-def store_message_as_extract(msg: mailparser.MailParser, outpath: Path, msg_uuid=None):
-  msg.write_attachments(Path(outpath / 'attachments'))
-  try:
-    with open(outpath / 'headers.txt', 'w', encoding='utf-8-sig') as f:
-      for hdr, hdr_data in msg.headers.items():
-        f.write(f'{hdr}:{hdr_data}')
-        f.write('\n')
-    with open(outpath / 'message.txt', 'w', encoding='utf-8-sig') as f:
-      for txt in msg.text_plain:
-        f.write(f'{txt}"\n"')
-    with open(outpath / 'message.html', 'w', encoding='utf-8-sig') as f:
-      for txt in msg.text_html:
-        f.write(f'{txt}"\n"')
-    with open(outpath / 'message_as_string.txt', 'w', encoding='utf-8-sig') as f:
-      f.write(msg.message_as_string)
-  except UnicodeError as ue:
-    logger.exception(f'Unicode error in msg {msg_uuid}: {str(ue)}')
-    with open(outpath / 'headers.txt_UNICODE_BINARY', 'wb') as f:
-      for hdr, hdr_data in msg.headers.items():
-        f.write(bytes(hdr_data, encoding='utf-8-sig'))
-    with open(outpath / 'message.txt_UNICODE_BINARY', 'wb') as f:
-      for txt in msg.text_plain:
-        f.write(bytes(txt, encoding='utf-8-sig'))
-    with open(outpath / 'message.html_UNICODE_BINARY', 'wb') as f:
-      for txt in msg.text_html:
-        f.write(bytes(txt, encoding='utf-8-sig'))
+  return exporter.store_message_as_extract(mailparser.parse_from_bytes(msg_object),
+                                           outpath)
 
 
 def args_command_report_dupes(dbconn):
+  import sqlalchemy
+  import storage
   smt = sqlalchemy.select([storage.messagedata.c.msg_id])
   result = dbconn.execute(smt)
   cntdict = {}
@@ -248,138 +353,543 @@ def args_command_report_dupes(dbconn):
     print(' ')
 
 
-def arg_command_extract_email_for_acct(dbconn, email_label, email_export_root: Path):
-  bulk_export_root = util_lib.safe_create_path(Path(email_export_root), Path(email_label))
-  for ix, msg_uuid in enumerate(storage.msg_uuid_per_account(dbconn, email_label)):
-    logger.debug(
-      f'Extracting messages for {email_label}: '
-      f'{ix + 1}/{len(storage.msg_uuid_per_account(dbconn, email_label))} '
-      f'into {bulk_export_root}')
-    arg_command_extract_email(dbconn=dbconn, msg_uuid=msg_uuid,
-                              email_export_root=bulk_export_root)
+def arg_command_backfill_addresses(dbconn):
+  import addresses
+  linked = addresses.backfill(dbconn)
+  print(f'Linked the addresses of {linked} message(s)')
 
 
-if __name__ == '__main__':
+def arg_command_contact(dbconn, email_address: str, role=None, page=1, pagelen=20):
+  import addresses
+  for msg in addresses.messages_with_address(dbconn, email_address, role=role,
+                                             limit=pagelen, offset=(page - 1) * pagelen):
+    print(f"{msg['msg_uuid']}  {str(msg['msg_ts'] or ''):19.19}  {msg['email_account']}  "
+          f"{','.join(msg['roles']):12}  {msg['msg_subj']}")
 
-  logger.debug(f'{ar3_mailrepo_version_info.into_string()} '
-               f'in Python {platform.python_version()} '
-               f'on {platform.platform()}')
 
-  parser = argparse.ArgumentParser(prog='AR3 Mail Repo', usage='Print -h for help')
+def arg_command_top_correspondents(dbconn, email_label_or_all: str, role=None, limit=20):
+  import addresses
+  email_account = None if email_label_or_all.upper() == 'ALL' else email_label_or_all
+  for email_address, display_name, count in addresses.top_correspondents(
+      dbconn, email_account=email_account, role=role, limit=limit):
+    print(f"{count:8}  {email_address}  {display_name or ''}")
 
-  parser.add_argument('--create_db',
-                      help='Creates a new DB. If on a server, the database must be already created, it will only be populated. With SQLite it will create the database file',
-                      action='store_true')
-  parser.add_argument('--init_cache', help='Creates directories to hold file caches. Can be safely re-run, does not change existing directories', action='store_true')
 
-  parser.add_argument('--list_emails', help='Lists all email addresseses for which there is a connection specification available for download',
-                      action='store_true')
+def arg_command_backfill_threads(dbconn):
+  import threads
+  threaded = threads.backfill(dbconn)
+  print(f'Threaded {threaded} message(s)')
 
-  parser.add_argument('--list_folders', help='Lists all REMOTE IMAP folders for a given email or ALL. Needs access to the remote accoung',
-                      action='store', type=str)
 
-  parser.add_argument('--download', help='Downloads all emails for given email',
-                      action='store', type=str)
+def arg_command_conversation(dbconn, thread_id_or_msg_uuid: str):
+  import threads
+  if thread_id_or_msg_uuid.isdigit():
+    messages = threads.conversation(dbconn, thread_id=int(thread_id_or_msg_uuid))
+  else:
+    messages = threads.conversation(dbconn, msg_uuid=thread_id_or_msg_uuid)
+  for msg in messages:
+    print(f"{msg['msg_uuid']}  {str(msg['msg_ts'] or ''):19.19}  {'  ' * msg['depth']}"
+          f"{msg['msg_from']}  {msg['msg_subj']}")
+
+
+def arg_command_threads(dbconn, email_label_or_all: str, page=1, pagelen=20):
+  import threads
+  email_account = None if email_label_or_all.upper() == 'ALL' else email_label_or_all
+  for item in threads.threads_by_last_activity(dbconn, email_account=email_account,
+                                               limit=pagelen, offset=(page - 1) * pagelen):
+    print(f"{item['id']:8}  {str(item['last_ts'] or ''):19.19}  {item['message_count']:5}  "
+          f"{item['email_account']}  {item['subject'] or ''}")
+
+
+def arg_command_stats(dbconn, email_label_or_all: str):
+  import mailstats
+  email_account = None if email_label_or_all.upper() == 'ALL' else email_label_or_all
+  mb = 1024 * 1024
+  if not mailstats.is_complete(dbconn):
+    print('Warning: the statistics only count messages stored since they were '
+          'introduced, run --rebuild_stats once to include older messages')
+  rows = mailstats.monthly_stats(dbconn, email_account=email_account)
+  if not rows:
+    print('No statistics found')
+  for row in rows:
+    print(f"{row['email_account']}  {row['month'] or 'no date':7}  {row['source'] or '-':10}  "
+          f"{row['message_count']:8}  {row['raw_bytes'] / mb:10.1f} MB  "
+          f"{row['gmail_data_bytes'] / mb:8.1f} MB gmail_data")
+  for row in mailstats.account_totals(dbconn, email_account=email_account):
+    print(f"Total {row['email_account']}: {row['message_count']} message(s), "
+          f"{row['raw_bytes'] / mb:.1f} MB raw, "
+          f"{row['gmail_data_bytes'] / mb:.1f} MB compressed gmail_data")
+
+
+def arg_command_rebuild_stats(dbconn):
+  import mailstats
+  counted = mailstats.rebuild(dbconn)
+  print(f'Rebuilt the statistics of {counted} message(s)')
+
+
+def arg_command_extract_email_for_acct(dbconn, email_label, email_export_root: Path,
+                                      workers=None):
+  import exporter
+  # The export folder per account is fixed so that a re-run resumes the export
+  bulk_export_root = Path(email_export_root / util_lib.safe_folder_name(email_label))
+  exporter.export_account(dbconn, email_label, bulk_export_root, workers=workers)
+
+
+def arg_command_export_archive(dbconn, archive_format: str, email_label_or_all: str,
+                               email_export_root: Path,
+                               backend: 'search_backends.SearchBackend' = None,
+                               search_string=None):
+  import mailbox_archive
+  email_account = None if email_label_or_all.upper() == 'ALL' else email_label_or_all
+  msg_uuids = None
+  if search_string:
+    msg_uuids = backend.search_uuids(search_string)
+    logger.debug(f'Search {search_string} selected {len(msg_uuids)} message(s) to export')
+  archive_name = f'{util_lib.safe_folder_name(email_label_or_all)}.{archive_format}'
+  archive_path = util_lib.safe_new_path(email_export_root, Path(archive_name))
+  mailbox_archive.export_messages(dbconn, archive_format, archive_path,
+                                  email_account=email_account, msg_uuids=msg_uuids)
+
+
+def arg_command_import_archive(dbconn, archive_format: str, archive_path: Path,
+                               email_label: str):
+  import mailbox_archive
+  if not email_label:
+    raise RuntimeError('Importing an archive needs --import_account')
+  imported, skipped = mailbox_archive.import_messages(dbconn, archive_format,
+                                                      archive_path, email_label)
+  logger.debug(f'Imported {imported} message(s) from {archive_path} into '
+               f'{email_label}, {skipped} already present')
+
+
+class CommandContext:
+  """
+  Arguments and configuration of a run. The database engine is created when a
+  command first asks for it
+  """
+
+  def __init__(self, args, app_config: ar3_mailrepo_config.AppConfig):
+    self.args = args
+    self.conf = app_config
+    self._db_engine = None
+
+  def db_engine(self):
+    if self._db_engine is None:
+      import storage
+      self._db_engine = storage.DBEngine(self.conf)
+    return self._db_engine
+
+  def backend(self):
+    import search_backends
+    return search_backends.create_backend(self.conf, self.db_engine())
+
+  def close(self):
+    if self._db_engine is not None:
+      self._db_engine.close()
+
+
+# (option, add_argument keywords, function run with a CommandContext or None for
+# options that only modify a command). Commands run in the order of registration
+COMMAND_REGISTRY = []
+
+
+def option(name: str, **argument):
+  COMMAND_REGISTRY.append((name, argument, None))
+
+
+def command(name: str, **argument):
+  """
+  Registers the decorated function as the command run when option name is given
+  """
+  def register(run):
+    COMMAND_REGISTRY.append((name, argument, run))
+    return run
+  return register
+
+
+@command('--rebuild_index', help='Rebuild Search Index', action='store_true')
+def _run_rebuild_index(ctx: CommandContext):
+  arg_command_rebuild_search(ctx.backend(), ctx.db_engine().conn())
+
+
+@command('--rebuild_index_shard',
+         help='Rebuilds the Search Index shard of one email account, when '
+              'the index is sharded by account',
+         action='store', type=str)
+def _run_rebuild_index_shard(ctx: CommandContext):
+  arg_command_rebuild_search_shard(ctx.conf.search_index_root(), ctx.db_engine().conn(),
+                                   ctx.args.rebuild_index_shard,
+                                   ctx.conf.index_build_options())
+
+
+@command('--update_index',
+         help='Adds messages stored since the last index build or update '
+              'to the Search Index',
+         action='store_true')
+def _run_update_index(ctx: CommandContext):
+  arg_command_update_search(ctx.backend(), ctx.db_engine().conn())
+
+
+@command('--search', help='Searches for a string. Fields can be queried as '
+                          'date:[2019 to 2020], account:, subject:, from:, '
+                          'to:, body:, attachment:',
+         action='store', type=str)
+def _run_search(ctx: CommandContext):
+  arg_command_search(ctx.conf, ctx.args.search, sort_by=ctx.args.sort,
+                     page=ctx.args.page, pagelen=ctx.args.pagelen,
+                     highlight=ctx.args.highlight, db_engine_for=ctx.db_engine)
+
+
+# The keys of searcher.SORT_FIELDS, which is not imported to keep the start fast
+option('--sort', help='Sorts search results by date or account',
+       action='store', type=str, choices=['account', 'date'])
+option('--page', help='Page of search or contact results to show (default: 1)',
+       action='store', type=int, default=1)
+option('--pagelen', help='Search or contact results per page (default: 20)',
+       action='store', type=int, default=20)
+option('--highlight', help='Shows matching fragments of search results',
+       action='store_true')
+
+
+@command('--serve_search',
+         help='Runs a local search service keeping the index open. '
+              '--search uses it when search_service is configured and it is running',
+         action='store_true')
+def _run_serve_search(ctx: CommandContext):
+  arg_command_serve_search(ctx.backend(), ctx.conf.search_index_root(), ctx.db_engine(),
+                           ctx.conf.search_service_options(),
+                           maintenance_options=ctx.conf.index_maintenance_options())
+
+
+@command('--index_maintenance',
+         help='Reports segments, deleted documents and size of the Search '
+              'Index and merges segments when over the configured thresholds',
+         action='store_true')
+def _run_index_maintenance(ctx: CommandContext):
+  # --optimize_index includes the report
+  if not ctx.args.optimize_index:
+    arg_command_index_maintenance(ctx.backend(), ctx.conf.index_maintenance_options())
+
+
+@command('--optimize_index',
+         help='Merges the Search Index into a single segment. Safe while the '
+              'search service is running',
+         action='store_true')
+def _run_optimize_index(ctx: CommandContext):
+  arg_command_index_maintenance(ctx.backend(), ctx.conf.index_maintenance_options(),
+                                optimize=True)
+
+
+@command('--rebuild_db_data',
+         help='Repopulates a database with the contents of a download cache. '
+              'Can be safely re-run: messages already in the database and '
+              'fully ingested cache folders are skipped. '
+              'Pass email as arg or ALL for all',
+         action='store', type=str)
+def _run_rebuild_db_data(ctx: CommandContext):
+  arg_command_rebuild_database(db_engine=ctx.db_engine(),
+                               datacache_root=ctx.conf.cache_dir(),
+                               email_label_or_all=ctx.args.rebuild_db_data,
+                               workers=ctx.conf.ingest_workers())
+  auto_update_search(ctx.conf, ctx.db_engine())
+
+
+@command('--list_emails',
+         help='Lists all email addresseses for which there is a connection '
+              'specification available for download',
+         action='store_true')
+def _run_list_emails(ctx: CommandContext):
+  arg_command_list_all_emails(credentials_root_path=ctx.conf.credentials_root())
+
+
+@command('--create_db',
+         help='Creates a new DB. If on a server, the database must be already created, '
+              'it will only be populated. With SQLite it will create the database file',
+         action='store_true')
+def _run_create_db(ctx: CommandContext):
+  arg_command_create_db(db_engine=ctx.db_engine())
+
+
+@command('--init_cache',
+         help='Creates directories to hold file caches. Can be safely re-run, does not '
+              'change existing directories',
+         action='store_true')
+def _run_init_cache(ctx: CommandContext):
+  arg_command_init_cache(data_cache_dir=ctx.conf.cache_dir(),
+                         credential_root_dir=ctx.conf.credentials_root(),
+                         db_engine=ctx.db_engine())
+
+
+@command('--store_message_cache_into_db',
+         help='Stores messages from a cache into the DB',
+         action='store', type=str)
+def _run_store_message_cache_into_db(ctx: CommandContext):
+  import storage
+  cachfolder = storage.DataCacheFolder(ctx.args.store_message_cache_into_db)
+  cachfolder.store_messages_in_database(ctx.db_engine().conn())
+  auto_update_search(ctx.conf, ctx.db_engine())
+
+
+@command('--list_folders',
+         help='Lists all REMOTE IMAP folders for a given email or ALL. Needs access to '
+              'the remote accoung',
+         action='store', type=str)
+def _run_list_folders(ctx: CommandContext):
+  # args.list_folders has email label as argument
+  arg_command_list_folders_for_email(credential_root_path=ctx.conf.credentials_root(),
+                                     emaillabel=ctx.args.list_folders)
+
+
+@command('--extract_pickle_obj',
+         help='COnverts specific pikcle file into message extract',
+         action='store', type=str)
+def _run_extract_pickle_obj(ctx: CommandContext):
+  arg_command_extract_pickle_obj(Path(ctx.args.extract_pickle_obj),
+                                 ctx.conf.email_export_root())
+
+
+@command('--download', help='Downloads all emails for given email',
+         action='store', type=str)
+def _run_download(ctx: CommandContext):
+  if ctx.args.pipeline:
+    arg_command_download_pipeline(ctx.args.download, ctx.conf, ctx.db_engine())
+    return
+  arg_command_download_and_store_emails(emaillabel=ctx.args.download,
+                                        cacheeroot=ctx.conf.cache_dir(),
+                                        credentials_root=ctx.conf.credentials_root(),
+                                        db_engine=ctx.db_engine(),
+                                        workers=ctx.conf.download_workers())
+  # Nothing to index yet: this only fills the cache, --store_message_cache_into_db
+  # and --rebuild_db_data store the messages and update the index
+
+
+option('--pipeline',
+       help='With --download, stores and indexes messages as they arrive '
+            'instead of downloading into the cache first',
+       action='store_true')
+
+
+@command('--sync_daemon',
+         help='Keeps running and stores new emails for given email or ALL as '
+              'they arrive, using IMAP IDLE and Gmail history polling',
+         action='store', type=str)
+def _run_sync_daemon(ctx: CommandContext):
+  arg_command_sync_daemon(ctx.args.sync_daemon, ctx.conf, ctx.db_engine())
+
+
+@command('--extract_email', help='Extracts an email with a given UUID',
+         action='store', type=str)
+def _run_extract_email(ctx: CommandContext):
+  arg_command_extract_email(dbconn=ctx.db_engine().conn(),
+                            msg_uuid=ctx.args.extract_email,
+                            email_export_root=ctx.conf.email_export_root())
+
+
+@command('--report_message_id_dupes', help='Creates a report of all dupe message IDs',
+         action='store_true')
+def _run_report_message_id_dupes(ctx: CommandContext):
+  args_command_report_dupes(dbconn=ctx.db_engine().conn())
+
+
+@command('--backfill_addresses',
+         help='Links messages stored before the address tables existed to their '
+              'sender and recipient addresses. Can be safely re-run',
+         action='store_true')
+def _run_backfill_addresses(ctx: CommandContext):
+  arg_command_backfill_addresses(ctx.db_engine().conn())
+
+
+@command('--contact',
+         help='Lists the messages from or to an email address, newest first, '
+              'paged by --page / --pagelen',
+         action='store', type=str)
+def _run_contact(ctx: CommandContext):
+  arg_command_contact(ctx.db_engine().conn(), ctx.args.contact, role=ctx.args.role,
+                      page=ctx.args.page, pagelen=ctx.args.pagelen)
+
+
+@command('--top_correspondents',
+         help='Lists the addresses in the most messages of given account or ALL, '
+              'up to --pagelen',
+         action='store', type=str)
+def _run_top_correspondents(ctx: CommandContext):
+  arg_command_top_correspondents(ctx.db_engine().conn(), ctx.args.top_correspondents,
+                                 role=ctx.args.role, limit=ctx.args.pagelen)
+
 
-  parser.add_argument('--rebuild_db_data',
-                      help='Repopulates a database with the contents of a download cache.\
-                       Does NOT check for duplicates. Pass email as arg or ALL for all',
-                      action='store', type=str)
+@command('--backfill_threads',
+         help='Adds messages stored before the thread tables existed to their '
+              'conversation threads. Can be safely re-run',
+         action='store_true')
+def _run_backfill_threads(ctx: CommandContext):
+  arg_command_backfill_threads(ctx.db_engine().conn())
 
 
+@command('--conversation',
+         help='Shows the thread of given thread id or message uuid as a reply tree, '
+              'oldest first',
+         action='store', type=str)
+def _run_conversation(ctx: CommandContext):
+  arg_command_conversation(ctx.db_engine().conn(), ctx.args.conversation)
+
+
+@command('--threads',
+         help='Lists the threads of given account or ALL by last activity, '
+              'paged by --page / --pagelen',
+         action='store', type=str)
+def _run_threads(ctx: CommandContext):
+  arg_command_threads(ctx.db_engine().conn(), ctx.args.threads,
+                      page=ctx.args.page, pagelen=ctx.args.pagelen)
 
-  parser.add_argument('--rebuild_index', help='Rebuild Search Index',
-                      action='store_true')
-  parser.add_argument('--search', help='Searches for a string',
-                      action='store', type=str)
 
+@command('--stats',
+         help='Shows message counts and stored sizes per month and source of given '
+              'account or ALL, from the statistics kept at ingest',
+         action='store', type=str)
+def _run_stats(ctx: CommandContext):
+  arg_command_stats(ctx.db_engine().conn(), ctx.args.stats)
 
 
-  parser.add_argument('--extract_pickle_obj',
-                      help='COnverts specific pikcle file into message extract',
-                      action='store', type=str)
+@command('--rebuild_stats',
+         help='Recomputes the statistics of --stats from the stored messages, for '
+              'databases created before they were kept. Run while no ingest is running',
+         action='store_true')
+def _run_rebuild_stats(ctx: CommandContext):
+  arg_command_rebuild_stats(ctx.db_engine().conn())
 
 
-  parser.add_argument('--store_message_cache_into_db',
-                      help='Stores messages from a cache into the DB',
-                      action='store', type=str)
+# The keys of addresses.ROLE_HEADERS
+option('--role', help='Restricts --contact / --top_correspondents to one role',
+       action='store', type=str, choices=['from', 'to', 'cc', 'bcc'])
 
-  parser.add_argument('--extract_email',
-                      help='Extracts an email with a given UUID',
-                      action='store', type=str)
 
-  parser.add_argument('--report_message_id_dupes',
-                      help='Creates a report of all dupe message IDs',
-                      action='store_true')
+@command('--extract_email_for_acct',
+         help='Extracts emails for given account. Re-running resumes an '
+              'interrupted export',
+         action='store', type=str)
+def _run_extract_email_for_acct(ctx: CommandContext):
+  arg_command_extract_email_for_acct(dbconn=ctx.db_engine().conn(),
+                                     email_label=ctx.args.extract_email_for_acct,
+                                     email_export_root=ctx.conf.email_export_root(),
+                                     workers=ctx.conf.export_workers())
 
 
-  parser.add_argument('--extract_email_for_acct',
-                      help='Extracts emails for given account',
-                      action='store', type=str)
+def _run_export_archive(ctx: CommandContext, archive_format: str, export_arg: str):
+  arg_command_export_archive(dbconn=ctx.db_engine().conn(),
+                             archive_format=archive_format,
+                             email_label_or_all=export_arg,
+                             email_export_root=ctx.conf.email_export_root(),
+                             backend=ctx.backend() if ctx.args.export_query else None,
+                             search_string=ctx.args.export_query)
 
-  args = parser.parse_args()
 
-  conf = ar3_mailrepo_config.AppConfig.from_configfile('ar3_mailreport_config.yaml')
-  email_storage_db_engine = storage.DBEngine(conf)
+@command('--export_mbox',
+         help='Exports emails for given account or ALL into an mbox file',
+         action='store', type=str)
+def _run_export_mbox(ctx: CommandContext):
+  _run_export_archive(ctx, 'mbox', ctx.args.export_mbox)
 
-  try:
 
-    if args.rebuild_index:
-      arg_command_rebuild_search(conf.search_index_root(), email_storage_db_engine.conn())
+@command('--export_maildir',
+         help='Exports emails for given account or ALL into a Maildir',
+         action='store', type=str)
+def _run_export_maildir(ctx: CommandContext):
+  _run_export_archive(ctx, 'maildir', ctx.args.export_maildir)
 
-    if args.search:
-      arg_command_search(conf.search_index_root(), args.search)
 
-    if args.rebuild_db_data:
-      arg_command_rebuild_database(db_engine=email_storage_db_engine,
-                                   datacache_root=conf.cache_dir(),
-                                   email_label_or_all=args.rebuild_db_data)
+option('--export_query',
+       help='Restricts --export_mbox / --export_maildir to the results of a search',
+       action='store', type=str)
 
-    if args.list_emails:
-      arg_command_list_all_emails(credentials_root_path=conf.credentials_root())
 
-    if args.create_db:
-      arg_command_create_db(db_engine=email_storage_db_engine)
+def _run_import_archive(ctx: CommandContext, archive_format: str, import_arg: str):
+  arg_command_import_archive(dbconn=ctx.db_engine().conn(),
+                             archive_format=archive_format,
+                             archive_path=Path(import_arg),
+                             email_label=ctx.args.import_account)
+  auto_update_search(ctx.conf, ctx.db_engine())
 
-    if args.init_cache:
-      arg_command_init_cache(data_cache_dir=conf.cache_dir(),
-                             credential_root_dir=conf.credentials_root(),
-                             db_engine=email_storage_db_engine)
 
-    if args.store_message_cache_into_db:
-      cachfolder = storage.DataCacheFolder(args.store_message_cache_into_db)
-      cachfolder.store_messages_in_database(email_storage_db_engine.conn())
+@command('--import_mbox',
+         help='Imports an mbox file into the database. Needs --import_account',
+         action='store', type=str)
+def _run_import_mbox(ctx: CommandContext):
+  _run_import_archive(ctx, 'mbox', ctx.args.import_mbox)
 
-    if args.list_folders:
-      # args.list_folders has email label as argument
-      arg_command_list_folders_for_email(credential_root_path=conf.credentials_root(),
-                                         emaillabel=args.list_folders)
 
-    if args.extract_pickle_obj:
-      arg_command_extract_pickle_obj(Path(args.extract_pickle_obj),
-                                     conf.email_export_root())
+@command('--import_maildir',
+         help='Imports a Maildir into the database. Needs --import_account',
+         action='store', type=str)
+def _run_import_maildir(ctx: CommandContext):
+  _run_import_archive(ctx, 'maildir', ctx.args.import_maildir)
 
-    if args.download:
-      arg_command_download_and_store_emails(emaillabel=args.download,
-                                            cacheeroot=conf.cache_dir(),
-                                            credentials_root=conf.credentials_root(),
-                                            db_engine=email_storage_db_engine)
-    if args.extract_email:
-      arg_command_extract_email(dbconn=email_storage_db_engine.conn(),
-                                msg_uuid=args.extract_email,
-                                email_export_root=conf.email_export_root())
 
-    if args.report_message_id_dupes:
-      args_command_report_dupes(dbconn=email_storage_db_engine.conn())
+option('--import_account',
+       help='Email account to store messages under for --import_mbox / --import_maildir',
+       action='store', type=str)
 
-    if args.extract_email_for_acct:
-      arg_command_extract_email_for_acct(dbconn=email_storage_db_engine.conn(),
-                                         email_label=args.extract_email_for_acct,
-                                         email_export_root=conf.email_export_root())
+option('--log_level', help='Overrides log_level of the configuration',
+       action='store', type=str.upper, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+# Values of profiling.MODES
+option('--profile',
+       help='Profiles the selected commands with cProfile (default) or a '
+            'stack sampler, plus tracemalloc, and prints the hot functions',
+       action='store', nargs='?', const='cprofile', choices=['cprofile', 'sample'])
+
+
+def build_parser():
+  parser = argparse.ArgumentParser(prog='AR3 Mail Repo', usage='Print -h for help')
+  for name, argument, unused in COMMAND_REGISTRY:  # pylint: disable=unused-variable
+    parser.add_argument(name, **argument)
+  return parser
 
 
+def selected_commands(args):
+  return [run for name, unused, run in COMMAND_REGISTRY  # pylint: disable=unused-variable
+          if run and getattr(args, name.lstrip('-'))]
 
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  conf = ar3_mailrepo_config.AppConfig.from_configfile('ar3_mailreport_config.yaml')
+  util_logger.apply_logger_handler(level=args.log_level or conf.log_level())
+  logger.debug(f'{ar3_mailrepo_version_info.into_string()} '
+               f'in Python {platform.python_version()} '
+               f'on {platform.platform()}')
+
+  ctx = CommandContext(args, conf)
+  metrics_options = conf.metrics_options()
+  if metrics_options['http_port']:
+    import metrics
+    metrics.start_http_server(metrics_options['http_host'], metrics_options['http_port'])
+  profile_session = None
+  if args.profile:
+    import profiling
+    profiling_options = conf.profiling_options()
+    profile_session = profiling.ProfileSession(
+      profiling_options['output_dir'], label='ar3_mailrepo', mode=args.profile,
+      memory=profiling_options['memory'], top=profiling_options['top'],
+      sample_interval=profiling_options['sample_interval_seconds']).start()
+
+  try:
+    for run in selected_commands(args):
+      run(ctx)
   except Exception:  # pylint: disable=broad-except
     logger.exception('Exception caught as MAIN level')
   finally:
-    email_storage_db_engine.close()
+    try:
+      if profile_session:
+        logger.info(profile_session.stop())
+    finally:
+      ctx.close()
+    # Only modules that record metrics load the metrics module
+    metrics = sys.modules.get('metrics')
+    if metrics:
+      if metrics_options['summary']:
+        metrics.log_summary()
+      if metrics_options['textfile']:
+        metrics.write_textfile(Path(metrics_options['textfile']))
+
+
+if __name__ == '__main__':
+  main()
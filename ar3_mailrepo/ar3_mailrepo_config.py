@@ -20,10 +20,81 @@
 Configuration manager for MailRepo
 """
 
+import os
 from pathlib import Path
 
 import yaml
 
+# Applied to every SQLite connection, overridden by sqlite_pragmas in the config.
+# WAL lets readers run concurrently with the writer, synchronous=NORMAL only
+# syncs at checkpoints in WAL mode
+DEFAULT_SQLITE_PRAGMAS = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'mmap_size': 256 * 1024 * 1024,
+  'cache_size': -64 * 1024,  # negative values are KiB
+  'temp_store': 'MEMORY',
+  'busy_timeout': 30000,
+}
+
+# Options of a full search index build, overridden by index_build in the config
+DEFAULT_INDEX_BUILD_OPTIONS = {
+  'procs': os.cpu_count(),
+  'limitmb': 256,
+  'multisegment': False,
+  'batch_size': 1000,
+  'text_workers': os.cpu_count(),
+  'body_max_chars': 20000,
+}
+
+# Thresholds of --index_maintenance, overridden by index_maintenance in the config.
+# interval_minutes > 0 also runs it in the background of the search service
+DEFAULT_INDEX_MAINTENANCE_OPTIONS = {
+  'max_segments': 8,
+  'max_deleted_ratio': 0.2,
+  'interval_minutes': 0,
+}
+
+# Streaming download of --download --pipeline, overridden by download_pipeline in
+# the config
+DEFAULT_DOWNLOAD_PIPELINE_OPTIONS = {
+  'queue_size': 1000,
+  'cache_tee': True,
+  'update_index': True,
+  'flush_seconds': 1.0,
+  'index_interval_seconds': 5.0,
+}
+
+# Continuous sync of --sync_daemon, overridden by sync_daemon in the config
+DEFAULT_SYNC_DAEMON_OPTIONS = {
+  'idle_folders': ['INBOX'],
+  'idle_seconds': 600,
+  'noop_seconds': 60,
+  'poll_seconds': 900,
+  'gmail_poll_seconds': 60,
+  'backoff_initial_seconds': 5,
+  'backoff_max_seconds': 900,
+  'jitter': 0.2,
+  'start_jitter_seconds': 10,
+  'status_interval_seconds': 300,
+}
+
+# Metrics of --download, --rebuild_db_data, indexing etc., overridden by metrics in
+# the config. http_port > 0 serves them while a command runs
+DEFAULT_METRICS_OPTIONS = {
+  'summary': True,
+  'textfile': None,
+  'http_host': '127.0.0.1',
+  'http_port': 0,
+}
+
+DEFAULT_PROFILING_OPTIONS = {
+  'output_dir': None,
+  'memory': True,
+  'top': 25,
+  'sample_interval_seconds': 0.005,
+}
+
 
 class AppConfig:
   """
@@ -58,3 +129,89 @@ class AppConfig:
 
   def email_export_root(self):
     return Path(self.data['email_export_root'])
+
+  def export_workers(self):
+    return int(self.data.get('export_workers', os.cpu_count()))
+
+  def db_pool_options(self, db_driver: str):
+    """
+    Pool settings of db_pool for one db_driver, db_pool being keyed by driver
+    """
+    return dict((self.data.get('db_pool') or {}).get(db_driver) or {})
+
+  def download_workers(self):
+    return int(self.data.get('download_workers', 1))
+
+  def sqlite_pragmas(self):
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    pragmas.update(self.data.get('sqlite_pragmas') or {})
+    return pragmas
+
+  def sqlite_writer_thread(self):
+    return bool(self.data.get('sqlite_writer_thread', True))
+
+  def sqlite_writer_queue_size(self):
+    """
+    Writes queued for the writer thread before producers block. Each may be a batch
+    of up to INSERT_BATCH_BYTES, so the default is small: two per worker
+    """
+    return int(self.data.get('sqlite_writer_queue_size',
+                             2 * max(self.ingest_workers(), self.download_workers())))
+
+  def ingest_workers(self):
+    return int(self.data.get('ingest_workers', 1))
+
+  def auto_update_index(self):
+    return bool(self.data.get('auto_update_index', False))
+
+  def index_build_options(self):
+    options = dict(DEFAULT_INDEX_BUILD_OPTIONS)
+    options.update(self.data.get('index_build') or {})
+    return options
+
+  def search_backend(self):
+    # 'whoosh' for the index under whoosh_index_root, 'database' for full-text
+    # search in the database (SQLite and Postgres)
+    return self.data.get('search_backend', 'whoosh')
+
+  def index_shard_by(self):
+    # 'none' keeps a single index, 'account' one index shard per email account
+    return self.data.get('index_shard_by', 'none')
+
+  def index_maintenance_options(self):
+    options = dict(DEFAULT_INDEX_MAINTENANCE_OPTIONS)
+    options.update(self.data.get('index_maintenance') or {})
+    return options
+
+  def download_pipeline_options(self):
+    options = dict(DEFAULT_DOWNLOAD_PIPELINE_OPTIONS)
+    options.update(self.data.get('download_pipeline') or {})
+    return options
+
+  def sync_daemon_options(self):
+    options = dict(DEFAULT_SYNC_DAEMON_OPTIONS)
+    options.update(self.data.get('sync_daemon') or {})
+    return options
+
+  def metrics_options(self):
+    options = dict(DEFAULT_METRICS_OPTIONS)
+    options.update(self.data.get('metrics') or {})
+    return options
+
+  def log_level(self):
+    return str(self.data.get('log_level', 'DEBUG')).upper()
+
+  def profiling_options(self):
+    options = dict(DEFAULT_PROFILING_OPTIONS)
+    options.update(self.data.get('profiling') or {})
+    options['output_dir'] = Path(options['output_dir']) if options['output_dir'] \
+      else self.cache_dir() / 'profiles'
+    return options
+
+  def search_service_configured(self):
+    return 'search_service' in self.data
+
+  def search_service_options(self):
+    options = {'host': '127.0.0.1', 'port': 8765, 'cache_size': 256}
+    options.update(self.data.get('search_service') or {})
+    return options
@@ -28,19 +28,56 @@ import json
 import logging
 import pickle
 import re
+import select
 import ssl
+import time
 from pathlib import Path
 
 import google
+import google.auth.credentials
 import google_auth_oauthlib
 import mailparser
 from googleapiclient.discovery import build
 
+import metrics
 import util_lib
+import util_logger
 
 logger = logging.getLogger('ar3_mailrepo.ar3_mailreport_lib')
 
 
+def new_download_report(since_date: datetime.datetime, dupes_filterset: set):
+  return {
+    'ok_count': 0,
+    'dupe_filter_size': len(dupes_filterset),
+    'since_date': since_date.isoformat(),
+    'dupe_count': 0,
+    'error_count_folders': 0,
+    'error_count_msg': 0,
+    'download_start': datetime.datetime.now().isoformat(),
+    'download_duration_seconds': 0,
+  }
+
+
+@metrics.timed('ar3mr_cache_write_seconds')
+def write_message_to_cache(cache_folder: Path, msg: dict):
+  msg_fnmame = Path(cache_folder / f"Msg_{msg['ar3mr_uuid']}.pickle")
+  with open(msg_fnmame, 'wb') as msgf:
+    pickle.dump(obj=msg, file=msgf, protocol=util_lib.PICKLE_PROTOCOL)
+
+
+def write_download_report(cache_folder: Path, download_report: dict):
+  """
+  Sets the duration and writes the report, which marks the cache folder as complete
+  """
+  download_start = datetime.datetime.fromisoformat(download_report['download_start'])
+  download_report['download_duration_seconds'] = int(
+    (datetime.datetime.now() - download_start).total_seconds())
+  dnreport_nmame = Path(cache_folder / 'download_report.json')
+  with open(dnreport_nmame, 'w') as dnrpf:
+    json.dump(obj=download_report, fp=dnrpf, indent=4)
+
+
 def create_server_connection(credentials: dict):
   if credentials['protocol'] == 'imap4':
     return IMAPServerConnection(credentials)
@@ -64,58 +101,61 @@ class ServerConnection:
   def close(self):
     pass
 
-  def retrieve_messages_to_cache(self, cache_folder: Path,
-                                 since_date: datetime.datetime,
-                                 dupes_filterset: set):
-    logger.debug(f"Begin Retrieve messages for {self.credentials['emaillabel']}"
-                 f" into {cache_folder} since {since_date}")
-    ok_count = 0
-    dupe_count = 0
-    error_count_folders = 0
-    error_count_msg = 0
-    download_start = datetime.datetime.now()
-    for result in self.retrieve_messages(since_date, dupes_filterset):
+  def download_messages(self, since_date: datetime.datetime, dupes_filterset: set,
+                        download_report: dict, error_folder: Path = None):
+    """
+    Yields the downloaded messages stamped with account, uuid and download time.
+    Counts are added to download_report, see new_download_report. Error descriptions
+    are written to files in error_folder if given, otherwise only logged
+    """
+    return self.stamp_messages(self.retrieve_messages(since_date, dupes_filterset),
+                               download_report, error_folder=error_folder)
+
+  def stamp_messages(self, results, download_report: dict, error_folder: Path = None):
+    """
+    download_messages over the results of any retrieve method
+    """
+    download_start = datetime.datetime.fromisoformat(download_report['download_start'])
+    for result in results:
       result_id = util_lib.create_unique_id()
       if 'is_error' in result:
         if result['error_scope'] == 'FOLDER':
-          error_count_folders += 1
+          download_report['error_count_folders'] += 1
         elif result['error_scope'] == 'MESSAGE':
-          error_count_msg += 1
+          download_report['error_count_msg'] += 1
         else:
           raise RuntimeError('Unknown Error scope ', result['error_scope'])
-        error_fname = Path(
-          cache_folder / f"Error_{result['error_scope']}_{result_id}.txt")
-        with open(error_fname, 'w') as errorf:
-          errorf.write(result['error_description'])
-          errorf.write('\n')
+        if error_folder:
+          error_fname = Path(
+            error_folder / f"Error_{result['error_scope']}_{result_id}.txt")
+          with open(error_fname, 'w') as errorf:
+            errorf.write(result['error_description'])
+            errorf.write('\n')
+        else:
+          logger.error(f"Download error for {self.credentials['emaillabel']}: "
+                       f"{result['error_description']}")
       elif 'is_dupe' in result:
-        dupe_count += 1
+        download_report['dupe_count'] += 1
       else:
-        ok_count += 1
+        download_report['ok_count'] += 1
         msg = result
         msg['ar3mr_email_account'] = self.credentials['emaillabel']
         msg['ar3mr_uuid'] = result_id
         msg['ar3mr_downloadtime'] = download_start
         if 'ar3mr_gmail_data' not in msg:
           msg['ar3mr_gmail_data'] = None
-        msg_fnmame = Path(cache_folder / f'Msg_{result_id}.pickle')
-        with open(msg_fnmame, 'wb') as msgf:
-          pickle.dump(obj=msg, file=msgf, protocol=util_lib.PICKLE_PROTOCOL)
-    download_duration_seconds = int(
-      (datetime.datetime.now() - download_start).total_seconds())
-    download_report = {
-      'ok_count': ok_count,
-      'dupe_filter_size': len(dupes_filterset),
-      'since_date': since_date.isoformat(),
-      'dupe_count': dupe_count,
-      'error_count_folders': error_count_folders,
-      'error_count_msg': error_count_msg,
-      'download_start': download_start.isoformat(),
-      'download_duration_seconds': download_duration_seconds,
-    }
-    dnreport_nmame = Path(cache_folder / 'download_report.json')
-    with open(dnreport_nmame, 'w') as dnrpf:
-      json.dump(obj=download_report, fp=dnrpf, indent=4)
+        yield msg
+
+  def retrieve_messages_to_cache(self, cache_folder: Path,
+                                 since_date: datetime.datetime,
+                                 dupes_filterset: set):
+    logger.debug(f"Begin Retrieve messages for {self.credentials['emaillabel']}"
+                 f" into {cache_folder} since {since_date}")
+    download_report = new_download_report(since_date, dupes_filterset)
+    for msg in self.download_messages(since_date, dupes_filterset, download_report,
+                                      error_folder=cache_folder):
+      write_message_to_cache(cache_folder, msg)
+    write_download_report(cache_folder, download_report)
     logger.debug(f"Finish Retrieve messages for {self.credentials['emaillabel']}"
                  f" into {cache_folder} since {since_date}")
 
@@ -136,6 +176,12 @@ class GmailServerConnection(ServerConnection):
 
   @staticmethod
   def _build_gmail_service(generic_credentials: dict):
+    if generic_credentials.get('gmail_api_endpoint'):
+      # Local stand-in for the Gmail API, see fake_servers. Uses the discovery
+      # document shipped with googleapiclient, so no network access is needed
+      return build('gmail', 'v1', credentials=google.auth.credentials.AnonymousCredentials(),
+                   client_options={'api_endpoint': generic_credentials['gmail_api_endpoint']},
+                   static_discovery=True)
     token_cachefile = generic_credentials['gmail_oauth_token_cache']
     credentials = generic_credentials['gmail_oauth_credentials']
     creds = None
@@ -168,16 +214,6 @@ class GmailServerConnection(ServerConnection):
     return results.get('labels', [])
 
   def retrieve_messages(self, since_date: datetime.datetime, dupes_filterset: set):
-    expected_fileds = {
-      'id',
-      'threadId',
-      'labelIds',
-      'snippet',
-      'sizeEstimate',
-      'raw',
-      'historyId',
-      'internalDate'
-    }
     download_chunk_sz = 1000
     q_param = 'after:' + since_date.strftime('%Y-%m-%d')
     results = self.conn.users().messages().list(userId='me', q=q_param,
@@ -191,36 +227,78 @@ class GmailServerConnection(ServerConnection):
       if results['resultSizeEstimate'] > 0:
         resultlist.extend(results['messages'])
     message_ids = {x['id'] for x in resultlist}
+    yield from self.retrieve_messages_by_id(message_ids, dupes_filterset)
+
+  def current_history_id(self):
+    return self.conn.users().getProfile(userId='me').execute()['historyId']
+
+  def list_history_message_ids(self, start_history_id: str):
+    """
+    Returns (latest history id, ids of messages added after start_history_id). The
+    API answers 404 once start_history_id is too old, then a full download is needed
+    """
+    message_ids = []
+    page_token = None
+    while True:
+      results = self.conn.users().history().list(
+        userId='me', startHistoryId=start_history_id, historyTypes='messageAdded',
+        pageToken=page_token).execute()
+      for record in results.get('history', []):
+        message_ids.extend(x['message']['id'] for x in record.get('messagesAdded', []))
+      page_token = results.get('nextPageToken')
+      if not page_token:
+        return results['historyId'], list(dict.fromkeys(message_ids))
+
+  def retrieve_messages_by_id(self, message_ids, dupes_filterset: set):
+    expected_fileds = {
+      'id',
+      'threadId',
+      'labelIds',
+      'snippet',
+      'sizeEstimate',
+      'raw',
+      'historyId',
+      'internalDate'
+    }
     error_limt = 1000
     error_count = 0
-    for msg_ix, message_id in enumerate(message_ids):
+    message_ids = list(message_ids)
+    progress = util_logger.ProgressReporter(
+      logger, f"Download {self.credentials['emaillabel']}", total=len(message_ids))
+    for message_id in message_ids:
+      progress.update()
       try:
-        message = self.conn.users().messages().get(userId='me', id=message_id,
-                                                   format='raw').execute()
-        logger.debug(f'Download message {msg_ix + 1}/{len(message_ids)}: {message_id}')
+        # Gmail ids are stored as msg_id, so known messages are not fetched again
+        if message_id in dupes_filterset:
+          yield {
+            'is_dupe': 'True',
+          }
+          continue
+        with metrics.timed('ar3mr_fetch_seconds', protocol='gmail'):
+          message = self.conn.users().messages().get(userId='me', id=message_id,
+                                                     format='raw').execute()
+        metrics.counter('ar3mr_fetch_bytes_total', protocol='gmail').inc(
+          message.get('sizeEstimate', 0))
         if len(set(message.keys()) - expected_fileds) > 0:
           logger.error(f'Unexpected contents in gmail downloaded data: \
           {set(message.keys())} compared to {expected_fileds}')
           raise RuntimeError(f'Unexpected contents in gmail downloaded data: \
           {set(message.keys())} compared to {expected_fileds}')
-        if id in dupes_filterset:
-          yield {
-            'is_dupe': 'True',
-          }
-        else:
-          yield self.standardise_message(message)
+        yield self.standardise_message(message)
       except Exception as e: # pylint: disable=broad-except
         error_count += 1
         if error_count > error_limt:
           raise RuntimeError(
             f'Exceeding number of messages errors {error_count} in gmail download')
-        logger.debug(f'Yielding error object {str(e)}')
+        logger.debug('Yielding error object %s', e)
         yield {
           'is_error': 'True',
           'error_description': str(e),
           'error_scope': 'MESSAGE'
         }
+    progress.done()
 
+  @metrics.timed('ar3mr_parse_seconds', protocol='gmail')
   def standardise_message(self, downloaded_msgitem):
     m = mailparser.parse_from_bytes(
       base64.urlsafe_b64decode(downloaded_msgitem['raw'].encode('ASCII')))
@@ -257,6 +335,7 @@ class IMAPServerConnection(ServerConnection):
   LIST_RESPONSE_PATTERN = re.compile(
     r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)'
   )
+  EXISTS_PATTERN = re.compile(rb'\* \d+ EXISTS')
 
   @staticmethod
   def _strip_folder_name(folder_list_record: str):
@@ -272,7 +351,11 @@ class IMAPServerConnection(ServerConnection):
   def create_imap_connection(credentials: dict):
     logger.debug(f"Logging into IMAP Server {credentials['imap_user']} "
                  f"@ {credentials['imap_host']}")
-    if credentials['imap_starttls']:
+    if credentials.get('imap_plaintext'):
+      # Unencrypted, only meant for local servers such as fake_servers
+      imap_conn = imaplib.IMAP4(host=credentials['imap_host'],
+                                port=credentials['imap_port'])
+    elif credentials['imap_starttls']:
       ctx = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1)
       imap_conn = imaplib.IMAP4(host=credentials['imap_host'],
                                 port=credentials['imap_port'])
@@ -342,10 +425,12 @@ class IMAPServerConnection(ServerConnection):
         folder_return_status = 'Exception'
       if folder_return_status == 'OK':
         download_size = len(folder_data[0].split())
-        for msg_ix, msg_num in enumerate(folder_data[0].split()):
-          logger.debug(
-            f'Download message {msg_ix + 1}/{download_size} in {folder}: {msg_num}')
-          msg_return_status, msg_data = self.conn.fetch(msg_num, '(RFC822)')
+        progress = util_logger.ProgressReporter(logger, f'Download {account} {folder}',
+                                                total=download_size)
+        for msg_num in folder_data[0].split():
+          progress.update()
+          with metrics.timed('ar3mr_fetch_seconds', protocol='imap4'):
+            msg_return_status, msg_data = self.conn.fetch(msg_num, '(RFC822)')
           if not msg_data[0]:
             msg_return_status = f'Error: message is empty object {msg_num} in {folder}'
           if msg_return_status != 'OK':
@@ -361,17 +446,99 @@ class IMAPServerConnection(ServerConnection):
               raise RuntimeError(
                 f'Exceeding number of messages errors {msg_error_count} in {account}')
           if msg_return_status == 'OK':
+            metrics.counter('ar3mr_fetch_bytes_total', protocol='imap4').inc(
+              len(msg_data[0][1]))
             message_obj = mailparser.parse_from_bytes(msg_data[0][1])
             msg_id = str(message_obj.message_id)
             if msg_id in dupes_filterset:
-              logger.debug(f'Message dupe found and ignored: {msg_id}')
+              logger.debug('Message dupe found and ignored: %s', msg_id)
               yield {
                 'is_dupe': 'True',
               }
             else:
-              logger.debug(f'Returning Message - no dupe, no error: {msg_num}')
+              logger.debug('Returning Message - no dupe, no error: %s', msg_num)
               yield self.convert_imap_msgobject_to_return_dict(msg_data[0][1])
+        progress.done()
+
+  def folder_uidvalidity(self, folder: str):
+    self.conn.select(folder, readonly=True)
+    unused, data = self.conn.response('UIDVALIDITY')  # pylint: disable=unused-variable
+    return int(data[0]) if data and data[0] else None
+
+  def retrieve_new_messages(self, folder: str, after_uid, since_date: datetime.datetime,
+                            dupes_filterset: set):
+    """
+    Yields (uid, result) for the messages of folder with a UID above after_uid, or
+    since since_date if after_uid is None, in the format of retrieve_messages
+    """
+    self.conn.select(folder, readonly=True)
+    if after_uid is None:
+      criteria = 'SINCE ' + since_date.strftime('%d-%b-%Y')
+    else:
+      criteria = f'UID {after_uid + 1}:*'
+    return_status, data = self.conn.uid('SEARCH', criteria)
+    if return_status != 'OK':
+      raise RuntimeError(f'UID SEARCH {criteria} in {folder}: {return_status}')
+    uids = [int(x) for x in (data[0] or b'').split()]
+    # n:* always matches the last message, even if its UID is below n
+    uids = [x for x in uids if after_uid is None or x > after_uid]
+    for uid in uids:
+      with metrics.timed('ar3mr_fetch_seconds', protocol='imap4'):
+        return_status, msg_data = self.conn.uid('FETCH', str(uid), '(RFC822)')
+      if return_status != 'OK' or not msg_data or not isinstance(msg_data[0], tuple):
+        yield uid, {
+          'is_error': 'True',
+          'error_description': f'Msg Error: {return_status}. Pulling UID {uid}/{folder}',
+          'error_scope': 'MESSAGE'
+        }
+        continue
+      metrics.counter('ar3mr_fetch_bytes_total', protocol='imap4').inc(len(msg_data[0][1]))
+      message_obj = mailparser.parse_from_bytes(msg_data[0][1])
+      if str(message_obj.message_id) in dupes_filterset:
+        yield uid, {
+          'is_dupe': 'True',
+        }
+      else:
+        yield uid, self.convert_imap_msgobject_to_return_dict(msg_data[0][1])
+
+  def supports_idle(self):
+    return 'IDLE' in self.conn.capabilities
 
+  def idle(self, folder: str, timeout: float, stop_event=None):
+    """
+    Waits in IMAP IDLE (RFC 2177) on folder until the server reports a new message,
+    timeout seconds have passed or stop_event is set. Returns True on new messages
+    """
+    self.conn.select(folder, readonly=True)
+    tag = self.conn._new_tag()  # pylint: disable=protected-access
+    self.conn.send(tag + b' IDLE\r\n')
+    if not self.conn.readline().startswith(b'+'):
+      raise RuntimeError(f'IDLE refused on {folder}')
+    changed = False
+    deadline = time.monotonic() + timeout
+    sock = self.conn.sock
+    while not changed and time.monotonic() < deadline and \
+        not (stop_event and stop_event.is_set()):
+      # Waits on the socket so that stop_event is checked every second. Lines already
+      # buffered by imaplib are picked up after DONE at the latest
+      pending = isinstance(sock, ssl.SSLSocket) and sock.pending()
+      if not pending and not select.select([sock], [], [], 1.0)[0]:
+        continue
+      line = self.conn.readline()
+      if not line:
+        raise imaplib.IMAP4.abort(f'Connection closed during IDLE on {folder}')
+      changed = IMAPServerConnection.EXISTS_PATTERN.match(line) is not None
+    self.conn.send(b'DONE\r\n')
+    while True:
+      line = self.conn.readline()
+      if not line:
+        raise imaplib.IMAP4.abort(f'Connection closed during IDLE on {folder}')
+      if line.startswith(tag):
+        break
+      changed = changed or IMAPServerConnection.EXISTS_PATTERN.match(line) is not None
+    return changed
+
+  @metrics.timed('ar3mr_parse_seconds', protocol='imap4')
   def convert_imap_msgobject_to_return_dict(self, imap_msgobject):
     mail_object = mailparser.parse_from_bytes(imap_msgobject)
     return {
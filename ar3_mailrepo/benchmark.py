@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Benchmarks of the cache, ingest, index, search and export paths on a synthetic
+corpus, against SQLite in a temporary directory. Results are written as JSON so
+that runs of different versions can be compared:
+
+  python benchmark.py --messages 5000 --output bench.json
+  python benchmark.py --messages 5000 --baseline bench.json
+
+With --profile each stage is profiled into its own directory; profiled timings are
+slower and should not be compared with unprofiled runs.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from whoosh import index
+
+import ar3_mailrepo_config
+import ar3_mailrepo_lib
+import ar3_mailrepo_version_info
+import corpus
+import exporter
+import fake_servers
+import mailbox_archive
+import metrics
+import profiling
+import search_backends
+import searcher
+import storage
+import textextract
+
+logger = logging.getLogger('ar3_mailrepo.benchmark')
+
+BENCHMARK_FORMAT_VERSION = 1
+
+STAGES = ['cache_write', 'db_ingest', 'text_extract', 'index_build', 'search',
+          'database_search', 'export_extract', 'export_mbox']
+
+# Messages per cache folder, as a download of one account would produce
+CACHE_FOLDER_SIZE = 1000
+
+
+class CorpusServerConnection(ar3_mailrepo_lib.IMAPServerConnection):
+
+  """
+  Serves corpus messages through the IMAP download code path, without a server
+  """
+
+  def __init__(self, email_account: str, raw_messages):  # pylint: disable=super-init-not-called
+    self.credentials = {'emaillabel': email_account, 'protocol': 'imap4',
+                        'imap_user': email_account, 'imap_host': 'corpus'}
+    self.conn = None
+    self.raw_messages = raw_messages
+
+  def retrieve_messages(self, since_date: datetime.datetime, dupes_filterset: set):
+    for raw in self.raw_messages:
+      yield self.convert_imap_msgobject_to_return_dict(raw)
+
+
+def percentiles(values, points=(50, 90, 99)):
+  ordered = sorted(values)
+  if not ordered:
+    return {}
+  result = {f'p{x}': ordered[min(len(ordered) - 1, int(len(ordered) * x / 100))]
+            for x in points}
+  result['max'] = ordered[-1]
+  result['mean'] = sum(ordered) / len(ordered)
+  return result
+
+
+def _rates(count: int, seconds: float, total_bytes=None):
+  result = {'count': count, 'seconds': round(seconds, 4),
+            'per_second': round(count / max(seconds, 1e-9), 2)}
+  if total_bytes is not None:
+    result['bytes'] = total_bytes
+    result['mb_per_second'] = round(total_bytes / (1024 * 1024) / max(seconds, 1e-9), 3)
+  return result
+
+
+class BenchmarkRun:
+  """
+  One run of the stages over a corpus, in its own working directory
+  """
+
+  def __init__(self, spec: corpus.CorpusSpec, workdir: Path, search_rounds=20,
+               stages=None, download_profiles=None, profile_mode=None, profile_root=None):
+    self.spec = spec
+    self.workdir = workdir
+    self.search_rounds = search_rounds
+    self.stages = stages or STAGES
+    self.download_profiles = download_profiles or []
+    self.profile_mode = profile_mode
+    self.profile_root = profile_root or workdir / 'profiles'
+    self.profile_dirs = {}
+    self.results = {}
+    self.app_config = ar3_mailrepo_config.AppConfig.from_dict({
+      'db_driver': 'sqlite',
+      'db_driver_credentials': {'sqlite_file_path': str(workdir / 'benchmark.sqlite')},
+      'cache_dir': str(workdir / 'cache'),
+      'whoosh_index_root': str(workdir / 'index'),
+      'email_export_root': str(workdir / 'export'),
+      'credentials_root': str(workdir / 'credentials'),
+    })
+    self.db_engine = storage.DBEngine(self.app_config)
+    self.generator = corpus.CorpusGenerator(spec)
+    self.messages_by_account = {}
+    self.corpus_bytes = 0
+
+  def generate(self):
+    start = time.perf_counter()
+    for email_account, raw in self.generator.messages():
+      self.messages_by_account.setdefault(email_account, []).append(raw)
+      self.corpus_bytes += len(raw)
+    self.results['generate'] = _rates(self.spec.messages, time.perf_counter() - start,
+                                      self.corpus_bytes)
+
+  def cache_write(self):
+    start = time.perf_counter()
+    for email_account, raw_messages in self.messages_by_account.items():
+      for folder_ix in range(0, len(raw_messages), CACHE_FOLDER_SIZE):
+        cache_folder = Path(self.app_config.cache_dir() / email_account /
+                            f'download_{folder_ix:06d}')
+        cache_folder.mkdir(parents=True)
+        connection = CorpusServerConnection(
+          email_account, raw_messages[folder_ix:folder_ix + CACHE_FOLDER_SIZE])
+        connection.retrieve_messages_to_cache(cache_folder, corpus.CORPUS_START, set())
+    self.results['cache_write'] = _rates(self.spec.messages, time.perf_counter() - start,
+                                         self.corpus_bytes)
+
+  def download(self, profile_name: str):
+    """
+    Downloads the whole corpus from the fake IMAP and Gmail servers over the link
+    profile, through the same code path as a real download
+    """
+    profile = fake_servers.LINK_PROFILES[profile_name]
+    stored = [fake_servers.StoredMessage(raw) for raw_messages in
+              self.messages_by_account.values() for raw in raw_messages]
+    folders = {'INBOX': stored[0::2], 'Archive': stored[1::2]}
+    for protocol, server_class in (('imap4', fake_servers.FakeIMAPServer),
+                                   ('gmail', fake_servers.FakeGmailServer)):
+      cache_folder = Path(self.workdir / 'download' / profile_name / protocol)
+      cache_folder.mkdir(parents=True)
+      with server_class(folders, profile=profile) as server:
+        start = time.perf_counter()
+        connection = ar3_mailrepo_lib.create_server_connection(
+          server.connection_credentials(f'download@{protocol}.example'))
+        connection.retrieve_messages_to_cache(
+          cache_folder, corpus.CORPUS_START - datetime.timedelta(days=1), set())
+        connection.close()
+        seconds = time.perf_counter() - start
+        result = _rates(len(list(cache_folder.glob('Msg_*.pickle'))), seconds,
+                        self.corpus_bytes)
+        result['wire_bytes'] = server.bytes_sent
+        result['requests'] = server.requests
+      self.results[f'download_{protocol}_{profile_name}'] = result
+
+  def db_ingest(self):
+    self.db_engine.populate_database()
+    dbconn = self.db_engine.conn()
+    writer = self.db_engine.writer()
+    start = time.perf_counter()
+    stored = 0
+    for folder in sorted(self.app_config.cache_dir().glob('*/*')):
+      stored += storage.DataCacheFolder(folder).store_messages_in_database(dbconn,
+                                                                          writer=writer)
+    self.results['db_ingest'] = _rates(stored, time.perf_counter() - start,
+                                       self.corpus_bytes)
+
+  def text_extract(self):
+    options = self.app_config.index_build_options()
+    start = time.perf_counter()
+    count = textextract.fill_text_cache(self.db_engine.conn(),
+                                        workers=options['text_workers'],
+                                        max_chars=options['body_max_chars'])
+    self.results['text_extract'] = _rates(count, time.perf_counter() - start)
+
+  def index_build(self):
+    options = self.app_config.index_build_options()
+    start = time.perf_counter()
+    count = searcher.build_index_from_scratch(self.app_config.search_index_root(),
+                                              self.db_engine.conn(), fill_text=False,
+                                              **options)
+    result = _rates(count, time.perf_counter() - start)
+    result['index_bytes'] = sum(x.stat().st_size for x in
+                                self.app_config.search_index_root().iterdir())
+    self.results['index_build'] = result
+
+  def search_queries(self, with_dates=True):
+    """
+    Query mix with common, rare and fielded terms, the same for every run of a spec
+    """
+    vocabulary = self.generator.vocabulary
+    name = self.generator.contacts[0][0]
+    queries = [(vocabulary[0], None), (vocabulary[5], None),
+               (f'{vocabulary[1]} {vocabulary[2]}', None),
+               (vocabulary[len(vocabulary) // 2], None), (vocabulary[-1], None),
+               (f'subject:{vocabulary[3]}', None), (f'from:{name.split()[0]}', None),
+               (f'{vocabulary[0]} account:{self.spec.account_names()[0]}', None),
+               (vocabulary[4], 'date')]
+    if with_dates:
+      queries.append((f'{vocabulary[0]} date:[2015 to 2016]', 'date'))
+    return queries
+
+  def _time_queries(self, run_query, with_dates=True):
+    latencies_ms = {}
+    totals = {}
+    for query_string, sort_by in self.search_queries(with_dates):
+      latencies = []
+      for _ in range(self.search_rounds):
+        start = time.perf_counter()
+        page = run_query(query_string, sort_by)
+        latencies.append((time.perf_counter() - start) * 1000)
+      latencies_ms[query_string] = percentiles(latencies)
+      totals[query_string] = page.total
+    all_latencies = [y for x in latencies_ms.values() for y in x.values()]
+    return {'queries': len(latencies_ms), 'rounds': self.search_rounds,
+            'overall_ms': percentiles(all_latencies), 'per_query_ms': latencies_ms,
+            'hits': totals}
+
+  def search(self):
+    # Warm searcher, as the search service keeps it
+    with index.open_dir(self.app_config.search_index_root()).searcher() as s:
+      self.results['search'] = self._time_queries(
+        lambda q, sort_by: searcher.SearchQuery(s, q, sort_by=sort_by).page(1, 20))
+
+  def database_search(self):
+    backend = search_backends.DatabaseBackend(self.db_engine.conn())
+    start = time.perf_counter()
+    backend.build(self.db_engine.conn())
+    build_seconds = time.perf_counter() - start
+    result = self._time_queries(
+      lambda q, sort_by: backend.search(q, pagelen=20, sort_by=sort_by), with_dates=False)
+    result['build_seconds'] = round(build_seconds, 4)
+    self.results['database_search'] = result
+
+  def export_extract(self):
+    email_account = self.spec.account_names()[0]
+    start = time.perf_counter()
+    exported, _, failed = exporter.export_account(
+      self.db_engine.conn(), email_account,
+      Path(self.app_config.email_export_root() / email_account),
+      workers=self.app_config.export_workers())
+    result = _rates(exported, time.perf_counter() - start)
+    result['failed'] = failed
+    self.results['export_extract'] = result
+
+  def export_mbox(self):
+    archive_path = Path(self.app_config.email_export_root() / 'all.mbox')
+    start = time.perf_counter()
+    count = mailbox_archive.export_messages(self.db_engine.conn(), 'mbox', archive_path)
+    self.results['export_mbox'] = _rates(count, time.perf_counter() - start,
+                                         archive_path.stat().st_size)
+
+  def _run_stage(self, label: str, stage_method, *args):
+    if not self.profile_mode:
+      stage_method(*args)
+      return
+    session = profiling.ProfileSession(self.profile_root, label=label,
+                                       mode=self.profile_mode)
+    with session:
+      stage_method(*args)
+    self.profile_dirs[label] = str(session.output_dir)
+    # stdout carries the JSON results
+    print(session.summary, file=sys.stderr)
+
+  def run(self):
+    self.generate()
+    for profile_name in self.download_profiles:
+      logger.debug(f'Running download benchmark over the {profile_name} profile')
+      self._run_stage(f'download_{profile_name}', self.download, profile_name)
+    for stage in STAGES:
+      if stage in self.stages:
+        logger.debug(f'Running benchmark stage {stage}')
+        self._run_stage(stage, getattr(self, stage))
+    self.db_engine.close()
+    return {
+      'format_version': BENCHMARK_FORMAT_VERSION,
+      'app_version': ar3_mailrepo_version_info.current_system_version(),
+      'timestamp': datetime.datetime.now().isoformat(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'corpus': self.spec.as_dict(),
+      'link_profiles': {x: fake_servers.LINK_PROFILES[x].as_dict()
+                        for x in self.download_profiles},
+      'results': self.results,
+      'metrics': metrics.REGISTRY.summary_lines(),
+      'profiled': self.profile_mode,
+      'profiles': self.profile_dirs,
+    }
+
+
+def compare(current: dict, baseline: dict):
+  """
+  Returns {stage.metric: current / baseline} of the throughput and latency metrics
+  """
+  ratios = {}
+  for stage, result in current['results'].items():
+    base = baseline['results'].get(stage)
+    if not base:
+      continue
+    for metric in ('per_second', 'mb_per_second'):
+      if base.get(metric):
+        ratios[f'{stage}.{metric}'] = round(result[metric] / base[metric], 3)
+    if 'overall_ms' in result and base.get('overall_ms'):
+      for point in ('p50', 'p90', 'p99'):
+        if base['overall_ms'].get(point):
+          ratios[f'{stage}.{point}_ms'] = round(
+            result['overall_ms'][point] / base['overall_ms'][point], 3)
+  return ratios
+
+
+def run_benchmark(spec: corpus.CorpusSpec, workdir: Path = None, keep_workdir=False,
+                  search_rounds=20, stages=None, download_profiles=None, profile_mode=None,
+                  profile_root=None):
+  if workdir:
+    workdir.mkdir(parents=True, exist_ok=True)
+  tmpdir = Path(tempfile.mkdtemp(prefix='ar3mr_bench_', dir=workdir))
+  try:
+    return BenchmarkRun(spec, tmpdir, search_rounds=search_rounds, stages=stages,
+                        download_profiles=download_profiles, profile_mode=profile_mode,
+                        profile_root=profile_root).run()
+  finally:
+    if keep_workdir:
+      # stdout carries the JSON results
+      print(f'Benchmark data kept in {tmpdir}', file=sys.stderr)
+    else:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='AR3 Mail Repo benchmarks')
+  parser.add_argument('--messages', help='Number of messages in the corpus',
+                      action='store', type=int, default=2000)
+  parser.add_argument('--accounts', help='Number of email accounts',
+                      action='store', type=int, default=2)
+  parser.add_argument('--seed', help='Seed of the corpus generator',
+                      action='store', type=int, default=1)
+  parser.add_argument('--attachment_ratio', help='Share of messages with attachments',
+                      action='store', type=float, default=0.2)
+  parser.add_argument('--max_thread_depth', help='Maximum messages per thread',
+                      action='store', type=int, default=6)
+  parser.add_argument('--search_rounds', help='Repetitions of each search query',
+                      action='store', type=int, default=20)
+  parser.add_argument('--stages', help=f'Comma separated subset of {",".join(STAGES)}. '
+                                       f'Stages need the stages before them',
+                      action='store', type=str)
+  parser.add_argument('--download_profiles',
+                      help=f'Comma separated link profiles of {",".join(fake_servers.LINK_PROFILES)} '
+                           f'to benchmark downloads from the fake IMAP and Gmail servers over',
+                      action='store', type=str)
+  parser.add_argument('--workdir', help='Directory for the temporary benchmark data',
+                      action='store', type=str)
+  parser.add_argument('--keep_workdir', help='Keeps the benchmark data',
+                      action='store_true')
+  parser.add_argument('--profile',
+                      help='Profiles each stage with cProfile (default) or a stack sampler, '
+                           'plus tracemalloc',
+                      action='store', nargs='?', const=profiling.MODE_CPROFILE,
+                      choices=profiling.MODES)
+  parser.add_argument('--profile_dir',
+                      help='Directory for the profiles (default: profiles in the current '
+                           'directory)',
+                      action='store', type=str, default='profiles')
+  parser.add_argument('--output', help='Writes the results to a JSON file',
+                      action='store', type=str)
+  parser.add_argument('--baseline', help='Compares the results with an earlier JSON file',
+                      action='store', type=str)
+  args = parser.parse_args()
+
+  bench_spec = corpus.CorpusSpec(messages=args.messages, accounts=args.accounts,
+                                 seed=args.seed, attachment_ratio=args.attachment_ratio,
+                                 max_thread_depth=args.max_thread_depth)
+  bench_result = run_benchmark(bench_spec,
+                               workdir=Path(args.workdir) if args.workdir else None,
+                               keep_workdir=args.keep_workdir,
+                               search_rounds=args.search_rounds,
+                               stages=args.stages.split(',') if args.stages else None,
+                               download_profiles=args.download_profiles.split(',')
+                               if args.download_profiles else None,
+                               profile_mode=args.profile,
+                               profile_root=Path(args.profile_dir))
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      bench_result['baseline_ratios'] = compare(bench_result, json.load(baseline_file))
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(bench_result, output_file, indent=2)
+  print(json.dumps(bench_result, indent=2))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Deterministic synthetic RFC822 mail corpus for benchmarks and offline servers.
+The same spec always produces the same bytes.
+"""
+
+import datetime
+import email.message
+import email.policy
+import email.utils
+import random
+
+# (charset, content transfer encoding) of text parts
+DEFAULT_ENCODINGS = [('utf-8', '8bit'), ('utf-8', 'quoted-printable'),
+                     ('utf-8', 'base64'), ('iso-8859-1', 'quoted-printable')]
+
+_SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tas', 'vo', 'pel', 'dri', 'sun', 'har', 'qui',
+              'ben', 'zo', 'lit', 'mar', 'cor', 'fen', 'gal', 'nor', 'est']
+# Latin-1 words so that the 8-bit and iso-8859-1 encodings carry non-ASCII text
+_ACCENTED_WORDS = ['café', 'Grüße', 'naïve', 'façade', 'Müller', 'señor', 'über', 'déjà']
+_FIRST_NAMES = ['Anna', 'Ben', 'Clara', 'David', 'Eva', 'Felix', 'Greta', 'Hugo', 'Ida',
+                'Jonas', 'Klara', 'Lukas', 'Mia', 'Noah', 'Olga', 'Paul']
+_LAST_NAMES = ['Adler', 'Becker', 'Conti', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Hahn',
+               'Ito', 'Jensen', 'Kowalski', 'Lopez', 'Moreau', 'Novak', 'Olsen', 'Peters']
+_ATTACHMENT_TYPES = [('pdf', 'application', 'pdf'), ('png', 'image', 'png'),
+                     ('zip', 'application', 'zip'), ('txt', 'text', 'plain')]
+
+CORPUS_START = datetime.datetime(2015, 1, 1, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+class CorpusSpec:
+  """
+  Size and mix of a synthetic corpus
+  """
+
+  def __init__(self, messages=1000, accounts=2, seed=1, attachment_ratio=0.2,
+               attachment_kb=(2, 200), html_ratio=0.5, thread_ratio=0.4,
+               max_thread_depth=6, body_words=(20, 400), vocabulary_size=5000,
+               contacts=200, encodings=None):
+    self.messages = messages
+    self.accounts = accounts
+    self.seed = seed
+    self.attachment_ratio = attachment_ratio
+    self.attachment_kb = tuple(attachment_kb)
+    self.html_ratio = html_ratio
+    self.thread_ratio = thread_ratio
+    self.max_thread_depth = max_thread_depth
+    self.body_words = tuple(body_words)
+    self.vocabulary_size = vocabulary_size
+    self.contacts = contacts
+    self.encodings = [tuple(x) for x in (encodings or DEFAULT_ENCODINGS)]
+
+  def account_names(self):
+    return [f'bench{ix}@corpus.example' for ix in range(self.accounts)]
+
+  def as_dict(self):
+    return dict(self.__dict__)
+
+
+class _Thread:
+
+  def __init__(self, subject: str, root_msg_id: str):
+    self.subject = subject
+    self.msg_ids = [root_msg_id]
+
+
+class CorpusGenerator:
+  """
+  Generates the messages of a CorpusSpec. Words follow a Zipf-like distribution so
+  that there are common and rare terms to search for
+  """
+
+  def __init__(self, spec: CorpusSpec):
+    self.spec = spec
+    self._rng = random.Random(spec.seed)
+    self.vocabulary = self._make_vocabulary()
+    self._word_weights = [1.0 / (rank + 1) for rank in range(len(self.vocabulary))]
+    self.contacts = [self._make_contact(ix) for ix in range(spec.contacts)]
+    self._threads = []
+
+  def _make_vocabulary(self):
+    words = set()
+    while len(words) < self.spec.vocabulary_size:
+      words.add(''.join(self._rng.choice(_SYLLABLES)
+                        for _ in range(self._rng.randint(2, 4))))
+    # Sorted before shuffling, set iteration order is not deterministic
+    vocabulary = sorted(words)
+    self._rng.shuffle(vocabulary)
+    return vocabulary
+
+  def _make_contact(self, ix: int):
+    first = self._rng.choice(_FIRST_NAMES)
+    last = self._rng.choice(_LAST_NAMES)
+    return f'{first} {last}', f'{first.lower()}.{last.lower()}{ix}@mail{ix % 7}.example'
+
+  def words(self, count: int):
+    words = self._rng.choices(self.vocabulary, weights=self._word_weights, k=count)
+    if self._rng.random() < 0.3:
+      words[self._rng.randrange(count)] = self._rng.choice(_ACCENTED_WORDS)
+    return words
+
+  def _body_text(self):
+    words = self.words(self._rng.randint(*self.spec.body_words))
+    paragraphs = [' '.join(words[ix:ix + 60]) for ix in range(0, len(words), 60)]
+    return '\n\n'.join(x.capitalize() + '.' for x in paragraphs) + '\n'
+
+  def _thread_for(self, msg_id: str):
+    open_threads = [x for x in self._threads
+                    if len(x.msg_ids) < self.spec.max_thread_depth]
+    if open_threads and self._rng.random() < self.spec.thread_ratio:
+      return self._rng.choice(open_threads[-50:])
+    thread = _Thread(' '.join(self.words(self._rng.randint(2, 8))).capitalize(), msg_id)
+    self._threads.append(thread)
+    return thread
+
+  def _add_attachment(self, msg: email.message.EmailMessage, ix: int):
+    extension, maintype, subtype = self._rng.choice(_ATTACHMENT_TYPES)
+    size = self._rng.randint(*self.spec.attachment_kb) * 1024
+    filename = f'{self._rng.choice(self.vocabulary)}_{ix}.{extension}'
+    if maintype == 'text':
+      msg.add_attachment(' '.join(self.words(size // 8)), subtype=subtype,
+                         filename=filename)
+    else:
+      msg.add_attachment(self._rng.getrandbits(size * 8).to_bytes(size, 'little'),
+                         maintype=maintype, subtype=subtype, filename=filename)
+
+  def make_message(self, ix: int):
+    """
+    Returns (email_account, raw message bytes with CRLF line endings)
+    """
+    spec = self.spec
+    email_account = spec.account_names()[ix % spec.accounts]
+    msg_id = f'<corpus-{spec.seed}-{ix}@corpus.example>'
+    thread = self._thread_for(msg_id)
+    sender = self._rng.choice(self.contacts)
+    recipients = self._rng.sample(self.contacts, self._rng.randint(1, 3))
+    msg = email.message.EmailMessage()
+    msg['From'] = email.utils.formataddr(sender)
+    msg['To'] = ', '.join(email.utils.formataddr(x) for x in recipients)
+    msg['Subject'] = thread.subject if thread.msg_ids[0] == msg_id \
+      else 'Re: ' + thread.subject
+    msg['Date'] = email.utils.format_datetime(
+      CORPUS_START + datetime.timedelta(minutes=ix * 37 + self._rng.randint(0, 30)))
+    msg['Message-ID'] = msg_id
+    if thread.msg_ids[0] != msg_id:
+      msg['In-Reply-To'] = thread.msg_ids[-1]
+      msg['References'] = ' '.join(thread.msg_ids)
+      thread.msg_ids.append(msg_id)
+    charset, cte = self._rng.choice(spec.encodings)
+    body = self._body_text()
+    msg.set_content(body, charset=charset, cte=cte)
+    if self._rng.random() < spec.html_ratio:
+      html_body = ''.join(f'<p>{x}</p>' for x in body.split('\n\n'))
+      msg.add_alternative(f'<html><body>{html_body}</body></html>', subtype='html',
+                          charset=charset, cte=cte)
+    if self._rng.random() < spec.attachment_ratio:
+      for attachment_ix in range(self._rng.randint(1, 3)):
+        self._add_attachment(msg, attachment_ix)
+    # MIME boundaries are random by default
+    for part_ix, part in enumerate(msg.walk()):
+      if part.is_multipart():
+        part.set_boundary(f'==corpus-{ix}-{part_ix}==')
+    return email_account, msg.as_bytes(policy=email.policy.SMTP)
+
+  def messages(self):
+    for ix in range(self.spec.messages):
+      yield self.make_message(ix)
+
+
+def generate(spec: CorpusSpec):
+  """
+  Yields (email_account, raw message bytes) for every message of the spec
+  """
+  return CorpusGenerator(spec).messages()
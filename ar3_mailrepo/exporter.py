@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Export of stored messages into per-message extract folders
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import mailparser
+
+import storage
+
+logger = logging.getLogger('ar3_mailrepo.exporter')
+
+CHECKPOINT_FILE = 'export_checkpoint.json'
+PARTIAL_SUFFIX = '.partial'
+
+
+def store_message_as_extract(msg: mailparser.MailParser, outpath: Path, msg_uuid=None):
+  msg.write_attachments(Path(outpath / 'attachments'))
+  try:
+    with open(outpath / 'headers.txt', 'w', encoding='utf-8-sig') as f:
+      for hdr, hdr_data in msg.headers.items():
+        f.write(f'{hdr}:{hdr_data}')
+        f.write('\n')
+    with open(outpath / 'message.txt', 'w', encoding='utf-8-sig') as f:
+      for txt in msg.text_plain:
+        f.write(f'{txt}"\n"')
+    with open(outpath / 'message.html', 'w', encoding='utf-8-sig') as f:
+      for txt in msg.text_html:
+        f.write(f'{txt}"\n"')
+    with open(outpath / 'message_as_string.txt', 'w', encoding='utf-8-sig') as f:
+      f.write(msg.message_as_string)
+  except UnicodeError as ue:
+    logger.exception(f'Unicode error in msg {msg_uuid}: {str(ue)}')
+    with open(outpath / 'headers.txt_UNICODE_BINARY', 'wb') as f:
+      for hdr, hdr_data in msg.headers.items():
+        f.write(bytes(hdr_data, encoding='utf-8-sig'))
+    with open(outpath / 'message.txt_UNICODE_BINARY', 'wb') as f:
+      for txt in msg.text_plain:
+        f.write(bytes(txt, encoding='utf-8-sig'))
+    with open(outpath / 'message.html_UNICODE_BINARY', 'wb') as f:
+      for txt in msg.text_html:
+        f.write(bytes(txt, encoding='utf-8-sig'))
+
+
+def extract_raw_message(raw_data: bytes, outpath: Path, msg_uuid=None):
+  """
+  Parses raw_data and writes the extract into outpath. The extract is built in a
+  '.partial' sibling folder and renamed once complete, so an existing outpath is
+  always a finished extract. Runs in the export worker processes.
+  """
+  partial_path = outpath.with_name(outpath.name + PARTIAL_SUFFIX)
+  if partial_path.exists():
+    shutil.rmtree(partial_path)
+  partial_path.mkdir(parents=True)
+  store_message_as_extract(mailparser.parse_from_bytes(raw_data), partial_path, msg_uuid)
+  partial_path.rename(outpath)
+  return msg_uuid
+
+
+class ExportCheckpoint:
+  """
+  Tracks the highest messagedata.id below which every message of an account export
+  has been written, so that an interrupted export resumes from there
+  """
+
+  def __init__(self, export_root: Path, email_account: str):
+    self.filename = Path(export_root / CHECKPOINT_FILE)
+    self.email_account = email_account
+    self.last_id = 0
+    if self.filename.exists():
+      with open(self.filename) as f:
+        data = json.load(f)
+      if data['email_account'] == email_account:
+        self.last_id = data['last_id']
+
+  def save(self, last_id: int):
+    self.last_id = last_id
+    tmp_filename = self.filename.with_suffix('.tmp')
+    with open(tmp_filename, 'w') as f:
+      json.dump({'email_account': self.email_account,
+                 'last_id': last_id,
+                 'updated': datetime.datetime.now().isoformat()}, f, indent=4)
+    tmp_filename.replace(self.filename)
+
+
+def export_account(dbconn, email_account: str, export_root: Path, workers=None,
+                   fetch_batch_size=200, checkpoint_every=500):
+  """
+  Exports all messages of an account into export_root/<uuid>. Messages are streamed
+  in id order and parsed in a process pool; existing extracts are skipped, so
+  re-running after an interruption only exports what is missing.
+  Returns a tuple (exported, skipped, failed)
+  """
+  export_root.mkdir(parents=True, exist_ok=True)
+  checkpoint = ExportCheckpoint(export_root, email_account)
+  finished = {x.name for x in export_root.iterdir()
+              if x.is_dir() and not x.name.endswith(PARTIAL_SUFFIX)}
+  logger.debug(f'Exporting {email_account} into {export_root}: resuming after id '
+               f'{checkpoint.last_id}, {len(finished)} extract(s) already present')
+  workers = workers or os.cpu_count()
+  max_in_flight = workers * 4
+  exported = skipped = failed = 0
+  pending_ids = collections.deque()  # ids in stream order, head is oldest unfinished
+  done_ids = set()
+  in_flight = {}
+
+  def advance_checkpoint():
+    last_id = checkpoint.last_id
+    while pending_ids and pending_ids[0] in done_ids:
+      last_id = pending_ids.popleft()
+      done_ids.discard(last_id)
+    if last_id != checkpoint.last_id:
+      checkpoint.save(last_id)
+
+  def collect(futures):
+    nonlocal exported, failed
+    for future in futures:
+      msg_id, msg_uuid = in_flight.pop(future)
+      try:
+        future.result()
+        exported += 1
+        done_ids.add(msg_id)
+      except Exception:  # pylint: disable=broad-except
+        failed += 1
+        logger.exception(f'Failed to export message {msg_uuid} of {email_account}')
+      if (exported + failed) % checkpoint_every == 0:
+        logger.debug(f'Exported {exported} message(s) of {email_account}, '
+                     f'{skipped} skipped, {failed} failed')
+        advance_checkpoint()
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    for msg_id, msg_uuid, raw_data in storage.stream_raw_messages_for_account(
+        dbconn, email_account, after_id=checkpoint.last_id, batch_size=fetch_batch_size):
+      pending_ids.append(msg_id)
+      if msg_uuid in finished:
+        skipped += 1
+        done_ids.add(msg_id)
+        continue
+      future = pool.submit(extract_raw_message, raw_data, Path(export_root / msg_uuid),
+                           msg_uuid)
+      in_flight[future] = (msg_id, msg_uuid)
+      if len(in_flight) >= max_in_flight:
+        completed, _ = concurrent.futures.wait(
+          in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        collect(completed)
+    collect(concurrent.futures.as_completed(list(in_flight)))
+  advance_checkpoint()
+  logger.debug(f'Finished export of {email_account} into {export_root}: '
+               f'{exported} exported, {skipped} skipped, {failed} failed')
+  return exported, skipped, failed
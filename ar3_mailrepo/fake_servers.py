@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Local stand-ins for IMAP servers and the Gmail API, serving a Maildir or a
+synthetic corpus with injected latency and bandwidth limits. Only the commands
+the download and sync code use are implemented. Messages can be added while a
+server runs, to exercise IMAP IDLE and Gmail history polling.
+"""
+
+import argparse
+import base64
+import datetime
+import email.parser
+import email.utils
+import http.server
+import json
+import logging
+import mailbox
+import re
+import select
+import socketserver
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+import corpus
+
+logger = logging.getLogger('ar3_mailrepo.fake_servers')
+
+
+class LinkProfile:
+  """
+  Round trip latency in seconds and bandwidth in bytes per second (None for
+  unlimited) applied to every response
+  """
+
+  def __init__(self, name: str, latency: float, bandwidth=None):
+    self.name = name
+    self.latency = latency
+    self.bandwidth = bandwidth
+
+  def send(self, wfile, data: bytes, chunk_size=16 * 1024):
+    if self.latency:
+      time.sleep(self.latency)
+    if not self.bandwidth:
+      wfile.write(data)
+      return
+    for ix in range(0, len(data), chunk_size):
+      chunk = data[ix:ix + chunk_size]
+      wfile.write(chunk)
+      time.sleep(len(chunk) / self.bandwidth)
+
+  def as_dict(self):
+    return {'name': self.name, 'latency': self.latency, 'bandwidth': self.bandwidth}
+
+
+LINK_PROFILES = {
+  'local': LinkProfile('local', 0.0),
+  'lan': LinkProfile('lan', 0.001, 100 * 1024 * 1024),
+  'broadband': LinkProfile('broadband', 0.02, 5 * 1024 * 1024),
+  'mobile': LinkProfile('mobile', 0.08, 1024 * 1024),
+}
+
+
+class StoredMessage:
+  """
+  Raw message with the header values the servers filter and report on
+  """
+
+  __slots__ = ('raw', 'date', 'message_id', 'thread_root')
+
+  def __init__(self, raw: bytes):
+    # IMAP literals use CRLF line endings, Maildir files usually do not
+    self.raw = raw if b'\r\n' in raw else raw.replace(b'\n', b'\r\n')
+    headers = email.parser.BytesHeaderParser().parsebytes(self.raw)
+    try:
+      self.date = email.utils.parsedate_to_datetime(headers['Date'])
+    except (TypeError, ValueError):
+      self.date = corpus.CORPUS_START
+    if self.date.tzinfo is None:
+      self.date = self.date.replace(tzinfo=datetime.timezone.utc)
+    self.message_id = (headers['Message-ID'] or '').strip()
+    references = (headers['References'] or '').split()
+    self.thread_root = references[0] if references else self.message_id
+
+
+def folders_from_maildir(path: Path):
+  """
+  Returns {folder name: [StoredMessage]} of a Maildir, the top level is INBOX
+  """
+  folders = {}
+  mdir = mailbox.Maildir(path, factory=None, create=False)
+  folders['INBOX'] = [StoredMessage(mdir.get_bytes(x)) for x in sorted(mdir.keys())]
+  for name in mdir.list_folders():
+    subdir = mdir.get_folder(name)
+    folders[name] = [StoredMessage(subdir.get_bytes(x)) for x in sorted(subdir.keys())]
+  for messages in folders.values():
+    messages.sort(key=lambda x: x.date)
+  return folders
+
+
+def folders_from_corpus(spec: corpus.CorpusSpec, email_account=None, archive_ratio=0.5):
+  """
+  Returns {folder name: [StoredMessage]} of the corpus messages of one account, or of
+  all accounts. Every second message in archive_ratio goes to an Archive folder
+  """
+  folders = {'INBOX': [], 'Archive': []}
+  for ix, (account, raw) in enumerate(corpus.generate(spec)):
+    if email_account and account != email_account:
+      continue
+    folder = 'Archive' if (ix % 100) < archive_ratio * 100 and ix % 2 else 'INBOX'
+    folders[folder].append(StoredMessage(raw))
+  return folders
+
+
+class _BackgroundServer:
+  """
+  Runs a socketserver in a daemon thread, usable as a context manager
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def _init_counters(self):
+    self._counter_lock = threading.Lock()
+    self.bytes_sent = 0
+    self.requests = 0
+    self._thread = None
+
+  def count(self, sent_bytes: int):
+    with self._counter_lock:
+      self.bytes_sent += sent_bytes
+      self.requests += 1
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def start(self):
+    self._thread = threading.Thread(target=self.serve_forever,
+                                    name=f'ar3mr-{type(self).__name__}', daemon=True)
+    self._thread.start()
+    logger.debug(f'{type(self).__name__} listening on {self.server_address}')
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.stop()
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+  """
+  One IMAP4rev1 session
+  """
+
+  COMMAND_PATTERN = re.compile(r'(?P<tag>\S+) (?P<command>[A-Za-z]+)(?: (?P<args>.*))?')
+  SINCE_PATTERN = re.compile(r'SINCE (?P<date>\d{1,2}-[A-Za-z]{3}-\d{4})', re.IGNORECASE)
+
+  def setup(self):
+    super(_IMAPHandler, self).setup()
+    self.selected = None
+
+  def _send(self, data: bytes):
+    self.server.profile.send(self.wfile, data)
+    self.server.count(len(data))
+
+  def handle(self):
+    self._send(b'* OK [CAPABILITY IMAP4rev1 IDLE] ar3mr fake IMAP server ready\r\n')
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      match = self.COMMAND_PATTERN.match(line.decode('utf-8', 'replace').rstrip('\r\n'))
+      if not match:
+        self._send(b'* BAD Invalid command\r\n')
+        continue
+      tag = match.group('tag').encode('ascii')
+      command = match.group('command').upper()
+      args = match.group('args') or ''
+      handler = getattr(self, f'cmd_{command.lower()}', None)
+      if handler is None:
+        self._send(tag + f' BAD {command} not supported\r\n'.encode('ascii'))
+        continue
+      if not handler(tag, args):
+        return
+
+  def cmd_capability(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    self._send(b'* CAPABILITY IMAP4rev1 IDLE AUTH=PLAIN\r\n' + tag + b' OK CAPABILITY completed\r\n')
+    return True
+
+  def cmd_login(self, tag: bytes, args: str):
+    user, _, password = args.partition(' ')
+    if self.server.credentials and self.server.credentials != (user.strip('"'),
+                                                               password.strip('"')):
+      self._send(tag + b' NO [AUTHENTICATIONFAILED] Invalid credentials\r\n')
+    else:
+      self._send(tag + b' OK LOGIN completed\r\n')
+    return True
+
+  def cmd_list(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    response = b''.join(f'* LIST (\\HasNoChildren) "/" "{x}"\r\n'.encode('utf-8')
+                        for x in self.server.folders)
+    self._send(response + tag + b' OK LIST completed\r\n')
+    return True
+
+  def cmd_select(self, tag: bytes, args: str):
+    folder = args.strip().strip('"')
+    if folder not in self.server.folders:
+      self.selected = None
+      self._send(tag + b' NO Mailbox does not exist\r\n')
+      return True
+    self.selected = self.server.folders[folder]
+    self._send(f'* {len(self.selected)} EXISTS\r\n* 0 RECENT\r\n'
+               f'* FLAGS (\\Seen)\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n'.encode('ascii')
+               + tag + b' OK [READ-WRITE] SELECT completed\r\n')
+    return True
+
+  cmd_examine = cmd_select
+
+  # Messages are never expunged, so the UID of a message is its sequence number
+
+  def cmd_search(self, tag: bytes, args: str, by_uid=False):
+    if self.selected is None:
+      self._send(tag + b' BAD No mailbox selected\r\n')
+      return True
+    since = self.SINCE_PATTERN.search(args)
+    since_date = datetime.datetime.strptime(since.group('date'), '%d-%b-%Y').date() \
+      if since else None
+    uid_range = re.search(r'UID (\S+)', args, re.IGNORECASE)
+    in_range = set(self._sequence_set(uid_range.group(1))) if uid_range else None
+    numbers = [str(ix + 1) for ix, msg in enumerate(self.selected)
+               if (since_date is None or msg.date.date() >= since_date) and
+               (in_range is None or ix + 1 in in_range)]
+    self._send(('* SEARCH ' + ' '.join(numbers)).rstrip().encode('ascii') + b'\r\n'
+               + tag + (b' OK UID SEARCH completed\r\n' if by_uid
+                        else b' OK SEARCH completed\r\n'))
+    return True
+
+  def _sequence_set(self, sequence: str):
+    numbers = []
+    for item in sequence.split(','):
+      first, _, last = item.partition(':')
+      last = last or first
+      last = len(self.selected) if last == '*' else int(last)
+      first = len(self.selected) if first == '*' else int(first)
+      numbers.extend(range(min(first, last), max(first, last) + 1))
+    return numbers
+
+  def cmd_fetch(self, tag: bytes, args: str, by_uid=False):
+    if self.selected is None:
+      self._send(tag + b' BAD No mailbox selected\r\n')
+      return True
+    sequence, _, items = args.partition(' ')
+    if 'RFC822' not in items.upper() and 'BODY[]' not in items.upper():
+      self._send(tag + b' BAD Only RFC822 and BODY[] are supported\r\n')
+      return True
+    try:
+      numbers = self._sequence_set(sequence)
+    except ValueError:
+      self._send(tag + b' BAD Invalid sequence set\r\n')
+      return True
+    if self.server.take_failure(numbers):
+      self._send(tag + b' NO Fetch failed\r\n')
+      return True
+    response = []
+    for number in numbers:
+      if 1 <= number <= len(self.selected):
+        raw = self.selected[number - 1].raw
+        uid_item = f'UID {number} ' if by_uid else ''
+        response.append(
+          f'* {number} FETCH ({uid_item}RFC822 {{{len(raw)}}}\r\n'.encode('ascii'))
+        response.append(raw)
+        response.append(b')\r\n')
+    response.append(tag + b' OK FETCH completed\r\n')
+    self._send(b''.join(response))
+    return True
+
+  def cmd_uid(self, tag: bytes, args: str):
+    command, _, command_args = args.partition(' ')
+    if command.upper() == 'SEARCH':
+      return self.cmd_search(tag, command_args, by_uid=True)
+    if command.upper() == 'FETCH':
+      return self.cmd_fetch(tag, command_args, by_uid=True)
+    self._send(tag + f' BAD UID {command} not supported\r\n'.encode('ascii'))
+    return True
+
+  def cmd_idle(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    if self.selected is None:
+      self._send(tag + b' BAD No mailbox selected\r\n')
+      return True
+    self._send(b'+ idling\r\n')
+    reported = len(self.selected)
+    while True:
+      readable, _, _ = select.select([self.connection], [], [], 0.1)
+      if readable:
+        line = self.rfile.readline()
+        if not line:
+          return False
+        if line.strip().upper() == b'DONE':
+          self._send(tag + b' OK IDLE terminated\r\n')
+          return True
+      if len(self.selected) != reported:
+        reported = len(self.selected)
+        self._send(f'* {reported} EXISTS\r\n'.encode('ascii'))
+
+  def cmd_noop(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    self._send(tag + b' OK NOOP completed\r\n')
+    return True
+
+  def cmd_close(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    self.selected = None
+    self._send(tag + b' OK CLOSE completed\r\n')
+    return True
+
+  def cmd_logout(self, tag: bytes, args: str):  # pylint: disable=unused-argument
+    self._send(b'* BYE ar3mr fake IMAP server logging out\r\n' + tag + b' OK LOGOUT completed\r\n')
+    return False
+
+
+class FakeIMAPServer(_BackgroundServer, socketserver.ThreadingTCPServer):
+  """
+  Plaintext IMAP4rev1 server over {folder name: [StoredMessage]}. Accepts any
+  login unless user and password are given
+  """
+
+  def __init__(self, folders: dict, host='127.0.0.1', port=0, profile: LinkProfile = None,
+               user=None, password=None):
+    self.folders = folders
+    self.profile = profile or LINK_PROFILES['local']
+    self.credentials = (user, password) if user else None
+    self.failing_uids = set()
+    self._init_counters()
+    socketserver.ThreadingTCPServer.__init__(self, (host, port), _IMAPHandler)
+
+  def add_message(self, msg: StoredMessage, folder='INBOX'):
+    """
+    Delivers a message, reported to sessions idling on the folder
+    """
+    self.folders.setdefault(folder, []).append(msg)
+
+  def fail_fetch(self, uid: int):
+    """
+    The next FETCH of this UID answers NO
+    """
+    with self._counter_lock:
+      self.failing_uids.add(uid)
+
+  def take_failure(self, uids):
+    with self._counter_lock:
+      failing = self.failing_uids.intersection(uids)
+      self.failing_uids.difference_update(failing)
+    return bool(failing)
+
+  def connection_credentials(self, emaillabel: str):
+    """
+    Credentials for ar3_mailrepo_lib.create_server_connection
+    """
+    user, password = self.credentials or (emaillabel, 'secret')
+    return {'protocol': 'imap4', 'emaillabel': emaillabel,
+            'imap_host': self.server_address[0], 'imap_port': self.port,
+            'imap_user': user, 'imap_password': password,
+            'imap_starttls': False, 'imap_plaintext': True}
+
+
+class _GmailHandler(http.server.BaseHTTPRequestHandler):
+  """
+  The users.labels.list, users.messages.list and users.messages.get calls of the
+  Gmail REST API
+  """
+
+  protocol_version = 'HTTP/1.1'
+  ROUTES = [
+    (re.compile(r'/gmail/v1/users/(?P<user>[^/]+)/profile$'), 'get_profile'),
+    (re.compile(r'/gmail/v1/users/(?P<user>[^/]+)/history$'), 'history_list'),
+    (re.compile(r'/gmail/v1/users/(?P<user>[^/]+)/labels$'), 'labels_list'),
+    (re.compile(r'/gmail/v1/users/(?P<user>[^/]+)/messages$'), 'messages_list'),
+    (re.compile(r'/gmail/v1/users/(?P<user>[^/]+)/messages/(?P<id>[^/]+)$'), 'messages_get'),
+  ]
+  AFTER_PATTERN = re.compile(r'after:(?P<date>\d{4}[-/]\d{2}[-/]\d{2})')
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logger.debug(f'{self.address_string()} {format % args}')
+
+  def _send_json(self, status: int, obj):
+    body = json.dumps(obj).encode('utf-8')
+    header = (f'HTTP/1.1 {status} {self.responses[status][0]}\r\n'
+              f'Content-Type: application/json; charset=UTF-8\r\n'
+              f'Content-Length: {len(body)}\r\n\r\n').encode('ascii')
+    self.server.profile.send(self.wfile, header + body)
+    self.server.count(len(header) + len(body))
+
+  def _error(self, status: int, message: str):
+    self._send_json(status, {'error': {'code': status, 'message': message,
+                                       'status': self.responses[status][0]}})
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    url = urllib.parse.urlsplit(self.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    for pattern, name in self.ROUTES:
+      match = pattern.match(url.path)
+      if match:
+        if self.server.take_failure(name):
+          self._error(503, 'The service is currently unavailable.')
+          return
+        getattr(self, name)(match, params)
+        return
+    self._error(404, f'Unknown path {url.path}')
+
+  def get_profile(self, match, params):  # pylint: disable=unused-argument
+    self._send_json(200, {'emailAddress': match.group('user'),
+                          'messagesTotal': len(self.server.messages),
+                          'historyId': str(self.server.history_id)})
+
+  def history_list(self, match, params):  # pylint: disable=unused-argument
+    start = int(params.get('startHistoryId', 0))
+    if start < self.server.oldest_history_id:
+      self._error(404, 'Requested entity was not found.')
+      return
+    added = [x for x in reversed(self.server.message_ids)
+             if int(self.server.history_ids[x]) > start]
+    offset = int(params.get('pageToken', 0))
+    limit = min(int(params.get('maxResults', 100)), 500)
+    result = {'historyId': str(self.server.history_id)}
+    page = added[offset:offset + limit]
+    if page:
+      result['history'] = [{'id': self.server.history_ids[x], 'messagesAdded': [
+        {'message': {'id': x, 'threadId': self.server.thread_ids[x],
+                     'labelIds': [self.server.label_of[x]]}}]} for x in page]
+    if offset + limit < len(added):
+      result['nextPageToken'] = str(offset + limit)
+    self._send_json(200, result)
+
+  def labels_list(self, match, params):  # pylint: disable=unused-argument
+    self._send_json(200, {'labels': [{'id': x, 'name': x, 'type': 'system'}
+                                     for x in self.server.labels]})
+
+  def messages_list(self, match, params):  # pylint: disable=unused-argument
+    after = self.AFTER_PATTERN.search(params.get('q', ''))
+    after_date = datetime.date.fromisoformat(after.group('date').replace('/', '-')) \
+      if after else None
+    ids = [x for x in self.server.message_ids
+           if after_date is None or self.server.messages[x].date.date() >= after_date]
+    offset = int(params.get('pageToken', 0))
+    limit = min(int(params.get('maxResults', 100)), 500)
+    page = ids[offset:offset + limit]
+    result = {'resultSizeEstimate': len(page)}
+    if page:
+      result['messages'] = [{'id': x, 'threadId': self.server.thread_ids[x]} for x in page]
+    if offset + limit < len(ids):
+      result['nextPageToken'] = str(offset + limit)
+    self._send_json(200, result)
+
+  def messages_get(self, match, params):
+    message_id = match.group('id')
+    msg = self.server.messages.get(message_id)
+    if msg is None:
+      self._error(404, 'Requested entity was not found.')
+      return
+    result = {'id': message_id, 'threadId': self.server.thread_ids[message_id],
+              'labelIds': [self.server.label_of[message_id]], 'snippet': '',
+              'sizeEstimate': len(msg.raw), 'historyId': self.server.history_ids[message_id],
+              'internalDate': str(int(msg.date.timestamp() * 1000))}
+    if params.get('format', 'full') == 'raw':
+      result['raw'] = base64.urlsafe_b64encode(msg.raw).decode('ascii')
+    self._send_json(200, result)
+
+
+class FakeGmailServer(_BackgroundServer, http.server.ThreadingHTTPServer):
+  """
+  HTTP server answering the Gmail API calls of GmailServerConnection. Folders become
+  labels, messages are listed newest first as Gmail does. The real API caps
+  maxResults at 500. History ids below oldest_history_id answer 404, as expired
+  history does
+  """
+
+  def __init__(self, folders: dict, host='127.0.0.1', port=0, profile: LinkProfile = None):
+    self.profile = profile or LINK_PROFILES['local']
+    self.labels = list(folders)
+    self.messages = {}
+    self.label_of = {}
+    self.thread_ids = {}
+    self.history_ids = {}
+    self.message_ids = []
+    self.history_id = 0
+    self.oldest_history_id = 0
+    self._thread_roots = {}
+    self.failing_calls = {}
+    self._lock = threading.Lock()
+    stored = [(msg, label) for label, messages in folders.items() for msg in messages]
+    for msg, label in sorted(stored, key=lambda x: x[0].date):
+      self.add_message(msg, label)
+    self._init_counters()
+    http.server.ThreadingHTTPServer.__init__(self, (host, port), _GmailHandler)
+
+  def add_message(self, msg: StoredMessage, label='INBOX'):
+    """
+    Adds a message with the next history id, reported by history.list
+    """
+    with self._lock:
+      self.history_id += 1
+      message_id = f'{self.history_id:016x}'
+      self.messages[message_id] = msg
+      self.label_of[message_id] = label
+      self.thread_ids[message_id] = self._thread_roots.setdefault(
+        msg.thread_root or message_id, message_id)
+      self.history_ids[message_id] = str(self.history_id)
+      # Newest first
+      self.message_ids.insert(0, message_id)
+      if label not in self.labels:
+        self.labels.append(label)
+    return message_id
+
+  def fail_call(self, call: str, times=1):
+    """
+    The next times requests of call, a handler name such as messages_list, answer 503
+    """
+    with self._lock:
+      self.failing_calls[call] = self.failing_calls.get(call, 0) + times
+
+  def take_failure(self, call: str):
+    with self._lock:
+      if not self.failing_calls.get(call):
+        return False
+      self.failing_calls[call] -= 1
+      return True
+
+  def connection_credentials(self, emaillabel: str):
+    """
+    Credentials for ar3_mailrepo_lib.create_server_connection
+    """
+    return {'protocol': 'gmail', 'emaillabel': emaillabel,
+            'gmail_api_endpoint': f'http://{self.server_address[0]}:{self.port}/'}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Local fake IMAP and Gmail servers')
+  parser.add_argument('--protocol', help='imap4 or gmail', action='store', type=str,
+                      default='imap4')
+  parser.add_argument('--port', help='Port to listen on, 0 picks a free port',
+                      action='store', type=int, default=0)
+  parser.add_argument('--maildir', help='Serves this Maildir instead of a synthetic corpus',
+                      action='store', type=str)
+  parser.add_argument('--messages', help='Number of messages in the synthetic corpus',
+                      action='store', type=int, default=1000)
+  parser.add_argument('--seed', help='Seed of the corpus generator',
+                      action='store', type=int, default=1)
+  parser.add_argument('--profile', help=f'One of {",".join(LINK_PROFILES)}',
+                      action='store', type=str, default='local')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG)
+  serve_folders = folders_from_maildir(Path(args.maildir)) if args.maildir else \
+    folders_from_corpus(corpus.CorpusSpec(messages=args.messages, accounts=1, seed=args.seed))
+  server_class = FakeGmailServer if args.protocol == 'gmail' else FakeIMAPServer
+  fake_server = server_class(serve_folders, port=args.port,
+                             profile=LINK_PROFILES[args.profile])
+  print(json.dumps(fake_server.connection_credentials('fake@localhost'), indent=2))
+  try:
+    fake_server.serve_forever()
+  except KeyboardInterrupt:
+    fake_server.server_close()
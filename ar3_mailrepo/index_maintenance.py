@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Segment statistics and merging of the Whoosh search index.
+Incremental updates add a segment per commit; merging keeps query latency flat.
+"""
+
+import logging
+import threading
+import time
+from pathlib import Path
+
+from whoosh import index
+from whoosh.reading import SegmentReader
+
+import search_shards
+
+logger = logging.getLogger('ar3_mailrepo.index_maintenance')
+
+ACTION_MERGE = 'merge'
+ACTION_OPTIMIZE = 'optimize'
+
+
+class IndexStats:
+  """
+  Segment count, deleted documents and size on disk of one index
+  """
+
+  def __init__(self, indexpath: Path, segments: int, doc_count: int,
+               deleted_count: int, size_bytes: int):
+    self.indexpath = indexpath
+    self.segments = segments
+    self.doc_count = doc_count
+    self.deleted_count = deleted_count
+    self.size_bytes = size_bytes
+
+  @property
+  def deleted_ratio(self):
+    total = self.doc_count + self.deleted_count
+    return self.deleted_count / total if total else 0.0
+
+  def as_dict(self):
+    return {'index': str(self.indexpath), 'segments': self.segments,
+            'doc_count': self.doc_count, 'deleted_count': self.deleted_count,
+            'deleted_ratio': round(self.deleted_ratio, 4), 'size_bytes': self.size_bytes}
+
+
+def index_stats(indexpath: Path):
+  ix = index.open_dir(indexpath)
+  try:
+    segments = ix._segments()  # pylint: disable=protected-access
+    # Shards live in subfolders, only the files of this index count
+    size_bytes = sum(x.stat().st_size for x in indexpath.iterdir() if x.is_file())
+    return IndexStats(indexpath, len(segments), sum(x.doc_count() for x in segments),
+                      sum(x.deleted_count() for x in segments), size_bytes)
+  finally:
+    ix.close()
+
+
+def tiered_merge_policy(max_segments: int, max_deleted_ratio: float):
+  """
+  Returns a whoosh merge policy that rewrites segments with more than
+  max_deleted_ratio deleted documents, and merges the smallest segments until at
+  most max_segments remain
+  """
+
+  def merge(writer, segments):
+    def deleted_ratio(seg):
+      return seg.deleted_count() / seg.doc_count_all() if seg.doc_count_all() else 0.0
+
+    to_merge = [x for x in segments if deleted_ratio(x) > max_deleted_ratio]
+    remaining = sorted([x for x in segments if x not in to_merge],
+                       key=lambda x: x.doc_count_all())
+    # The merged segment counts as one of the max_segments
+    while remaining and len(remaining) + (1 if to_merge else 0) > max_segments:
+      to_merge.append(remaining.pop(0))
+    if not to_merge or (len(to_merge) == 1 and not to_merge[0].deleted_count()):
+      return segments
+    for seg in to_merge:
+      reader = SegmentReader(writer.storage, writer.schema, seg)
+      writer.add_reader(reader)
+      reader.close()
+    return remaining
+
+  return merge
+
+
+def maintain_index(indexpath: Path, max_segments=8, max_deleted_ratio=0.2,
+                   optimize=False):
+  """
+  Merges the segments of one index if it is over the thresholds, or into a single
+  segment if optimize is set. Readers such as the search service keep the segments
+  they have open and pick up the merged index on refresh. If another process holds
+  the write lock the index is left as it is.
+  Returns a dict with the action taken and the stats before and after
+  """
+  before = index_stats(indexpath)
+  action = None
+  if optimize:
+    action = ACTION_OPTIMIZE
+  elif before.segments > max_segments or before.deleted_ratio > max_deleted_ratio:
+    action = ACTION_MERGE
+  report = {'action': action, 'before': before.as_dict(), 'after': None}
+  if not action:
+    return report
+  ix = index.open_dir(indexpath)
+  try:
+    try:
+      writer = ix.writer(timeout=0)
+    except index.LockError:
+      logger.debug(f'Index {indexpath} is locked by a writer, maintenance skipped')
+      report['action'] = 'skipped_locked'
+      return report
+    start = time.perf_counter()
+    if action == ACTION_OPTIMIZE:
+      writer.commit(optimize=True)
+    else:
+      writer.commit(mergetype=tiered_merge_policy(max_segments, max_deleted_ratio))
+  finally:
+    ix.close()
+  after = index_stats(indexpath)
+  report['after'] = after.as_dict()
+  logger.debug(f'{action} of {indexpath} took {time.perf_counter() - start:.1f}s: '
+               f'{before.segments} -> {after.segments} segment(s), '
+               f'{before.size_bytes} -> {after.size_bytes} bytes')
+  return report
+
+
+def maintain_shards(index_root: Path, max_segments=8, max_deleted_ratio=0.2,
+                    optimize=False):
+  """
+  Runs maintain_index on every shard of the index root, see search_shards
+  """
+  return [maintain_index(path, max_segments=max_segments,
+                         max_deleted_ratio=max_deleted_ratio, optimize=optimize)
+          for path in search_shards.shard_paths(index_root).values()
+          if index.exists_in(path)]
+
+
+class MaintenanceThread(threading.Thread):
+  """
+  Runs threshold based maintenance of the shards of an index root every
+  interval seconds, until stopped
+  """
+
+  def __init__(self, index_root: Path, interval: float, max_segments=8,
+               max_deleted_ratio=0.2):
+    super(MaintenanceThread, self).__init__(name='ar3mr-index-maintenance', daemon=True)
+    self.index_root = index_root
+    self.interval = interval
+    self.max_segments = max_segments
+    self.max_deleted_ratio = max_deleted_ratio
+    self._stop_event = threading.Event()
+
+  def run(self):
+    while not self._stop_event.wait(self.interval):
+      try:
+        maintain_shards(self.index_root, max_segments=self.max_segments,
+                        max_deleted_ratio=self.max_deleted_ratio)
+      except Exception:  # pylint: disable=broad-except
+        logger.exception(f'Index maintenance of {self.index_root} failed')
+
+  def stop(self):
+    self._stop_event.set()
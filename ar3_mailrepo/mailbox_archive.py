@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Streaming export to and import from mbox and Maildir archives.
+Messages are copied as raw bytes, only the headers needed for messagedata are parsed.
+"""
+
+import datetime
+import hashlib
+import logging
+import mailbox
+import time
+import uuid
+from pathlib import Path
+
+import storage
+import util_mail
+
+logger = logging.getLogger('ar3_mailrepo.mailbox_archive')
+
+# Namespace for the uuids of imported messages. The uuid is derived from account and
+# content, so importing the same archive twice does not create duplicates.
+IMPORT_UUID_NAMESPACE = uuid.UUID('6b1f3c52-8d0e-4f59-9a7e-2f43c1d9a0b4')
+
+
+def _open_archive(archive_format: str, archive_path: Path, create: bool):
+  if archive_format == 'mbox':
+    return mailbox.mbox(str(archive_path), create=create)
+  if archive_format == 'maildir':
+    return mailbox.Maildir(str(archive_path), factory=None, create=create)
+  raise RuntimeError(f'Unknown archive format {archive_format}')
+
+
+def _mbox_from_line(msg_ts: datetime.datetime):
+  if msg_ts:
+    return b'From MAILER-DAEMON ' + msg_ts.strftime('%a %b %d %H:%M:%S %Y').encode()
+  return b'From MAILER-DAEMON ' + time.asctime(time.gmtime()).encode()
+
+
+def export_messages(dbconn, archive_format: str, archive_path: Path, email_account=None,
+                    msg_uuids=None, progress_every=1000):
+  """
+  Writes the raw_data of all selected messages into a new mbox file or Maildir.
+  Returns the number of messages written
+  """
+  if archive_path.exists():
+    raise RuntimeError(f'Archive already exists: {archive_path}')
+  archive_path.parent.mkdir(parents=True, exist_ok=True)
+  box = _open_archive(archive_format, archive_path, create=True)
+  box.lock()
+  count = 0
+  try:
+    for _, msg_uuid, msg_ts, raw_data in storage.stream_raw_messages(
+        dbconn, email_account=email_account, msg_uuids=msg_uuids):
+      if not raw_data:
+        logger.error(f'No raw data stored for message {msg_uuid}, not exported')
+        continue
+      # Written as stored, so that importing the archive again gives the same
+      # msg_uuid. Maildir keeps the bytes, mbox escapes body lines starting with
+      # 'From ' and ends each message with a newline
+      if archive_format == 'mbox':
+        raw_data = _mbox_from_line(msg_ts) + b'\n' + raw_data
+      box.add(raw_data)
+      count += 1
+      if count % progress_every == 0:
+        logger.debug(f'Exported {count} message(s) to {archive_path}')
+  finally:
+    box.flush()
+    box.unlock()
+    box.close()
+  logger.debug(f'Exported {count} message(s) to {archive_format} {archive_path}')
+  return count
+
+
+def raw_message_to_data(raw_data: bytes, email_account: str, source: str,
+                        dnload_ts: datetime.datetime):
+  headers = util_mail.parse_headers(raw_data)
+  msg_uuid = uuid.uuid5(IMPORT_UUID_NAMESPACE,
+                        email_account + hashlib.sha1(raw_data).hexdigest())
+  return {
+    'msg_uuid': str(msg_uuid),
+    'email_account': email_account,
+    'msg_id': util_mail.header_str(headers, 'message-id'),
+    'msg_ts': util_mail.header_date(headers),
+    'msg_subj': util_mail.header_str(headers, 'subject'),
+    'msg_from': util_mail.join_address_tuples(util_mail.address_tuples(headers, 'from')),
+    'msg_to': util_mail.join_address_tuples(util_mail.address_tuples(headers, 'to')),
+    'source': source,
+    'dnload_ts': dnload_ts,
+    'raw_data': raw_data,
+    'gmail_data': None
+  }
+
+
+def import_messages(dbconn, archive_format: str, archive_path: Path, email_account: str,
+                    batch_size=200):
+  """
+  Bulk loads an mbox file or Maildir into messagedata under email_account.
+  Messages already imported earlier are skipped. Returns (imported, skipped)
+  """
+  if not archive_path.exists():
+    raise RuntimeError(f'Archive does not exist: {archive_path}')
+  box = _open_archive(archive_format, archive_path, create=False)
+  import_ts = datetime.datetime.now()
+  imported = skipped = 0
+  store_list = []
+
+  def store_batch():
+    nonlocal imported, skipped
+    with storage.unit_of_work(dbconn) as conn:
+      existing = storage.existing_msg_uuids(conn, [x['msg_uuid'] for x in store_list])
+      new_msgs = {x['msg_uuid']: x for x in store_list if x['msg_uuid'] not in existing}
+      if new_msgs:
+        storage.insert_message_batch(conn, list(new_msgs.values()))
+    imported += len(new_msgs)
+    skipped += len(store_list) - len(new_msgs)
+    store_list.clear()
+    logger.debug(f'Imported {imported} message(s) from {archive_path}, {skipped} skipped')
+
+  try:
+    for key in box.iterkeys():
+      store_list.append(raw_message_to_data(box.get_bytes(key), email_account,
+                                            archive_format, import_ts))
+      if len(store_list) >= batch_size:
+        store_batch()
+    if store_list:
+      store_batch()
+  finally:
+    box.close()
+  return imported, skipped
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Message counts and stored sizes per account, source and month, kept in the mailstats
+table by the ingest so that reports do not scan messagedata
+"""
+
+import collections
+import logging
+
+from sqlalchemy import and_, bindparam, func, select
+
+import storage
+import util_logger
+
+logger = logging.getLogger('ar3_mailrepo.mailstats')
+
+# Month and source of messages without a timestamp or source
+NO_MONTH = ''
+NO_SOURCE = ''
+
+COUNTERS = ('message_count', 'raw_bytes', 'gmail_data_bytes')
+
+# Setting present once the statistics cover all messages: set for new databases
+# and by rebuild. Databases from before mailstats only count new messages
+COMPLETE_SETTING = 'mailstats_complete_id'
+
+
+def month_of(msg_ts):
+  return msg_ts.strftime('%Y-%m') if msg_ts else NO_MONTH
+
+
+def _stats_key(email_account, source, msg_ts):
+  return email_account, source or NO_SOURCE, month_of(msg_ts)
+
+
+def _apply(conn, totals):
+  """
+  Adds {(email_account, source, month): [message_count, raw_bytes,
+  gmail_data_bytes]} to the stored statistics
+  """
+  ms = storage.mailstats
+  # Sorted, so that concurrent writers lock the rows in the same order
+  keys = sorted(totals)
+  existing = set()
+  for email_account in sorted({x[0] for x in keys}):
+    smt = select([ms.c.source, ms.c.month]).where(ms.c.email_account == email_account)
+    existing.update((email_account, x['source'], x['month'])
+                    for x in conn.execute(smt).fetchall())
+  updates = [{'b_email_account': key[0], 'b_source': key[1], 'b_month': key[2],
+              **{f'b_{name}': value for name, value in zip(COUNTERS, totals[key])}}
+             for key in keys if key in existing]
+  if updates:
+    conn.execute(ms.update().where(and_(
+      ms.c.email_account == bindparam('b_email_account'),
+      ms.c.source == bindparam('b_source'),
+      ms.c.month == bindparam('b_month'))).values(
+      **{name: ms.c[name] + bindparam(f'b_{name}') for name in COUNTERS}), updates)
+  inserts = [{'email_account': key[0], 'source': key[1], 'month': key[2],
+              **dict(zip(COUNTERS, totals[key]))}
+             for key in keys if key not in existing]
+  if inserts:
+    conn.execute(ms.insert(None), inserts)
+
+
+def record_inserted_messages(conn, store_list, existing_uuids):
+  """
+  Ingest hook, see storage.insert_message_batch: counts the messages of store_list
+  whose msg_uuid was not in existing_uuids before the insert, in the same transaction
+  """
+  totals = collections.defaultdict(lambda: [0, 0, 0])
+  counted = set(existing_uuids)
+  for msg in store_list:
+    if msg['msg_uuid'] in counted:
+      continue
+    counted.add(msg['msg_uuid'])
+    item = totals[_stats_key(msg['email_account'], msg['source'], msg['msg_ts'])]
+    item[0] += 1
+    item[1] += len(msg['raw_data'] or b'')
+    item[2] += len(msg['gmail_data'] or b'')
+  if totals:
+    _apply(conn, totals)
+
+
+def _byte_length(dialect_name, column):
+  # LEN on SQL Server ignores trailing blanks and is meant for text
+  if dialect_name == 'mssql':
+    return func.coalesce(func.datalength(column), 0)
+  return func.coalesce(func.length(column), 0)
+
+
+def mark_complete(conn, last_id=0):
+  """
+  Records that the statistics cover all messages up to messagedata id last_id, and
+  the ingest keeps them up to date from there
+  """
+  storage.save_setting(conn, COMPLETE_SETTING, last_id)
+
+
+def is_complete(dbconn):
+  """
+  False if the database has messages from before the statistics were kept, and
+  rebuild has not run since
+  """
+  return storage.load_setting(dbconn, COMPLETE_SETTING) is not None
+
+
+def rebuild(dbconn, batch_size=5000):
+  """
+  Recomputes the statistics from messagedata, for databases created before the
+  mailstats table or after changes outside the ingest. Only the sizes of the
+  message blobs are read, not their content. Returns the number of messages counted
+  """
+  md = storage.messagedata
+  dialect_name = dbconn.dialect.name
+  totals = collections.defaultdict(lambda: [0, 0, 0])
+  progress = util_logger.ProgressReporter(logger, 'Counting messages')
+  after_id = 0
+  while True:
+    rows = dbconn.execute(select([
+      md.c.id, md.c.email_account, md.c.source, md.c.msg_ts,
+      _byte_length(dialect_name, md.c.raw_data).label('raw_bytes'),
+      _byte_length(dialect_name, md.c.gmail_data).label('gmail_data_bytes')]).where(
+      md.c.id > after_id).order_by(md.c.id).limit(batch_size)).fetchall()
+    if not rows:
+      break
+    for row in rows:
+      item = totals[_stats_key(row['email_account'], row['source'], row['msg_ts'])]
+      item[0] += 1
+      item[1] += row['raw_bytes']
+      item[2] += row['gmail_data_bytes']
+    after_id = rows[-1]['id']
+    progress.update(len(rows))
+  progress.done()
+  with storage.unit_of_work(dbconn) as conn:
+    conn.execute(storage.mailstats.delete())
+    _apply(conn, totals)
+    mark_complete(conn, after_id)
+  logger.debug(f'Rebuilt the statistics of {progress.count} message(s)')
+  return progress.count
+
+
+def monthly_stats(dbconn, email_account=None):
+  """
+  Rows of mailstats as dicts, by account, month and source
+  """
+  ms = storage.mailstats
+  smt = select([ms])
+  if email_account:
+    smt = smt.where(ms.c.email_account == email_account)
+  smt = smt.order_by(ms.c.email_account, ms.c.month, ms.c.source)
+  return [dict(x) for x in dbconn.execute(smt).fetchall()]
+
+
+def account_totals(dbconn, email_account=None):
+  """
+  Message count and sizes per account, as dicts ordered by account
+  """
+  ms = storage.mailstats
+  smt = select([ms.c.email_account] +
+               [func.sum(ms.c[name]).label(name) for name in COUNTERS])
+  if email_account:
+    smt = smt.where(ms.c.email_account == email_account)
+  smt = smt.group_by(ms.c.email_account).order_by(ms.c.email_account)
+  return [dict(x) for x in dbconn.execute(smt).fetchall()]
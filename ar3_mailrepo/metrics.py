@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Process wide counters, gauges and latency histograms of the download, ingest and
+indexing stages, exported in the Prometheus text format to a file or over HTTP
+"""
+
+import contextlib
+import http.server
+import logging
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger('ar3_mailrepo.metrics')
+
+# Upper bounds in seconds, from sub-millisecond parsing to slow batch commits
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Help texts of the metrics recorded by the application
+DESCRIPTIONS = {
+  'ar3mr_fetch_seconds': 'Time to fetch one message from the server',
+  'ar3mr_fetch_bytes_total': 'Raw message bytes fetched from servers',
+  'ar3mr_parse_seconds': 'Time to parse one downloaded message',
+  'ar3mr_cache_write_seconds': 'Time to write one message to the download cache',
+  'ar3mr_db_insert_batch_seconds': 'Time to insert one batch of messages',
+  'ar3mr_db_insert_messages_total': 'Messages sent to the database',
+  'ar3mr_db_insert_bytes_total': 'Raw message bytes sent to the database',
+  'ar3mr_text_extracted_total': 'Messages whose text was extracted for the search index',
+  'ar3mr_index_add_seconds': 'Time to add one document to the Whoosh index',
+  'ar3mr_index_commit_seconds': 'Time to commit a Whoosh index build or update',
+  'ar3mr_index_batch_seconds': 'Time to add one stored batch to the database search index',
+  'ar3mr_pipeline_queue_depth': 'Messages queued for the database writer',
+}
+
+
+def _format_value(value):
+  """
+  Sample value in the exposition format, exact for integers, as prometheus_client
+  """
+  if isinstance(value, int):
+    return str(value)
+  if value == float('inf'):
+    return '+Inf'
+  if value == float('-inf'):
+    return '-Inf'
+  return repr(float(value))
+
+
+def _label_text(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+  """
+  Monotonically increasing total
+  """
+
+  kind = 'counter'
+
+  def __init__(self, name: str, labels: tuple):
+    self.name = name
+    self.labels = labels
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def samples(self):
+    yield self.name, self.labels, self.value
+
+  def summary(self):
+    return _format_value(self.value)
+
+
+class Gauge(Counter):
+  """
+  Value that goes up and down, such as a queue depth
+  """
+
+  kind = 'gauge'
+
+  def set(self, value):
+    self.value = value
+
+
+class Histogram:
+  """
+  Observations counted into cumulative buckets, with their sum
+  """
+
+  kind = 'histogram'
+
+  def __init__(self, name: str, labels: tuple, buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.labels = labels
+    self.buckets = tuple(buckets)
+    self.bucket_counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe(self, value: float):
+    with self._lock:
+      self.count += 1
+      self.sum += value
+      for ix, bound in enumerate(self.buckets):
+        if value <= bound:
+          self.bucket_counts[ix] += 1
+          break
+
+  def quantile(self, q: float):
+    """
+    Upper bound of the bucket holding the q quantile, an estimate
+    """
+    if not self.count:
+      return 0.0
+    rank = q * self.count
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.bucket_counts):
+      cumulative += count
+      if cumulative >= rank:
+        return bound
+    return float('inf')
+
+  def samples(self):
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.bucket_counts):
+      cumulative += count
+      yield self.name + '_bucket', self.labels + (('le', f'{bound:g}'),), cumulative
+    yield self.name + '_bucket', self.labels + (('le', '+Inf'),), self.count
+    yield self.name + '_sum', self.labels, self.sum
+    yield self.name + '_count', self.labels, self.count
+
+  def summary(self):
+    if not self.count:
+      return '0 observations'
+    return (f'{self.count} in {self.sum:.2f}s, mean {self.sum / self.count * 1000:.2f}ms, '
+            f'p50 <= {self.quantile(0.5) * 1000:g}ms, p99 <= {self.quantile(0.99) * 1000:g}ms')
+
+
+class Registry:
+  """
+  Metrics by name and labels, created on first use
+  """
+
+  def __init__(self):
+    self._metrics = {}
+    self._help = dict(DESCRIPTIONS)
+    self._lock = threading.Lock()
+
+  def _get(self, metric_class, name: str, help_text: str, labels: dict):
+    key = (name, tuple(sorted(labels.items())))
+    metric = self._metrics.get(key)
+    if metric is None:
+      with self._lock:
+        metric = self._metrics.get(key)
+        if metric is None:
+          metric = metric_class(name, key[1])
+          self._metrics[key] = metric
+          if help_text:
+            self._help[name] = help_text
+    return metric
+
+  def counter(self, name: str, help_text='', **labels) -> Counter:
+    return self._get(Counter, name, help_text, labels)
+
+  def gauge(self, name: str, help_text='', **labels) -> Gauge:
+    return self._get(Gauge, name, help_text, labels)
+
+  def histogram(self, name: str, help_text='', **labels) -> Histogram:
+    return self._get(Histogram, name, help_text, labels)
+
+  def metrics(self):
+    return [self._metrics[x] for x in sorted(self._metrics)]
+
+  def prometheus_text(self):
+    lines = []
+    described = set()
+    for metric in self.metrics():
+      if metric.name not in described:
+        described.add(metric.name)
+        if metric.name in self._help:
+          lines.append(f'# HELP {metric.name} {self._help[metric.name]}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+      for name, labels, value in metric.samples():
+        lines.append(f'{name}{_label_text(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+  def summary_lines(self):
+    return [f'{x.name}{_label_text(x.labels)}: {x.summary()}' for x in self.metrics()
+            if not isinstance(x, Gauge)]
+
+  def clear(self):
+    with self._lock:
+      self._metrics.clear()
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text='', **labels):
+  return REGISTRY.counter(name, help_text, **labels)
+
+
+def gauge(name: str, help_text='', **labels):
+  return REGISTRY.gauge(name, help_text, **labels)
+
+
+def histogram(name: str, help_text='', **labels):
+  return REGISTRY.histogram(name, help_text, **labels)
+
+
+@contextlib.contextmanager
+def timed(name: str, help_text='', **labels):
+  """
+  Observes the duration of the enclosed block, or of each call when used as a
+  decorator, in the histogram name
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    REGISTRY.histogram(name, help_text, **labels).observe(time.perf_counter() - start)
+
+
+def write_textfile(path: Path):
+  """
+  Writes all metrics for the node_exporter textfile collector. The file is replaced
+  atomically so that the collector never reads a partial file
+  """
+  path = Path(path)
+  tmp_file = path.with_suffix('.tmp')
+  with open(tmp_file, 'w') as f:
+    f.write(REGISTRY.prometheus_text())
+  tmp_file.replace(path)
+
+
+def log_summary():
+  lines = REGISTRY.summary_lines()
+  if lines:
+    logger.info('Metrics summary:\n  ' + '\n  '.join(lines))
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = REGISTRY.prometheus_text().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logger.debug(f'{self.address_string()} {format % args}')
+
+
+def start_http_server(host='127.0.0.1', port=9464):
+  """
+  Serves GET /metrics from a daemon thread for the lifetime of the process
+  """
+  server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name='ar3mr-metrics', daemon=True).start()
+  logger.debug(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+  return server
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Streaming download: messages go from the server connections through a bounded queue
+to a batch database writer and an incremental search index update, without the
+round trip through the pickle cache. The cache can still be written as a copy.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+
+import ar3_mailrepo_lib
+import metrics
+import storage
+import util_lib
+
+logger = logging.getLogger('ar3_mailrepo.pipeline')
+
+STAGE_DOWNLOAD = 'download'
+STAGE_DB_WRITE = 'db_write'
+STAGE_INDEX = 'index'
+
+_STOP = object()
+
+# How often a producer blocked on the full queue checks that the writer is still running
+_PUT_POLL_SECONDS = 1.0
+
+
+class _CacheFolderDone:
+  """
+  Queued after the messages of a cache copy, recorded as ingested once they are stored
+  """
+
+  def __init__(self, folder: Path, message_count: int):
+    self.folder = folder
+    self.message_count = message_count
+
+
+class StageStats:
+  """
+  Items, bytes and busy time of one pipeline stage
+  """
+
+  def __init__(self, name: str):
+    self.name = name
+    self.items = 0
+    self.bytes = 0
+    self.busy_seconds = 0.0
+    self._lock = threading.Lock()
+
+  def add(self, items: int, nbytes: int, seconds: float):
+    with self._lock:
+      self.items += items
+      self.bytes += nbytes
+      self.busy_seconds += seconds
+
+  def as_dict(self, elapsed: float):
+    elapsed = max(elapsed, 1e-9)
+    return {'items': self.items, 'bytes': self.bytes,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'items_per_second': round(self.items / elapsed, 2),
+            'mb_per_second': round(self.bytes / (1024 * 1024) / elapsed, 3),
+            'utilisation': round(self.busy_seconds / elapsed, 3)}
+
+
+class DownloadPipeline:
+  """
+  Downloader threads (one per account) -> bounded queue -> batch writer thread ->
+  index updater thread. A full queue blocks the downloaders, so memory stays bounded
+  when the database is slower than the network
+  """
+
+  def __init__(self, db_engine: storage.DBEngine, credentials_for, backend=None,
+               cache_root: Path = None, workers=1, queue_size=1000,
+               batch_size=storage.INSERT_BATCH_SIZE, batch_bytes=storage.INSERT_BATCH_BYTES,
+               flush_seconds=1.0, index_interval=5.0, progress_interval=10.0):
+    """
+    credentials_for maps an email label to the credentials of
+    ar3_mailrepo_lib.create_server_connection. With a cache_root the downloaded
+    messages are also written to a cache folder per account
+    """
+    self.db_engine = db_engine
+    self.credentials_for = credentials_for
+    self.backend = backend
+    self.cache_root = cache_root
+    self.workers = workers
+    self.batch_size = batch_size
+    self.batch_bytes = batch_bytes
+    self.flush_seconds = flush_seconds
+    self.index_interval = index_interval
+    self.progress_interval = progress_interval
+    self.stats = {x: StageStats(x) for x in (STAGE_DOWNLOAD, STAGE_DB_WRITE, STAGE_INDEX)}
+    self.max_queue_depth = 0
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._writer_done = threading.Event()
+    self._write_error = None
+    self._writer_thread = None
+    self._start = None
+    self._threads = []
+
+  @staticmethod
+  def from_config(app_config, db_engine: storage.DBEngine, backend=None):
+    options = app_config.download_pipeline_options()
+    return DownloadPipeline(
+      db_engine,
+      lambda x: util_lib.load_generic_credentials(app_config.credentials_root(), x),
+      backend=backend if options['update_index'] else None,
+      cache_root=app_config.cache_dir() if options['cache_tee'] else None,
+      workers=app_config.download_workers(), queue_size=options['queue_size'],
+      flush_seconds=options['flush_seconds'],
+      index_interval=options['index_interval_seconds'])
+
+  @property
+  def write_error(self):
+    """
+    The exception that stopped the storing of messages, if any
+    """
+    return self._write_error
+
+  def check_stored(self):
+    """
+    Raises if queued messages are no longer being stored
+    """
+    if self._write_error:
+      raise RuntimeError(f'Storing downloaded messages failed: {self._write_error}')
+    if self._writer_thread is None or not self._writer_thread.is_alive():
+      raise RuntimeError('The pipeline writer is not running')
+
+  def _put(self, item):
+    # A writer that has died never takes the item, so do not block on it forever
+    while True:
+      if self._writer_thread is None or not self._writer_thread.is_alive():
+        raise RuntimeError('The pipeline writer is not running')
+      try:
+        self._queue.put(item, timeout=_PUT_POLL_SECONDS)
+        break
+      except queue.Full:
+        pass
+    depth = self._queue.qsize()
+    self.max_queue_depth = max(self.max_queue_depth, depth)
+    metrics.gauge('ar3mr_pipeline_queue_depth').set(depth)
+
+  def _download_account(self, emaillabel: str):
+    svr_conn = ar3_mailrepo_lib.create_server_connection(self.credentials_for(emaillabel))
+    try:
+      since_dt, dupefilterlist = storage.create_dupefilter_list(self.db_engine.conn(),
+                                                                emaillabel)
+      cache_folder = storage.create_new_timestamped_cache_path(
+        Path(self.cache_root / emaillabel)) if self.cache_root else None
+      report = ar3_mailrepo_lib.new_download_report(since_dt, dupefilterlist)
+      self.store_messages(svr_conn.download_messages(since_dt, dupefilterlist, report,
+                                                     error_folder=cache_folder),
+                          cache_folder=cache_folder)
+      if cache_folder:
+        self.close_cache_folder(cache_folder, report)
+      return report
+    finally:
+      svr_conn.close()
+
+  def store_messages(self, messages, cache_folder: Path = None):
+    """
+    Queues stamped messages, see ServerConnection.download_messages, for storage and
+    copies them to the cache folder if given. Blocks while the queue is full.
+    Returns the number of messages queued
+    """
+    count = 0
+    while True:
+      start = time.perf_counter()
+      msg = next(messages, None)
+      if msg is None:
+        return count
+      if cache_folder:
+        ar3_mailrepo_lib.write_message_to_cache(cache_folder, msg)
+      row = storage.msgdata_from_message(msg)
+      self.stats[STAGE_DOWNLOAD].add(1, len(row['raw_data'] or b''),
+                                     time.perf_counter() - start)
+      self._put(row)
+      count += 1
+
+  def close_cache_folder(self, cache_folder: Path, report: dict):
+    """
+    Completes the cache copy, recorded as ingested once its messages are stored
+    """
+    ar3_mailrepo_lib.write_download_report(cache_folder, report)
+    self._put(_CacheFolderDone(cache_folder, report['ok_count']))
+
+  def store_account_messages(self, emaillabel: str, messages, report: dict):
+    """
+    store_messages for repeated small downloads: a cache folder is only created if
+    there are messages
+    """
+    messages = iter(messages)
+    first = next(messages, None)
+    if first is None:
+      return 0
+    cache_folder = storage.create_new_timestamped_cache_path(
+      Path(self.cache_root / emaillabel)) if self.cache_root else None
+    count = self.store_messages(itertools.chain([first], messages), cache_folder)
+    if cache_folder:
+      self.close_cache_folder(cache_folder, report)
+    return count
+
+  def _insert(self, batch):
+    writer = self.db_engine.writer()
+    if writer:
+      writer.submit(lambda conn: storage.insert_message_batch(conn, batch)).result()
+    else:
+      with storage.unit_of_work(self.db_engine.conn()) as conn:
+        storage.insert_message_batch(conn, batch)
+
+  def _flush(self, batch):
+    if not batch or self._write_error:
+      return
+    start = time.perf_counter()
+    try:
+      self._insert(batch)
+    except Exception as e:  # pylint: disable=broad-except
+      # The downloads carry on into the cache copy, later rows are dropped
+      logger.exception('Storing a batch failed, no further messages are stored')
+      self._write_error = e
+      return
+    self.stats[STAGE_DB_WRITE].add(len(batch), sum(len(x['raw_data'] or b'') for x in batch),
+                                   time.perf_counter() - start)
+
+  def _record_cache_folder(self, done: _CacheFolderDone):
+    if self._write_error:
+      return
+    cache_folder = storage.DataCacheFolder(done.folder)
+    try:
+      with storage.unit_of_work(self.db_engine.conn()) as conn:
+        cache_folder.record_ingested(conn, done.message_count)
+    except Exception as e:  # pylint: disable=broad-except
+      # As in _flush, the queue is still drained so that producers do not block
+      logger.exception(f'Recording {done.folder} as ingested failed, no further '
+                       f'messages are stored')
+      self._write_error = e
+
+  def _write_loop(self):
+    batch = []
+    batch_bytes = 0
+    deadline = None
+    try:
+      while True:
+        try:
+          item = self._queue.get(
+            timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+        except queue.Empty:
+          item = None
+        if isinstance(item, dict):
+          if not batch:
+            # A partial batch is stored after flush_seconds, so that mail arriving
+            # slowly becomes searchable without waiting for a full batch
+            deadline = time.monotonic() + self.flush_seconds
+          batch.append(item)
+          batch_bytes += len(item['raw_data'] or b'')
+          if len(batch) < self.batch_size and batch_bytes < self.batch_bytes:
+            continue
+        self._flush(batch)
+        batch = []
+        batch_bytes = 0
+        if isinstance(item, _CacheFolderDone):
+          self._record_cache_folder(item)
+        if item is _STOP:
+          return
+    except Exception as e:  # pylint: disable=broad-except
+      logger.exception('The pipeline writer failed')
+      self._write_error = e
+    finally:
+      self._writer_done.set()
+
+  def _index_loop(self):
+    indexed = 0
+    while True:
+      done = self._writer_done.wait(self.index_interval)
+      written = self.stats[STAGE_DB_WRITE].items
+      if written > indexed:
+        start = time.perf_counter()
+        try:
+          added = self.backend.update(self.db_engine.conn())
+          self.stats[STAGE_INDEX].add(added or 0, 0, time.perf_counter() - start)
+          indexed = written
+        except Exception:  # pylint: disable=broad-except
+          # Tried again at the next interval
+          logger.exception('Incremental search index update failed')
+      if done:
+        return
+
+  def progress(self):
+    elapsed = time.perf_counter() - self._start
+    return {'seconds': round(elapsed, 3),
+            'queue': {'depth': self._queue.qsize(), 'max_depth': self.max_queue_depth,
+                      'size': self._queue.maxsize},
+            'stages': {name: x.as_dict(elapsed) for name, x in self.stats.items()}}
+
+  def _log_progress(self):
+    current = self.progress()
+    stages = ', '.join(f"{name} {x['items']} ({x['items_per_second']}/s)"
+                       for name, x in current['stages'].items())
+    logger.info(f"Pipeline after {current['seconds']:.0f}s: {stages}, "
+                f"queue {current['queue']['depth']}/{current['queue']['size']}")
+
+  def start(self):
+    """
+    Starts the writer and index threads, see store_messages
+    """
+    self._start = time.perf_counter()
+    self._writer_thread = threading.Thread(target=self._write_loop,
+                                           name='ar3mr-pipeline-writer', daemon=True)
+    self._threads = [self._writer_thread]
+    if self.backend:
+      self._threads.append(threading.Thread(target=self._index_loop,
+                                            name='ar3mr-pipeline-indexer', daemon=True))
+    for thread in self._threads:
+      thread.start()
+
+  def stop(self):
+    """
+    Stores and indexes what is queued, then stops the threads
+    """
+    try:
+      self._put(_STOP)
+    except RuntimeError:
+      # The writer has died, the indexer stops once it notices
+      logger.error('The pipeline writer stopped before the end of the queue')
+    for thread in self._threads:
+      thread.join()
+    if self._write_error:
+      raise RuntimeError(f'Storing downloaded messages failed: {self._write_error}')
+
+  def run(self, emaillabels):
+    """
+    Downloads and stores the accounts. Returns the download report per account and
+    the throughput of each stage
+    """
+    self.start()
+    accounts = {}
+    try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+        futures = {pool.submit(self._download_account, x): x for x in emaillabels}
+        pending = set(futures)
+        while pending:
+          finished, pending = concurrent.futures.wait(pending,
+                                                      timeout=self.progress_interval)
+          for future in finished:
+            try:
+              accounts[futures[future]] = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+              logger.exception(f'Download failed for email {futures[future]}')
+              accounts[futures[future]] = {'error': str(e)}
+          if pending:
+            self._log_progress()
+    finally:
+      self.stop()
+    report = self.progress()
+    report['accounts'] = accounts
+    return report
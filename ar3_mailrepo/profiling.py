@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Profiling of commands and benchmark stages: cProfile or a stack sampler for CPU
+time, tracemalloc for memory, written to a timestamped directory per run
+"""
+
+import collections
+import cProfile
+import datetime
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+logger = logging.getLogger('ar3_mailrepo.profiling')
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+# Allocations of the profiler itself and of imports are not of interest
+_TRACEMALLOC_FILTERS = (
+  tracemalloc.Filter(False, tracemalloc.__file__),
+  tracemalloc.Filter(False, cProfile.__file__),
+  tracemalloc.Filter(False, pstats.__file__),
+  tracemalloc.Filter(False, __file__),
+  tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+  tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+  tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def _frame_name(code):
+  return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+
+
+class StackSampler:
+  """
+  Records the stacks of all other threads every interval seconds. Cheaper than
+  cProfile on call heavy code and covers threads started before the session
+  """
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.samples = 0
+    self.stacks = collections.Counter()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _sample(self):
+    own_ident = threading.get_ident()
+    for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+      if ident == own_ident:
+        continue
+      stack = []
+      while frame is not None:
+        stack.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+      self.stacks[tuple(reversed(stack))] += 1
+    self.samples += 1
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      self._sample()
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name='ar3mr-sampler', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+
+  def hot_functions(self, limit: int):
+    """
+    [(function, self samples, total samples)] by self samples, that is the samples
+    in which the function was running rather than waiting on a callee
+    """
+    own = collections.Counter()
+    total = collections.Counter()
+    for stack, count in self.stacks.items():
+      own[stack[-1]] += count
+      for function in set(stack):
+        total[function] += count
+    return [(x, count, total[x]) for x, count in own.most_common(limit)]
+
+  def write_collapsed(self, path: Path):
+    """
+    One line per stack in the collapsed format of flamegraph.pl and speedscope
+    """
+    with open(path, 'w') as f:
+      for stack, count in self.stacks.most_common():
+        f.write(f"{';'.join(stack)} {count}\n")
+
+
+class ProfileSession:
+  """
+  Profiles the code run between start and stop, or inside a with block. With
+  cProfile, threads started during the session get a profiler of their own and are
+  merged into one set of statistics; worker processes are not profiled
+  """
+
+  def __init__(self, output_root: Path, label='run', mode=MODE_CPROFILE, memory=True,
+               top=25, sample_interval=0.005, tracemalloc_frames=1):
+    if mode not in MODES:
+      raise ValueError(f'Unknown profiling mode {mode}, expected one of {MODES}')
+    self.output_dir = Path(output_root) / \
+                      f"{label}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+    self.label = label
+    self.mode = mode
+    self.memory = memory
+    self.top = top
+    self.sample_interval = sample_interval
+    self.tracemalloc_frames = tracemalloc_frames
+    self.seconds = None
+    self.memory_peak = None
+    self.summary = None
+    self._profiler = None
+    self._thread_profilers = []
+    self._sampler = None
+    self._lock = threading.Lock()
+    self._start = None
+
+  def _profile_new_thread(self, frame, event, arg):  # pylint: disable=unused-argument
+    # Called on the first event of each new thread, the thread profiler then
+    # replaces this hook for the rest of the thread
+    profiler = cProfile.Profile()
+    with self._lock:
+      self._thread_profilers.append(profiler)
+    profiler.enable()
+
+  def start(self):
+    self.output_dir.mkdir(parents=True, exist_ok=True)
+    if self.memory:
+      tracemalloc.start(self.tracemalloc_frames)
+    if self.mode == MODE_CPROFILE:
+      threading.setprofile(self._profile_new_thread)
+      self._profiler = cProfile.Profile()
+      self._profiler.enable()
+    else:
+      self._sampler = StackSampler(self.sample_interval)
+      self._sampler.start()
+    self._start = time.perf_counter()
+    return self
+
+  def _cprofile_stats(self):
+    stats = pstats.Stats(self._profiler)
+    with self._lock:
+      thread_profilers = list(self._thread_profilers)
+    for profiler in thread_profilers:
+      try:
+        stats.add(profiler)
+      except TypeError:
+        # A thread that never made a call has no statistics
+        pass
+    return stats
+
+  def _write_cprofile(self):
+    stats = self._cprofile_stats()
+    stats.dump_stats(self.output_dir / 'cprofile.pstats')
+    with open(self.output_dir / 'cprofile.txt', 'w') as f:
+      stats.stream = f
+      stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top * 4)
+      stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top * 4)
+    hot = []
+    for func, (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+      hot.append((tottime, cumtime, ncalls, func))
+    hot.sort(reverse=True)
+    return [f'{tottime:9.3f}s self {cumtime:9.3f}s total {ncalls:>9} calls  '
+            f'{func[2]} ({Path(func[0]).name}:{func[1]})'
+            for tottime, cumtime, ncalls, func in hot[:self.top]]
+
+  def _write_samples(self):
+    self._sampler.write_collapsed(self.output_dir / 'samples.collapsed')
+    samples = max(self._sampler.samples, 1)
+    lines = [f'{count * self.sample_interval:9.3f}s self '
+             f'{total / samples * 100:6.1f}% of samples  {function}'
+             for function, count, total in self._sampler.hot_functions(self.top)]
+    with open(self.output_dir / 'samples.txt', 'w') as f:
+      f.write(f'{self._sampler.samples} samples every {self.sample_interval * 1000:g}ms\n')
+      f.write('\n'.join(lines) + '\n')
+    return lines
+
+  def _write_memory(self):
+    snapshot = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+    _, self.memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    snapshot.dump(str(self.output_dir / 'tracemalloc.snapshot'))
+    top_stats = snapshot.statistics('lineno')
+    with open(self.output_dir / 'tracemalloc.txt', 'w') as f:
+      f.write(f'Peak traced memory: {self.memory_peak / (1024 * 1024):.1f} MB\n')
+      f.write(f'Top {self.top} allocations still held at the end, by line:\n')
+      for stat in top_stats[:self.top]:
+        f.write(f'{stat}\n')
+    return top_stats[:5]
+
+  def stop(self):
+    """
+    Stops profiling, writes the output files and returns the summary text
+    """
+    self.seconds = time.perf_counter() - self._start
+    if self.mode == MODE_CPROFILE:
+      self._profiler.disable()
+      threading.setprofile(None)
+    else:
+      self._sampler.stop()
+    # Before writing the CPU profile, which allocates memory of its own
+    top_memory = self._write_memory() if self.memory else []
+    hot_lines = self._write_cprofile() if self.mode == MODE_CPROFILE else \
+      self._write_samples()
+    summary = io.StringIO()
+    summary.write(f'Profile of {self.label} ({self.mode}), {self.seconds:.2f}s, '
+                  f'written to {self.output_dir}\n')
+    summary.write('Hot functions:\n  ' + '\n  '.join(hot_lines) + '\n')
+    if self.memory:
+      summary.write(f'Peak traced memory {self.memory_peak / (1024 * 1024):.1f} MB, '
+                    f'largest allocations held:\n  ' +
+                    '\n  '.join(str(x) for x in top_memory) + '\n')
+    self.summary = summary.getvalue()
+    with open(self.output_dir / 'summary.txt', 'w') as f:
+      f.write(self.summary)
+    return self.summary
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.stop()
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Search backends: the Whoosh index on disk, or full-text search inside the database
+(an FTS5 table on SQLite, a tsvector table with a GIN index on Postgres)
+"""
+
+import abc
+import logging
+import re
+from pathlib import Path
+
+import sqlalchemy
+from sqlalchemy import text
+
+import ar3_mailrepo_config
+import index_maintenance
+import metrics
+import search_shards
+import searcher
+import storage
+import textextract
+
+logger = logging.getLogger('ar3_mailrepo.search_backends')
+
+BACKEND_WHOOSH = 'whoosh'
+BACKEND_DATABASE = 'database'
+
+# SQLite: FTS5 index over a view of the stored columns, so text is not stored twice
+FTS_TABLE = 'messagefts'
+FTS_SOURCE_VIEW = 'messagefts_source'
+# Postgres: one tsvector per message
+PG_SEARCH_TABLE = 'messagesearch'
+
+# Indexed text columns, named as the fields of the Whoosh schema
+TEXT_COLUMNS = ['msg_subj', 'msg_from', 'msg_to', 'msg_body', 'attachment_names']
+
+_QUERY_TOKEN = re.compile(r'(\w+):("[^"]*"|\S+)|("[^"]*")|(\S+)')
+
+
+class SearchBackend(abc.ABC):
+  """
+  Interface of the search implementations
+  """
+
+  # Whether queries may be answered by the search service, see search_service
+  uses_search_service = False
+
+  @abc.abstractmethod
+  def build(self, dbconn):
+    """
+    Builds the search data for all stored messages. Returns the number indexed
+    """
+
+  @abc.abstractmethod
+  def update(self, dbconn):
+    """
+    Indexes messages stored since the last build or update. Returns the number added
+    """
+
+  @abc.abstractmethod
+  def search(self, query_string: str, page=1, pagelen=20, sort_by=None,
+             highlight=False, body_text_loader=None) -> searcher.SearchPage:
+    """
+    One page of the results of a query in the Whoosh syntax
+    """
+
+  @abc.abstractmethod
+  def search_uuids(self, query_string: str):
+    """
+    The msg_uuids of all messages matching a query
+    """
+
+  @abc.abstractmethod
+  def maintain(self, optimize=False, max_segments=8, max_deleted_ratio=0.2):
+    """
+    Merges index segments when over the thresholds, or fully if optimize is set.
+    Returns a list of reports, one per index
+    """
+
+
+class WhooshBackend(SearchBackend):
+  """
+  The Whoosh index under the index root, optionally sharded, see search_shards
+  """
+
+  uses_search_service = True
+
+  def __init__(self, index_root: Path, build_options: dict,
+               shard_by=search_shards.SHARD_BY_NONE):
+    self.index_root = index_root
+    self.build_options = build_options
+    self.shard_by = shard_by
+
+  def build(self, dbconn):
+    return search_shards.build_index(self.index_root, dbconn, shard_by=self.shard_by,
+                                     **self.build_options)
+
+  def update(self, dbconn):
+    return search_shards.update_index(self.index_root, dbconn, shard_by=self.shard_by,
+                                      **self.build_options)
+
+  def search(self, query_string: str, page=1, pagelen=20, sort_by=None,
+             highlight=False, body_text_loader=None):
+    return search_shards.search(self.index_root, query_string, page=page,
+                                pagelen=pagelen, sort_by=sort_by, highlight=highlight,
+                                body_text_loader=body_text_loader)
+
+  def search_uuids(self, query_string: str):
+    return search_shards.search_uuids(self.index_root, query_string)
+
+  def maintain(self, optimize=False, max_segments=8, max_deleted_ratio=0.2):
+    return index_maintenance.maintain_shards(self.index_root, max_segments=max_segments,
+                                             max_deleted_ratio=max_deleted_ratio,
+                                             optimize=optimize)
+
+
+def _dialect_name(dbconn):
+  name = dbconn.dialect.name
+  if name not in ('sqlite', 'postgresql'):
+    raise RuntimeError(f'The database search backend does not support {name}, '
+                       f'use the whoosh backend')
+  return name
+
+
+def _pg_vector_sql():
+  # Subject ranks above addresses above body above attachment names
+  return ("setweight(to_tsvector('simple', coalesce(md.msg_subj, '')), 'A') || "
+          "setweight(to_tsvector('simple', coalesce(md.msg_from, '') || ' ' || "
+          "coalesce(md.msg_to, '')), 'B') || "
+          "setweight(to_tsvector('simple', coalesce(mt.body_text, '')), 'C') || "
+          "setweight(to_tsvector('simple', coalesce(mt.attachment_names, '')), 'D')")
+
+
+def ensure_schema(conn):
+  if _dialect_name(conn) == 'sqlite':
+    conn.execute(text(
+      f'CREATE VIEW IF NOT EXISTS {FTS_SOURCE_VIEW} AS '
+      f'SELECT md.id AS id, md.msg_subj AS msg_subj, md.msg_from AS msg_from, '
+      f'md.msg_to AS msg_to, mt.body_text AS msg_body, '
+      f'mt.attachment_names AS attachment_names '
+      f'FROM messagedata md LEFT JOIN messagetext mt ON mt.message_id = md.id'))
+    conn.execute(text(
+      f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+      f"{', '.join(TEXT_COLUMNS)}, content='{FTS_SOURCE_VIEW}', content_rowid='id', "
+      f"tokenize='unicode61 remove_diacritics 2')"))
+  else:
+    conn.execute(text(
+      f'CREATE TABLE IF NOT EXISTS {PG_SEARCH_TABLE} ('
+      f'message_id BIGINT PRIMARY KEY, search_vector TSVECTOR NOT NULL)'))
+    conn.execute(text(
+      f'CREATE INDEX IF NOT EXISTS ix_{PG_SEARCH_TABLE}_vector '
+      f'ON {PG_SEARCH_TABLE} USING GIN (search_vector)'))
+
+
+def _index_messages(conn, condition: str, params: dict):
+  """
+  Indexes the messages matching condition on messagedata md that are not in the
+  index yet. Returns the number of messages indexed
+  """
+  if _dialect_name(conn) == 'sqlite':
+    # An external content FTS5 table cannot tell whether a row is indexed, the
+    # docsize shadow table can
+    result = conn.execute(text(
+      f"INSERT INTO {FTS_TABLE}(rowid, {', '.join(TEXT_COLUMNS)}) "
+      f"SELECT md.id, {', '.join('md.' + x for x in TEXT_COLUMNS)} "
+      f"FROM {FTS_SOURCE_VIEW} md WHERE {condition} "
+      f"AND md.id NOT IN (SELECT id FROM {FTS_TABLE}_docsize)"), params)
+  else:
+    result = conn.execute(text(
+      f'INSERT INTO {PG_SEARCH_TABLE}(message_id, search_vector) '
+      f'SELECT md.id, {_pg_vector_sql()} FROM messagedata md '
+      f'LEFT JOIN messagetext mt ON mt.message_id = md.id WHERE {condition} '
+      f'ON CONFLICT (message_id) DO NOTHING'), params)
+  return result.rowcount
+
+
+@metrics.timed('ar3mr_index_batch_seconds')
+def index_inserted_messages(conn, store_list, max_chars: int):
+  """
+  Ingest hook, see storage.insert_message_batch: extracts the text of the messages
+  just inserted and adds them to the database search index, in the same transaction.
+  The index tables are created when the engine is opened, see storage.DBEngine
+  """
+  md = storage.messagedata
+  mt = storage.messagetext
+  raw_by_uuid = {x['msg_uuid']: x['raw_data'] for x in store_list}
+  rows = conn.execute(sqlalchemy.select([md.c.id, md.c.msg_uuid]).select_from(
+    md.outerjoin(mt, mt.c.message_id == md.c.id)).where(sqlalchemy.and_(
+    md.c.msg_uuid.in_(list(raw_by_uuid)), mt.c.message_id.is_(None)))).fetchall()
+  if not rows:
+    return
+  conn.execute(mt.insert(None), textextract.extract_batch(
+    [(x[0], raw_by_uuid[x[1]]) for x in rows], max_chars))
+  ids = [x[0] for x in rows]
+  _index_messages(conn, 'md.id IN (' + ', '.join(str(int(x)) for x in ids) + ')', {})
+
+
+class _ParsedQuery:
+  """
+  A query in the Whoosh syntax, split into account restrictions and the terms
+  passed to the database full-text engine
+  """
+
+  def __init__(self, query_string: str):
+    self.accounts = []
+    self.terms = []  # (column or None, term or phrase without quotes)
+    self.operators = []  # operator before each term: None, 'OR' or 'NOT'
+    aliases = {alias: field for field, names in searcher.FIELD_ALIASES.items()
+               for alias in names}
+    operator = None
+    for match in _QUERY_TOKEN.finditer(query_string):
+      field, value, phrase, word = match.groups()
+      if word in ('AND', 'OR', 'NOT'):
+        operator = None if word == 'AND' else word
+        continue
+      if field:
+        field = aliases.get(field, field)
+        value = value.strip('"')
+        if field == 'email_account':
+          self.accounts.append(value.lower())
+          continue
+        if field not in TEXT_COLUMNS:
+          raise RuntimeError(f'Field {field} is not supported by the database '
+                             f'search backend')
+        self.terms.append((field, value))
+      else:
+        self.terms.append((None, (phrase or word).strip('"')))
+      self.operators.append(operator)
+      operator = None
+
+  def fts5_match(self):
+    parts = []
+    for (column, term), operator in zip(self.terms, self.operators):
+      if operator == 'NOT' and not parts:
+        # FTS5 has no unary NOT, dropping it would search for the excluded term
+        raise RuntimeError('The database search backend needs a term before NOT, '
+                           'such as: invoice NOT spam')
+      if operator and parts:
+        parts.append(operator)
+      quoted = '"' + term.replace('"', '""') + '"'
+      parts.append(f'{column} : {quoted}' if column else quoted)
+    return ' '.join(parts)
+
+  def websearch(self):
+    # Postgres vectors do not keep fields apart, terms match any field
+    parts = []
+    for (_, term), operator in zip(self.terms, self.operators):
+      term = f'"{term}"' if ' ' in term else term
+      if operator == 'NOT':
+        parts.append('-' + term)
+      elif operator == 'OR' and parts:
+        parts.extend(['OR', term])
+      else:
+        parts.append(term)
+    return ' '.join(parts)
+
+
+class DatabaseBackend(SearchBackend):
+  """
+  Full-text search in the database itself. Messages are added at ingest, see
+  storage.insert_message_batch, or by update() for messages stored before
+  """
+
+  STATE_NAME = 'database'
+
+  def __init__(self, dbconn, text_workers=None, body_max_chars=20000):
+    self._dbconn = dbconn
+    self.text_workers = text_workers
+    self.body_max_chars = body_max_chars
+    with storage.unit_of_work(dbconn) as conn:
+      ensure_schema(conn)
+
+  def _last_id(self, conn):
+    st = storage.searchstate
+    row = conn.execute(sqlalchemy.select([st.c.last_id]).where(
+      st.c.backend == self.STATE_NAME)).fetchone()
+    return row[0] if row else 0
+
+  def _save_last_id(self, conn, last_id):
+    st = storage.searchstate
+    conn.execute(st.delete().where(st.c.backend == self.STATE_NAME))
+    conn.execute(st.insert(None), {'backend': self.STATE_NAME, 'last_id': last_id})
+
+  def build(self, dbconn):
+    textextract.fill_text_cache(dbconn, workers=self.text_workers,
+                                max_chars=self.body_max_chars)
+    with storage.unit_of_work(dbconn) as conn:
+      if _dialect_name(conn) == 'sqlite':
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES('delete-all')"))
+      else:
+        conn.execute(text(f'TRUNCATE {PG_SEARCH_TABLE}'))
+      return self._index_above(conn, 0)
+
+  def update(self, dbconn):
+    if textextract.check_max_chars(dbconn, self.body_max_chars):
+      return self.build(dbconn)
+    with storage.unit_of_work(dbconn) as conn:
+      last_id = self._last_id(conn)
+    textextract.fill_text_cache(dbconn, after_id=last_id, workers=self.text_workers,
+                                max_chars=self.body_max_chars)
+    with storage.unit_of_work(dbconn) as conn:
+      return self._index_above(conn, last_id)
+
+  def _index_above(self, conn, last_id):
+    md = storage.messagedata
+    max_id = conn.execute(sqlalchemy.select([sqlalchemy.func.max(md.c.id)])).scalar()
+    if not max_id or max_id <= last_id:
+      logger.debug(f'Database search index is up to date at id {last_id}')
+      return 0
+    count = _index_messages(conn, 'md.id > :last_id AND md.id <= :max_id',
+                            {'last_id': last_id, 'max_id': max_id})
+    self._save_last_id(conn, max_id)
+    logger.debug(f'Database search index covers messages up to id {max_id}, '
+                 f'{count} message(s) added')
+    return count
+
+  def _where(self, parsed: _ParsedQuery, params: dict):
+    conditions = []
+    if parsed.terms and _dialect_name(self._dbconn) == 'sqlite':
+      params['match'] = parsed.fts5_match()
+      conditions.append(f'{FTS_TABLE} MATCH :match')
+    elif parsed.terms:
+      params['match'] = parsed.websearch()
+      conditions.append('ms.search_vector @@ websearch_to_tsquery(\'simple\', :match)')
+    if parsed.accounts:
+      names = []
+      for ix, account in enumerate(parsed.accounts):
+        params[f'account{ix}'] = account
+        names.append(f':account{ix}')
+      conditions.append(f'lower(md.email_account) IN ({", ".join(names)})')
+    return ' AND '.join(conditions)
+
+  def _from(self, parsed: _ParsedQuery):
+    # A query of accounts only lists their messages, as in the Whoosh index
+    if not parsed.terms:
+      return 'messagedata md'
+    if _dialect_name(self._dbconn) == 'sqlite':
+      return f'{FTS_TABLE} JOIN messagedata md ON md.id = {FTS_TABLE}.rowid'
+    return f'{PG_SEARCH_TABLE} ms JOIN messagedata md ON md.id = ms.message_id'
+
+  def _score(self, parsed: _ParsedQuery):
+    if not parsed.terms:
+      return '0'
+    if _dialect_name(self._dbconn) == 'sqlite':
+      # bm25() is lower for better matches
+      return f'-bm25({FTS_TABLE})'
+    return 'ts_rank_cd(ms.search_vector, websearch_to_tsquery(\'simple\', :match))'
+
+  @staticmethod
+  def _order_by(sort_by):
+    field = searcher.sort_field(sort_by)
+    if field == 'msg_ts':
+      return 'md.msg_ts DESC'
+    if field:
+      return f'md.{field}'
+    return 'score DESC, md.id'
+
+  def _highlights(self, parsed: _ParsedQuery, ids):
+    # Computed for the rows of one page only
+    params = {}
+    where = self._where(parsed, params)
+    id_list = ', '.join(str(int(x)) for x in ids)
+    if _dialect_name(self._dbconn) == 'sqlite':
+      columns = ', '.join(
+        f"snippet({FTS_TABLE}, {ix}, '<b class=\"match\">', '</b>', '...', 16)"
+        for ix in range(4))
+      smt = f'SELECT md.id, {columns} FROM {self._from(parsed)} WHERE {where} ' \
+            f'AND md.id IN ({id_list})'
+    else:
+      options = '\'StartSel=<b class="match">, StopSel=</b>, MaxFragments=2\''
+      columns = ', '.join(
+        f"ts_headline('simple', coalesce({x}, ''), websearch_to_tsquery('simple', "
+        f":match), {options})"
+        for x in ['md.msg_subj', 'md.msg_from', 'md.msg_to', 'mt.body_text'])
+      smt = f'SELECT md.id, {columns} FROM {self._from(parsed)} ' \
+            f'LEFT JOIN messagetext mt ON mt.message_id = md.id ' \
+            f'WHERE {where} AND md.id IN ({id_list})'
+    highlights = {}
+    for row in self._dbconn.execute(text(smt), params):
+      highlights[row[0]] = {field: ' '.join(fragment.split()) for field, fragment in
+                            zip(TEXT_COLUMNS, row[1:]) if fragment and '<b' in fragment}
+    return highlights
+
+  def search(self, query_string: str, page=1, pagelen=20, sort_by=None,
+             highlight=False, body_text_loader=None):
+    parsed = _ParsedQuery(query_string)
+    page = max(page, 1)
+    if not parsed.terms and not parsed.accounts:
+      return searcher.SearchPage(query_string, page, pagelen, 0, [])
+    params = {}
+    where = self._where(parsed, params)
+    total = self._dbconn.execute(
+      text(f'SELECT count(*) FROM {self._from(parsed)} WHERE {where}'), params).scalar()
+    params.update({'limit': pagelen, 'offset': (page - 1) * pagelen})
+    # Typed so that SQLite returns msg_ts as a datetime
+    rows = self._dbconn.execute(text(
+      f'SELECT md.id, md.msg_uuid, md.email_account, md.msg_ts, md.msg_subj, '
+      f'{self._score(parsed)} AS score FROM {self._from(parsed)} WHERE {where} '
+      f'ORDER BY {self._order_by(sort_by)} LIMIT :limit OFFSET :offset').columns(
+      msg_ts=sqlalchemy.DateTime), params).fetchall()
+    highlights = self._highlights(parsed, [x[0] for x in rows]) \
+      if highlight and rows and parsed.terms else {}
+    hits = [searcher.SearchHit(x[1], x[2], x[3], x[4], x[5],
+                               highlights.get(x[0]) if highlight else None)
+            for x in rows]
+    return searcher.SearchPage(query_string, page, pagelen, total, hits)
+
+  def search_uuids(self, query_string: str):
+    parsed = _ParsedQuery(query_string)
+    if not parsed.terms and not parsed.accounts:
+      return []
+    params = {}
+    where = self._where(parsed, params)
+    return [x[0] for x in self._dbconn.execute(
+      text(f'SELECT md.msg_uuid, {self._score(parsed)} AS score FROM {self._from(parsed)} '
+           f'WHERE {where} ORDER BY score DESC, md.id'), params)]
+
+
+  def _index_stats(self, conn):
+    # Neither database reports segments or deleted entries of the index portably.
+    # pages are the FTS5 data blocks, or the Postgres pages of table and index
+    if _dialect_name(conn) == 'sqlite':
+      name = FTS_TABLE
+      doc_count = conn.execute(text(f'SELECT count(*) FROM {FTS_TABLE}_docsize')).scalar()
+      pages, size_bytes = conn.execute(text(
+        f'SELECT count(*), coalesce(sum(length(block)), 0) FROM {FTS_TABLE}_data')).first()
+    else:
+      name = PG_SEARCH_TABLE
+      doc_count = conn.execute(text(f'SELECT count(*) FROM {PG_SEARCH_TABLE}')).scalar()
+      pages, size_bytes = conn.execute(text(
+        f"SELECT pg_total_relation_size('{PG_SEARCH_TABLE}') / "
+        f"current_setting('block_size')::integer, "
+        f"pg_total_relation_size('{PG_SEARCH_TABLE}')")).first()
+    return {'index': name, 'segments': None, 'doc_count': doc_count,
+            'deleted_count': None, 'deleted_ratio': None, 'pages': pages,
+            'size_bytes': size_bytes}
+
+  def maintain(self, optimize=False, max_segments=8, max_deleted_ratio=0.2):
+    # The database manages its own index structures, these run its merge commands
+    with storage.unit_of_work(self._dbconn) as conn:
+      before = self._index_stats(conn)
+    if _dialect_name(self._dbconn) == 'sqlite':
+      command = 'optimize' if optimize else 'merge'
+      with storage.unit_of_work(self._dbconn) as conn:
+        if optimize:
+          conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES('optimize')"))
+        else:
+          # Merges b-tree segments incrementally, up to 500 pages of work
+          conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) "
+                            f"VALUES('merge', 500)"))
+    else:
+      command = 'gin_clean_pending_list'
+      with storage.unit_of_work(self._dbconn) as conn:
+        # Moves entries from the GIN fast-update pending list into the index
+        conn.execute(text(f"SELECT gin_clean_pending_list('ix_{PG_SEARCH_TABLE}_vector')"))
+        conn.execute(text(f'ANALYZE {PG_SEARCH_TABLE}'))
+    with storage.unit_of_work(self._dbconn) as conn:
+      after = self._index_stats(conn)
+    logger.debug(f'Database search index maintenance: {command}, {before["pages"]} -> '
+                 f'{after["pages"]} page(s), {before["size_bytes"]} -> '
+                 f'{after["size_bytes"]} bytes')
+    return [{'action': command, 'before': before, 'after': after}]
+
+
+def create_backend(app_config: ar3_mailrepo_config.AppConfig,
+                   db_engine: storage.DBEngine) -> SearchBackend:
+  build_options = app_config.index_build_options()
+  if app_config.search_backend() == BACKEND_DATABASE:
+    return DatabaseBackend(db_engine.conn(), text_workers=build_options['text_workers'],
+                           body_max_chars=build_options['body_max_chars'])
+  if app_config.search_backend() != BACKEND_WHOOSH:
+    raise RuntimeError(f'Unknown search backend {app_config.search_backend()}')
+  return WhooshBackend(app_config.search_index_root(), build_options,
+                       shard_by=app_config.index_shard_by())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Local search server keeping the index open between queries, and its client.
+Only imports the standard library at module level so that the client starts fast.
+"""
+
+import collections
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+logger = logging.getLogger('ar3_mailrepo.search_service')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+class LRUCache:
+  """
+  Least recently used cache of a fixed number of entries
+  """
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self._data = collections.OrderedDict()
+
+  def get(self, key):
+    if key not in self._data:
+      return None
+    self._data.move_to_end(key)
+    return self._data[key]
+
+  def put(self, key, value):
+    self._data[key] = value
+    self._data.move_to_end(key)
+    while len(self._data) > self.max_size:
+      self._data.popitem(last=False)
+
+  def clear(self):
+    self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+
+class SearchService:
+  """
+  Keeps the index shards and their searchers open and reopens them when the index
+  has changed on disk. Executed queries and result pages are cached until then.
+  body_text_loader returns the body texts highlighted in, by message uuid
+  """
+
+  def __init__(self, indexpath: Path, cache_size=256, body_text_loader=None):
+    # Imported here so that the client side of this module does not load whoosh
+    import search_shards  # pylint: disable=import-outside-toplevel
+    self.indexpath = indexpath
+    self.body_text_loader = body_text_loader
+    self._index = search_shards.ShardedIndex(indexpath)
+    self._lock = threading.Lock()
+    self.query_cache = LRUCache(cache_size)
+    self.page_cache = LRUCache(cache_size)
+
+  def _refresh_if_changed(self):
+    if self._index.refresh():
+      self.query_cache.clear()
+      self.page_cache.clear()
+      logger.debug(f'Index {self.indexpath} changed, searcher reloaded')
+
+  def _query(self, query_string: str, sort_by):
+    key = (query_string, sort_by)
+    query = self.query_cache.get(key)
+    if query is None:
+      query = self._index.query(query_string, sort_by=sort_by)
+      self.query_cache.put(key, query)
+    return query
+
+  def search(self, query_string: str, page=1, pagelen=20, sort_by=None,
+             highlight=False):
+    start = time.perf_counter()
+    with self._lock:
+      self._refresh_if_changed()
+      key = (query_string, page, pagelen, sort_by, highlight)
+      result = self.page_cache.get(key)
+      cached = result is not None
+      if not cached:
+        # Executed queries are cached, so the next page does not re-run the query
+        result = self._query(query_string, sort_by).page(
+          page, pagelen, highlight=highlight,
+          body_text_loader=self.body_text_loader).as_dict()
+        self.page_cache.put(key, result)
+    return dict(result, cached=cached,
+                took_ms=round((time.perf_counter() - start) * 1000, 3))
+
+  def close(self):
+    self._index.close()
+
+
+class _SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+
+  """
+  GET /search?q=...&page=1&pagelen=20&sort=date&highlight=1 returns the result page
+  as JSON
+  """
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    url = urllib.parse.urlsplit(self.path)
+    params = urllib.parse.parse_qs(url.query)
+    if url.path == '/health':
+      self._reply(200, {'status': 'ok', 'index': str(self.server.service.indexpath)})
+      return
+    if url.path != '/search' or 'q' not in params:
+      self._reply(404, {'error': 'Use /search?q=<query>'})
+      return
+    try:
+      result = self.server.service.search(
+        params['q'][0], page=int(params.get('page', [1])[0]),
+        pagelen=int(params.get('pagelen', [20])[0]), sort_by=params.get('sort', [None])[0],
+        highlight=params.get('highlight', ['0'])[0] == '1')
+    except Exception as e:  # pylint: disable=broad-except
+      logger.exception(f'Search failed for {self.path}')
+      self._reply(400, {'error': str(e)})
+      return
+    self._reply(200, result)
+
+  def _reply(self, status: int, body: dict):
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logger.debug(f'{self.address_string()} {format % args}')
+
+
+class SearchServer(http.server.ThreadingHTTPServer):
+
+  """
+  HTTP server bound to localhost answering queries from a SearchService
+  """
+
+  daemon_threads = True
+
+  def __init__(self, service: SearchService, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    super(SearchServer, self).__init__((host, port), _SearchRequestHandler)
+    self.service = service
+
+
+def serve(indexpath: Path, host=DEFAULT_HOST, port=DEFAULT_PORT, cache_size=256,
+          maintenance_options=None, body_text_loader=None):
+  service = SearchService(indexpath, cache_size=cache_size,
+                          body_text_loader=body_text_loader)
+  server = SearchServer(service, host, port)
+  maintenance = None
+  if maintenance_options and maintenance_options['interval_minutes'] > 0:
+    # Merges run next to the open searchers, which reload once they are committed
+    import index_maintenance  # pylint: disable=import-outside-toplevel
+    maintenance = index_maintenance.MaintenanceThread(
+      indexpath, maintenance_options['interval_minutes'] * 60,
+      max_segments=maintenance_options['max_segments'],
+      max_deleted_ratio=maintenance_options['max_deleted_ratio'])
+    maintenance.start()
+  logger.debug(f'Search service for {indexpath} listening on '
+               f'{server.server_address[0]}:{server.server_address[1]}')
+  try:
+    server.serve_forever()
+  finally:
+    if maintenance:
+      maintenance.stop()
+    server.server_close()
+    service.close()
+
+
+def print_search_page(result_page: dict):
+  """
+  Prints a page as returned by SearchPage.as_dict() or the search service
+  """
+  print(f"{result_page['total']} result(s), "
+        f"page {result_page['page']}/{result_page['pagecount']}")
+  for hit in result_page['hits']:
+    print(f"{hit['msg_uuid']}  {hit['msg_ts'] or '':19.19}  {hit['email_account']}  "
+          f"{hit['msg_subj']}")
+    for field, fragment in (hit.get('highlights') or {}).items():
+      print(f'    {field}: {fragment}')
+
+
+def query_service(query_string: str, host=DEFAULT_HOST, port=DEFAULT_PORT, page=1,
+                  pagelen=20, sort_by=None, highlight=False, timeout=5):
+  """
+  Sends a query to a running search service. Raises ConnectionError if there is
+  no service listening
+  """
+  params = {'q': query_string, 'page': page, 'pagelen': pagelen}
+  if sort_by:
+    params['sort'] = sort_by
+  if highlight:
+    params['highlight'] = 1
+  url = f'http://{host}:{port}/search?{urllib.parse.urlencode(params)}'
+  try:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+      return json.load(response)
+  except urllib.error.HTTPError as e:
+    # A proxy or another server on the port may not answer in JSON
+    try:
+      error = json.load(e).get('error')
+    except (ValueError, AttributeError, OSError):
+      error = None
+    raise RuntimeError(f'Search service error: {error or f"{e.code} {e.reason}"}')
+  except (urllib.error.URLError, OSError) as e:
+    raise ConnectionError(f'No search service at {host}:{port}: {e}')
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Layout of the search index: a single index in the index root, or one index per
+account under index_root/shards, searched in parallel and merged
+"""
+
+import concurrent.futures
+import hashlib
+import heapq
+import json
+import logging
+import re
+import shutil
+from pathlib import Path
+
+import sqlalchemy
+from whoosh import index
+from whoosh import query as whoosh_query
+
+import search_service
+import searcher
+import storage
+import textextract
+
+logger = logging.getLogger('ar3_mailrepo.search_shards')
+
+# Stored in the index root, records how the index is split into shards
+LAYOUT_FILE = 'ar3mr_index_layout.json'
+SHARDS_DIR = 'shards'
+
+SHARD_BY_NONE = 'none'
+SHARD_BY_ACCOUNT = 'account'
+SHARD_BY_CHOICES = [SHARD_BY_NONE, SHARD_BY_ACCOUNT]
+
+# Name of the only shard of an unsharded index
+SINGLE_SHARD = ''
+
+
+def shard_name(email_account: str):
+  """
+  Directory name of the shard of an account. The readable part loses characters and
+  case, the hash of the account keeps the names of different accounts apart
+  """
+  digest = hashlib.sha1(email_account.encode('utf-8')).hexdigest()[:10]
+  return f"{re.sub(r'[^a-z0-9@._-]', '_', email_account.lower())}-{digest}"
+
+
+def _shard_names(email_accounts):
+  """
+  Returns {shard name: account}, failing if two accounts would share a shard
+  """
+  shards = {}
+  for email_account in email_accounts:
+    name = shard_name(email_account)
+    if shards.get(name, email_account) != email_account:
+      raise RuntimeError(f'Accounts {shards[name]} and {email_account} resolve to the '
+                         f'same index shard {name}')
+    shards[name] = email_account
+  return shards
+
+
+def _current_shard_names(layout: dict):
+  return all(shard_name(y) == x for x, y in layout['shards'].items())
+
+
+def load_layout(index_root: Path):
+  layout_file = Path(index_root / LAYOUT_FILE)
+  if not layout_file.exists():
+    return {'shard_by': SHARD_BY_NONE, 'shards': {}}
+  with open(layout_file) as f:
+    return json.load(f)
+
+
+def save_layout(index_root: Path, layout: dict):
+  layout_file = Path(index_root / LAYOUT_FILE)
+  tmp_file = layout_file.with_suffix('.tmp')
+  with open(tmp_file, 'w') as f:
+    json.dump(layout, f, indent=4)
+  tmp_file.replace(layout_file)
+
+
+def shard_paths(index_root: Path, layout: dict = None):
+  """
+  Returns {shard name: index path} of the shards in the layout
+  """
+  layout = layout or load_layout(index_root)
+  if layout['shard_by'] == SHARD_BY_NONE:
+    return {SINGLE_SHARD: index_root}
+  return {x: Path(index_root / SHARDS_DIR / x) for x in layout['shards']}
+
+
+def _accounts_in_db(dbconn):
+  md = storage.messagedata
+  return [x[0] for x in dbconn.execute(
+    sqlalchemy.select([md.c.email_account]).distinct()).fetchall() if x[0]]
+
+
+def _remove_unsharded_index(index_root: Path):
+  for item in index_root.iterdir():
+    if item.is_file() and item.name != LAYOUT_FILE:
+      item.unlink()
+
+
+def build_index(index_root: Path, dbconn, shard_by=SHARD_BY_NONE, **build_options):
+  """
+  Rebuilds the whole index in the given layout, replacing an index in another layout.
+  Returns the number of messages indexed
+  """
+  index_root.mkdir(parents=True, exist_ok=True)
+  if shard_by == SHARD_BY_NONE:
+    if Path(index_root / SHARDS_DIR).exists():
+      shutil.rmtree(Path(index_root / SHARDS_DIR))
+    count = searcher.build_index_from_scratch(index_root, dbconn, **build_options)
+    save_layout(index_root, {'shard_by': SHARD_BY_NONE, 'shards': {}})
+    return count
+  _remove_unsharded_index(index_root)
+  if Path(index_root / SHARDS_DIR).exists():
+    shutil.rmtree(Path(index_root / SHARDS_DIR))
+  textextract.fill_text_cache(dbconn, workers=build_options.get('text_workers'),
+                              max_chars=build_options.get('body_max_chars', 20000))
+  shards = _shard_names(_accounts_in_db(dbconn))
+  count = 0
+  for name, email_account in shards.items():
+    count += searcher.build_index_from_scratch(
+      Path(index_root / SHARDS_DIR / name), dbconn, email_account=email_account,
+      fill_text=False, **build_options)
+  save_layout(index_root, {'shard_by': shard_by, 'shards': shards})
+  logger.debug(f'Built {len(shards)} index shard(s) in {index_root}')
+  return count
+
+
+def rebuild_shard(index_root: Path, dbconn, email_account: str, **build_options):
+  """
+  Rebuilds the shard of one account, leaving the other shards untouched
+  """
+  layout = load_layout(index_root)
+  if layout['shard_by'] != SHARD_BY_ACCOUNT:
+    raise RuntimeError(f'Index in {index_root} is not sharded by account')
+  if not _current_shard_names(layout):
+    logger.debug(f'Index in {index_root} has shards of an older naming, rebuilding')
+    return build_index(index_root, dbconn, shard_by=SHARD_BY_ACCOUNT, **build_options)
+  layout['shards'] = _shard_names(list(layout['shards'].values()) + [email_account])
+  name = shard_name(email_account)
+  count = searcher.build_index_from_scratch(
+    Path(index_root / SHARDS_DIR / name), dbconn, email_account=email_account,
+    **build_options)
+  save_layout(index_root, layout)
+  return count
+
+
+def update_index(index_root: Path, dbconn, shard_by=SHARD_BY_NONE, **build_options):
+  """
+  Adds new messages to each shard, and creates shards for new accounts. An index in
+  another layout than shard_by is rebuilt. Returns the number of messages added
+  """
+  layout = load_layout(index_root)
+  if layout['shard_by'] != shard_by:
+    logger.debug(f'Index in {index_root} is sharded by {layout["shard_by"]}, '
+                 f'rebuilding sharded by {shard_by}')
+    return build_index(index_root, dbconn, shard_by=shard_by, **build_options)
+  if not _current_shard_names(layout):
+    logger.debug(f'Index in {index_root} has shards of an older naming, rebuilding')
+    return build_index(index_root, dbconn, shard_by=shard_by, **build_options)
+  if shard_by == SHARD_BY_NONE:
+    return searcher.update_index(index_root, dbconn, **build_options)
+  if textextract.check_max_chars(dbconn, build_options.get('body_max_chars', 20000)):
+    return build_index(index_root, dbconn, shard_by=shard_by, **build_options)
+  # Text is extracted once for all shards, from the lowest shard high-water mark
+  states = [searcher.load_index_state(x) for x in shard_paths(index_root, layout).values()]
+  textextract.fill_text_cache(dbconn, after_id=min([x['last_id'] if x else 0
+                                                    for x in states] or [0]),
+                              workers=build_options.get('text_workers'),
+                              max_chars=build_options.get('body_max_chars', 20000))
+  layout['shards'] = _shard_names(sorted(set(layout['shards'].values()) |
+                                         set(_accounts_in_db(dbconn))))
+  count = 0
+  for name, email_account in layout['shards'].items():
+    count += searcher.update_index(Path(index_root / SHARDS_DIR / name), dbconn,
+                                   email_account=email_account, fill_text=False,
+                                   **build_options)
+  save_layout(index_root, layout)
+  return count
+
+
+def _query_accounts(query):
+  """
+  Returns the set of accounts a parsed query is restricted to, or None if it can
+  match messages of any account
+  """
+  if isinstance(query, whoosh_query.Term):
+    return {query.text} if query.fieldname == 'email_account' else None
+  if isinstance(query, whoosh_query.And):
+    restrictions = [x for x in map(_query_accounts, query.subqueries) if x is not None]
+    return set.intersection(*restrictions) if restrictions else None
+  if isinstance(query, whoosh_query.Or):
+    restrictions = [_query_accounts(x) for x in query.subqueries]
+    if restrictions and None not in restrictions:
+      return set.union(*restrictions)
+  return None
+
+
+class ShardedSearchQuery(searcher.SearchQuery):
+  """
+  Runs a query on the shards it can match, in parallel, and merges the per-shard
+  results, which are already in order. The merge only advances as far as the pages
+  requested so far
+  """
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, shard_searchers: dict, query_string: str, sort_by=None,
+               fields=None, executor: concurrent.futures.Executor = None,
+               shard_accounts: dict = None):
+    self.query_string = query_string
+    some_searcher = next(iter(shard_searchers.values()))
+    self.query = searcher.create_query_parser(some_searcher.schema,
+                                              fields).parse(query_string)
+    names = list(shard_searchers)
+    accounts = _query_accounts(self.query)
+    # An unsharded index has the single shard only, which holds every account.
+    # Query terms are lowercase, see the email_account field
+    if accounts is not None and shard_accounts and SINGLE_SHARD not in shard_searchers:
+      names = [x for x in names if shard_accounts.get(x, '').lower() in accounts]
+    logger.debug(f'Query {query_string} runs on {len(names)} of '
+                 f'{len(shard_searchers)} shard(s)')
+
+    def run(name):
+      return searcher.SearchQuery(shard_searchers[name], query_string, sort_by=sort_by,
+                                  parsed_query=self.query)
+
+    if executor and len(names) > 1:
+      self._shard_queries = list(executor.map(run, names))
+    else:
+      self._shard_queries = [run(x) for x in names]
+    self._order = []
+    self._merged = heapq.merge(
+      *[self._ranked(ix, x, sort_by) for ix, x in enumerate(self._shard_queries)],
+      key=lambda x: x[0], reverse=sort_by != 'account')
+
+  @staticmethod
+  def _ranked(shard_ix, shard_query, sort_by):
+    # Yields (merge key, shard, rank) in the order of the shard results. Sorted
+    # results are merged on the untranslated column values whoosh sorted them by,
+    # which are never None: a missing value is the column default
+    results = shard_query._results  # pylint: disable=protected-access
+    column = None
+    if sort_by:
+      column = results.searcher.reader().column_reader(searcher.sort_field(sort_by),
+                                                       translate=False)
+    for rank in range(len(results)):
+      if column is None:
+        key = results.score(rank)
+      else:
+        key = column[results.docnum(rank)]
+      yield key, shard_ix, rank
+
+  def _merge_up_to(self, count: int):
+    while len(self._order) < count:
+      item = next(self._merged, None)
+      if item is None:
+        break
+      self._order.append(item[1:])
+
+  @property
+  def total(self):
+    return sum(x.total for x in self._shard_queries)
+
+  def hits(self, offset=0, limit=20, highlight=False, body_text_loader=None):
+    self._merge_up_to(offset + limit)
+    # pylint: disable=protected-access
+    return searcher.make_search_hits(
+      [self._shard_queries[shard_ix]._results[rank]
+       for shard_ix, rank in self._order[offset:offset + limit]],
+      highlight, body_text_loader)
+
+  def uuids(self):
+    return [y for x in self._shard_queries for y in x.uuids()]
+
+
+class ShardedIndex:
+  """
+  The open shards of an index root, with a searcher per shard. refresh() picks up
+  shards added or rebuilt on disk since opening
+  """
+
+  def __init__(self, index_root: Path, max_workers=None):
+    self.index_root = index_root
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers, thread_name_prefix='ar3mr-shard')
+    self.searchers = {}
+    self.shard_accounts = {}
+    self._open()
+
+  def _open(self):
+    layout = load_layout(self.index_root)
+    self.shard_accounts = dict(layout['shards'])
+    for name, path in shard_paths(self.index_root, layout).items():
+      if index.exists_in(path):
+        self.searchers[name] = index.open_dir(path).searcher()
+    if not self.searchers:
+      raise RuntimeError(f'No search index in {self.index_root}')
+
+  def refresh(self):
+    """
+    Reopens changed shards. Returns True if anything changed
+    """
+    paths = shard_paths(self.index_root)
+    if set(paths) != set(self.searchers):
+      self._close_searchers()
+      self._open()
+      return True
+    changed = False
+    for name, shard_searcher in self.searchers.items():
+      if not shard_searcher.up_to_date():
+        self.searchers[name] = shard_searcher.refresh()
+        changed = True
+    return changed
+
+  def query(self, query_string: str, sort_by=None, fields=None):
+    return ShardedSearchQuery(self.searchers, query_string, sort_by=sort_by,
+                              fields=fields, executor=self._executor,
+                              shard_accounts=self.shard_accounts)
+
+  def _close_searchers(self):
+    for shard_searcher in self.searchers.values():
+      shard_searcher.close()
+    self.searchers = {}
+
+  def close(self):
+    self._close_searchers()
+    self._executor.shutdown(wait=False)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+def search(index_root: Path, query_string: str, page=1, pagelen=20, sort_by=None,
+           highlight=False, body_text_loader=None):
+  with ShardedIndex(index_root) as sharded_index:
+    return sharded_index.query(query_string, sort_by=sort_by).page(
+      page, pagelen, highlight=highlight, body_text_loader=body_text_loader)
+
+
+def search_and_print(index_root: Path, searchstring: str, sort_by=None, page=1,
+                     pagelen=20, highlight=False, body_text_loader=None):
+  search_service.print_search_page(search(index_root, searchstring, page=page,
+                                          pagelen=pagelen, sort_by=sort_by,
+                                          highlight=highlight,
+                                          body_text_loader=body_text_loader).as_dict())
+
+
+def search_uuids(index_root: Path, searchstring: str):
+  with ShardedIndex(index_root) as sharded_index:
+    return sharded_index.query(searchstring).uuids()
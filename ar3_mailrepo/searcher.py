@@ -20,50 +20,355 @@
 Implements the Search Engine
 """
 
+import json
+import logging
+import time
 from pathlib import Path
 
 import sqlalchemy
 from whoosh import index
-from whoosh.fields import Schema, TEXT
+from whoosh.fields import Schema, DATETIME, ID, KEYWORD, TEXT
 from whoosh.index import create_in
-from whoosh.qparser import QueryParser
+from whoosh.qparser import MultifieldParser
+from whoosh.qparser.dateparse import DateParserPlugin
+from whoosh.qparser.plugins import FieldAliasPlugin
 
+import metrics
+import search_service
 import storage
+import textextract
 
-schema = Schema(msg_uuid=TEXT(stored=True), email_account=TEXT(stored=True),
+logger = logging.getLogger('ar3_mailrepo.searcher')
+
+# Bump when the schema changes, an index with another version is rebuilt from scratch
+SCHEMA_VERSION = 4
+
+# Stored next to the index segments, records what has been indexed
+INDEX_STATE_FILE = 'ar3mr_index_state.json'
+
+# sortable fields are kept in per-document columns, so that filtering and sorting
+# on them does not load stored fields
+schema = Schema(msg_uuid=ID(stored=True, unique=True),
+                email_account=KEYWORD(stored=True, lowercase=True, sortable=True),
+                source=KEYWORD(stored=True, sortable=True),
+                msg_ts=DATETIME(stored=True, sortable=True),
                 msg_subj=TEXT(stored=True), msg_to=TEXT(stored=True),
-                msg_from=TEXT(stored=True))
+                msg_from=TEXT(stored=True), msg_body=TEXT(stored=False),
+                attachment_names=TEXT(stored=True))
+
+# Short names usable in queries, e.g. 'date:[2019 to 2020] account:x'
+FIELD_ALIASES = {
+  'msg_ts': ['date'],
+  'email_account': ['account'],
+  'msg_subj': ['subject'],
+  'msg_from': ['from'],
+  'msg_to': ['to'],
+  'msg_body': ['body'],
+  'attachment_names': ['attachment'],
+}
+
+SORT_FIELDS = {
+  'date': 'msg_ts',
+  'account': 'email_account',
+}
+
+
+# Fields searched by terms without a field name
+DEFAULT_SEARCH_FIELDS = ['msg_subj', 'msg_from', 'msg_to', 'msg_body']
+
 
+def create_query_parser(ix_schema, fields=None):
+  qp = MultifieldParser(fields or DEFAULT_SEARCH_FIELDS, schema=ix_schema)
+  qp.add_plugin(FieldAliasPlugin(FIELD_ALIASES))
+  qp.add_plugin(DateParserPlugin())
+  return qp
+
+
+def load_index_state(indexpath: Path):
+  state_file = Path(indexpath / INDEX_STATE_FILE)
+  if not state_file.exists():
+    return None
+  with open(state_file) as f:
+    return json.load(f)
+
+
+def save_index_state(indexpath: Path, last_id: int):
+  state_file = Path(indexpath / INDEX_STATE_FILE)
+  tmp_file = state_file.with_suffix('.tmp')
+  with open(tmp_file, 'w') as f:
+    json.dump({'schema_version': SCHEMA_VERSION, 'last_id': last_id}, f, indent=4)
+  tmp_file.replace(state_file)
+
+
+def _index_rows(dbconn, after_id=0, batch_size=1000, email_account=None):
+  """
+  Streams the indexed columns in id order through a server-side cursor
+  """
+  md = storage.messagedata
+  mt = storage.messagetext
+  condition = md.c.id > after_id
+  if email_account is not None:
+    condition = sqlalchemy.and_(condition, md.c.email_account == email_account)
+  semt = sqlalchemy.select(
+    [md.c.id, md.c.msg_uuid, md.c.email_account, md.c.msg_subj, md.c.msg_to,
+     md.c.msg_from, mt.c.body_text, mt.c.attachment_names, md.c.source,
+     md.c.msg_ts]).select_from(
+    md.outerjoin(mt, mt.c.message_id == md.c.id)).where(condition).order_by(md.c.id)
+  result = dbconn.execution_options(stream_results=True).execute(semt)
+  try:
+    while True:
+      rows = result.fetchmany(batch_size)
+      if not rows:
+        break
+      yield from rows
+  finally:
+    result.close()
 
-def build_index_from_scratch(indexpath: Path, dbconn):
+
+class IndexProgress:
+  """
+  Logs indexing progress and throughput every progress_every documents
+  """
+
+  def __init__(self, description: str, progress_every=10000):
+    self.description = description
+    self.progress_every = progress_every
+    self.count = 0
+    self.start = time.perf_counter()
+
+  def add(self):
+    self.count += 1
+    if self.count % self.progress_every == 0:
+      self.log()
+
+  def rate(self):
+    return self.count / max(time.perf_counter() - self.start, 1e-6)
+
+  def log(self):
+    logger.debug(f'{self.description}: {self.count} document(s) in '
+                 f'{time.perf_counter() - self.start:.1f}s, {self.rate():.0f} docs/s')
+
+
+def _add_rows(writer, rows, progress: IndexProgress, update=False):
+  add_fn = writer.update_document if update else writer.add_document
+  last_id = None
+  for item in rows:
+    document = {'msg_uuid': item[1], 'email_account': item[2], 'msg_subj': item[3],
+                'msg_to': item[4], 'msg_from': item[5], 'msg_body': item[6] or '',
+                'attachment_names': item[7] or '', 'source': item[8],
+                'msg_ts': item[9]}
+    # Whoosh rejects None values, in particular for the DATETIME field
+    with metrics.timed('ar3mr_index_add_seconds'):
+      add_fn(**{k: v for k, v in document.items() if v is not None})
+    last_id = item[0]
+    progress.add()
+  return last_id
+
+
+def build_index_from_scratch(indexpath: Path, dbconn, procs=1, limitmb=128,
+                             multisegment=False, batch_size=1000, text_workers=None,
+                             body_max_chars=20000, email_account=None, fill_text=True):
+  """
+  Builds a new index over all of messagedata, or over the messages of email_account
+  only. With procs > 1 documents are indexed by a multi-process writer; limitmb
+  bounds the memory of each indexing process. Unless fill_text is False, body text
+  missing from the text cache is extracted first by text_workers processes
+  """
   if not indexpath.exists():
     indexpath.mkdir(parents=True)
 
+  if fill_text:
+    textextract.fill_text_cache(dbconn, workers=text_workers, max_chars=body_max_chars)
+
   ix = create_in(indexpath, schema)
-  writer = ix.writer()
+  writer = ix.writer(procs=procs, limitmb=limitmb, multisegment=multisegment)
 
-  semt = sqlalchemy.select(
-    [storage.messagedata.c.msg_uuid, storage.messagedata.c.email_account,
-     storage.messagedata.c.msg_subj, storage.messagedata.c.msg_to,
-     storage.messagedata.c.msg_from])
-  result = dbconn.execute(semt)
-  for item in result.fetchall():
-    writer.add_document(msg_uuid=item[0], email_account=item[1], msg_subj=item[2],
-                        msg_to=item[3], msg_from=item[4])
-  writer.commit()
+  progress = IndexProgress(f'Building index {indexpath}')
+  last_id = _add_rows(writer, _index_rows(dbconn, batch_size=batch_size,
+                                          email_account=email_account), progress) or 0
+  logger.debug(f'All documents added to {indexpath}, committing')
+  with metrics.timed('ar3mr_index_commit_seconds'):
+    writer.commit()
+  save_index_state(indexpath, last_id)
+  progress.log()
+  logger.debug(f'Built index {indexpath} from scratch with {progress.count} message(s)')
+  return progress.count
+
+
+def update_index(indexpath: Path, dbconn, **build_options):
+  """
+  Adds messages stored since the last build or update, identified by messagedata.id
+  above the recorded high-water mark. Falls back to a full build if there is no
+  usable index yet. Returns the number of messages added
+  """
+  state = load_index_state(indexpath)
+  if not index.exists_in(indexpath) or not state or \
+      state['schema_version'] != SCHEMA_VERSION:
+    logger.debug(f'No current index in {indexpath}, building from scratch')
+    return build_index_from_scratch(indexpath, dbconn, **build_options)
+  if build_options.get('fill_text', True):
+    if textextract.check_max_chars(dbconn, build_options.get('body_max_chars', 20000)):
+      return build_index_from_scratch(indexpath, dbconn, **build_options)
+    textextract.fill_text_cache(dbconn, after_id=state['last_id'],
+                                workers=build_options.get('text_workers'),
+                                max_chars=build_options.get('body_max_chars', 20000))
+  writer = index.open_dir(indexpath).writer()
+  progress = IndexProgress(f'Updating index {indexpath}')
+  # update_document keeps the index consistent if a row was already added by a
+  # run that stopped before saving the index state
+  rows = _index_rows(dbconn, after_id=state['last_id'],
+                     batch_size=build_options.get('batch_size', 1000),
+                     email_account=build_options.get('email_account'))
+  last_id = _add_rows(writer, rows, progress, update=True)
+  if last_id is None:
+    writer.cancel()
+    logger.debug(f'Index {indexpath} is up to date at id {state["last_id"]}')
+    return 0
+  with metrics.timed('ar3mr_index_commit_seconds'):
+    writer.commit()
+  save_index_state(indexpath, last_id)
+  logger.debug(f'Added {progress.count} message(s) to index {indexpath}, '
+               f'now at id {last_id}')
+  return progress.count
+
+
+def sort_field(sort_by):
+  if not sort_by:
+    return None
+  if sort_by not in SORT_FIELDS:
+    raise RuntimeError(f'Unknown sort order {sort_by}, use one of {list(SORT_FIELDS)}')
+  return SORT_FIELDS[sort_by]
+
+
+class SearchHit:
+  """
+  Lightweight search result, built from the stored fields of one hit
+  """
+
+  __slots__ = ['msg_uuid', 'email_account', 'msg_ts', 'msg_subj', 'score', 'highlights']
+
+  def __init__(self, msg_uuid, email_account, msg_ts, msg_subj, score, highlights=None):
+    self.msg_uuid = msg_uuid
+    self.email_account = email_account
+    self.msg_ts = msg_ts
+    self.msg_subj = msg_subj
+    self.score = score
+    self.highlights = highlights
+
+  def as_dict(self):
+    return {'msg_uuid': self.msg_uuid,
+            'email_account': self.email_account,
+            'msg_ts': self.msg_ts.isoformat() if self.msg_ts else None,
+            'msg_subj': self.msg_subj,
+            'score': self.score,
+            'highlights': self.highlights}
+
+  def __repr__(self):
+    return f'SearchHit({self.as_dict()})'
+
+
+class SearchPage:
+  """
+  One page of the hits of a SearchQuery
+  """
+
+  def __init__(self, query_string, page, pagelen, total, hits):
+    self.query_string = query_string
+    self.page = page
+    self.pagelen = pagelen
+    self.total = total
+    self.pagecount = (total + pagelen - 1) // pagelen if pagelen else 0
+    self.hits = hits
+
+  def as_dict(self):
+    return {'query': self.query_string, 'page': self.page, 'pagelen': self.pagelen,
+            'pagecount': self.pagecount, 'total': self.total,
+            'hits': [x.as_dict() for x in self.hits]}
+
+
+HIGHLIGHT_FIELDS = ['msg_subj', 'msg_from', 'msg_to']
+
+
+def make_search_hits(page_hits, highlight=False, body_text_loader=None):
+  """
+  Turns whoosh hits into SearchHit objects, with highlights if requested
+  """
+  body_texts = {}
+  if highlight and body_text_loader and page_hits:
+    body_texts = body_text_loader([x['msg_uuid'] for x in page_hits])
+  search_hits = []
+  for hit in page_hits:
+    highlights = None
+    if highlight:
+      highlights = {x: hit.highlights(x) for x in HIGHLIGHT_FIELDS}
+      if hit['msg_uuid'] in body_texts:
+        highlights['msg_body'] = hit.highlights(
+          'msg_body', text=body_texts[hit['msg_uuid']] or '')
+      highlights = {k: v for k, v in highlights.items() if v}
+    search_hits.append(SearchHit(hit['msg_uuid'], hit.get('email_account'),
+                                 hit.get('msg_ts'), hit.get('msg_subj'), hit.score,
+                                 highlights))
+  return search_hits
+
+
+class SearchQuery:
+  """
+  Runs a query once against an open searcher and serves pages of its hits. Stored
+  fields and highlights are only loaded for the hits of a requested page, so paging
+  through a large result does not re-run the query. Valid while the searcher is open
+  """
+
+  def __init__(self, ix_searcher, query_string: str, sort_by=None, fields=None,
+               parsed_query=None):
+    self.query_string = query_string
+    self.query = parsed_query or create_query_parser(ix_searcher.schema,
+                                                     fields).parse(query_string)
+    # Newest first when sorting by date
+    self._results = ix_searcher.search(self.query, limit=None,
+                                       sortedby=sort_field(sort_by),
+                                       reverse=sort_by == 'date')
+
+  @property
+  def total(self):
+    return len(self._results)
+
+  def hits(self, offset=0, limit=20, highlight=False, body_text_loader=None):
+    """
+    Returns SearchHit objects for hits offset to offset + limit. body_text_loader
+    takes a list of uuids and returns {uuid: body text}, used to highlight the
+    body, which is not stored in the index
+    """
+    return make_search_hits([self._results[ix]
+                             for ix in range(offset, min(offset + limit, self.total))],
+                            highlight, body_text_loader)
+
+  def page(self, page=1, pagelen=20, highlight=False, body_text_loader=None):
+    page = max(page, 1)
+    return SearchPage(self.query_string, page, pagelen, self.total,
+                      self.hits((page - 1) * pagelen, pagelen, highlight,
+                                body_text_loader))
+
+  def uuids(self):
+    return [x['msg_uuid'] for x in self._results]
+
+
+def search(indexpath: Path, query_string: str, page=1, pagelen=20, sort_by=None,
+           highlight=False, body_text_loader=None):
+  ix = index.open_dir(indexpath)
+  with ix.searcher() as s:
+    return SearchQuery(s, query_string, sort_by=sort_by).page(
+      page, pagelen, highlight=highlight, body_text_loader=body_text_loader)
+
+
+def search_and_print(indexpath: Path, searchstring: str, sort_by=None, page=1,
+                     pagelen=20, highlight=False, body_text_loader=None):
+  search_service.print_search_page(search(indexpath, searchstring, page=page,
+                                          pagelen=pagelen, sort_by=sort_by,
+                                          highlight=highlight,
+                                          body_text_loader=body_text_loader).as_dict())
 
 
-def search_and_print(indexpath: Path, searchstring: str):
+def search_uuids(indexpath: Path, searchstring: str):
   ix = index.open_dir(indexpath)
-  qp = QueryParser("msg_subj", schema=ix.schema)
-  q = qp.parse(searchstring)
   with ix.searcher() as s:
-    # print(list(s.lexicon('msg_subj')))
-    results = s.search(q, limit=20)
-    # print(results.scored_length())
-    for r in results:
-      print(r)
-    # for hit in results:
-    #     for h in hit:
-    #         print('-'*30)
-    #         print(h)
+    return SearchQuery(s, searchstring).uuids()
@@ -20,23 +20,93 @@
 Database and other storage funcionality
 """
 
-from sqlalchemy import Table, Column, LargeBinary, Integer, String, Text, DateTime, \
-  MetaData
-from sqlalchemy import create_engine, inspect, select
-
+from sqlalchemy import Table, Column, LargeBinary, Integer, BigInteger, String, Text, \
+  DateTime, MetaData, UniqueConstraint, Index, PrimaryKeyConstraint
+from sqlalchemy import and_, bindparam, create_engine, event, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+import atexit
+import concurrent.futures
+import contextlib
 import datetime
 import json
 import logging
 import pickle
+import queue
+import threading
 from pathlib import Path
 
 import ar3_mailrepo_config
 import ar3_mailrepo_version_info as versioninfo
+import metrics
+import util_logger
 import gzip
 import uuid
 
 logger = logging.getLogger('ar3_mailrepo.storage')
 
+# Engine execution option set when the database search backend is used, holding the
+# number of body characters to index. insert_message_batch then indexes new messages
+INDEX_AT_INGEST_OPTION = 'ar3mr_index_at_ingest'
+
+# Maximum number of uuids per IN (...) clause
+UUID_QUERY_CHUNK = 500
+
+# A batch insert is sent once either limit is reached. The byte limit keeps
+# batches below max_allowed_packet on MySQL
+INSERT_BATCH_SIZE = 100
+INSERT_BATCH_BYTES = 32 * 1024 * 1024
+
+# Connection pool settings per db_driver, overridden per driver by db_pool in the
+# config. SQLite keeps the SQLAlchemy default pool, which does not take a size
+DEFAULT_POOL_OPTIONS = {
+  'sqlite': {'pool_pre_ping': True},
+  'mssql_local': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600,
+                  'pool_pre_ping': True},
+  'postgres': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600,
+               'pool_pre_ping': True},
+  'mysql': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 200,
+            'pool_pre_ping': True},
+}
+
+SQLITE_UNSUPPORTED_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+@contextlib.contextmanager
+def unit_of_work(dbconn):
+  """
+  Runs the enclosed statements in one transaction. Accepts the engine returned by
+  DBEngine.conn() or an already checked out connection
+  """
+  if isinstance(dbconn, Engine):
+    with dbconn.begin() as conn:
+      yield conn
+  else:
+    with dbconn.begin():
+      yield dbconn
+
+
+def create_dupefilter_list(dbconn, emaillabel: str, lookback_days=2):
+  stmt = select(
+    [messagedata.c.msg_id,
+     messagedata.c.msg_ts,
+     messagedata.c.id]).where \
+    (messagedata.c.email_account == emaillabel)
+  result = dbconn.execute(stmt)
+  resultset = []
+  for item in result.fetchall():
+    if item['msg_id'] and item['msg_ts']:
+      resultset.append({'id': item[0], 'date': item[1]})
+  if len(resultset) < 1:
+    return datetime.date(1970, 1, 1), set()
+  since_date = (max([x['date'] for x in resultset])).date() - datetime.timedelta(
+    days=lookback_days)
+  dupelist = {x['id'] for x in resultset if x['date'].date() >= since_date}
+  logger.debug(
+    f'Dupe List for {emaillabel} and lookback {lookback_days}: '
+    f'{since_date} and len {len(dupelist)}')
+  return since_date, dupelist
 
 
 def create_new_timestamped_cache_path(email_cache_folder: Path):
@@ -71,35 +141,38 @@ def create_download_report(len_messages_listed: int,
 
 def load_pickle_object_as_data(picklefilename: Path):
   with open(picklefilename, 'rb') as f:
-    load_msg = pickle.load(f)
-
-    msg = {}
-    for k, v in load_msg.items():
-      if v and isinstance(v, str):
-        msg[k] = v.replace('\x00', '')
-      else:
-        msg[k] = v
+    return msgdata_from_message(pickle.load(f))
 
-    compressed_gmail_data = None
-    if msg['ar3mr_gmail_data']:
-      compressed_gmail_data = gzip.compress(bytes(msg['ar3mr_gmail_data'], 'utf8'))
 
-
-
-    msgdata = {
-      'msg_uuid': msg['ar3mr_uuid'],
-      'email_account': msg['ar3mr_email_account'],
-      'msg_id': msg['ar3mr_id'],
-      'msg_ts': msg['ar3mr_ts'],
-      'msg_subj': str(msg['ar3mr_subj']),
-      'msg_from': msg['ar3mr_from'],
-      'msg_to': msg['ar3mr_to'],
-      'source': msg['ar3mr_source'],
-      'dnload_ts': msg['ar3mr_downloadtime'],
-      'raw_data': msg['ar3mr_raw'],
-      'gmail_data': compressed_gmail_data
-    }
-    return msgdata
+def msgdata_from_message(load_msg: dict):
+  """
+  Converts a downloaded message, as cached by ar3_mailrepo_lib, into a messagedata row
+  """
+  msg = {}
+  for k, v in load_msg.items():
+    if v and isinstance(v, str):
+      msg[k] = v.replace('\x00', '')
+    else:
+      msg[k] = v
+
+  compressed_gmail_data = None
+  if msg['ar3mr_gmail_data']:
+    compressed_gmail_data = gzip.compress(bytes(msg['ar3mr_gmail_data'], 'utf8'))
+
+  msgdata = {
+    'msg_uuid': msg['ar3mr_uuid'],
+    'email_account': msg['ar3mr_email_account'],
+    'msg_id': msg['ar3mr_id'],
+    'msg_ts': msg['ar3mr_ts'],
+    'msg_subj': str(msg['ar3mr_subj']),
+    'msg_from': msg['ar3mr_from'],
+    'msg_to': msg['ar3mr_to'],
+    'source': msg['ar3mr_source'],
+    'dnload_ts': msg['ar3mr_downloadtime'],
+    'raw_data': msg['ar3mr_raw'],
+    'gmail_data': compressed_gmail_data
+  }
+  return msgdata
 
 
 class DataCacheFolder:
@@ -120,34 +193,95 @@ class DataCacheFolder:
     with open(self.downloadreport_file) as f:
       return json.load(f)
 
-  def message_data_files(self):
-    return len(self.name.glob('*.pickle'))
-
-  def store_messages_in_database(self, dbconn):
-    batchsize = 1
+  def email_account(self):
+    return self.name.parent.name
+
+  def is_ingested(self, dbconn):
+    smt = select([ingestlog.c.message_count]).where(
+      and_(ingestlog.c.email_account == self.email_account(),
+           ingestlog.c.cache_folder == self.name.name))
+    row = dbconn.execute(smt).fetchone()
+    return row is not None and row['message_count'] == len(self.message_files())
+
+  def message_files(self):
+    return sorted(self.name.glob('*.pickle'))
+
+  def store_messages_in_database(self, dbconn, batch_size=INSERT_BATCH_SIZE,
+                                 batch_bytes=INSERT_BATCH_BYTES, writer=None):
+    """
+    Idempotent ingest of the folder: messages whose uuid is already in the database
+    are not loaded, and a folder recorded as fully ingested is skipped entirely.
+    With a QueuedWriter the inserts are handed to the writer thread.
+    Returns the number of messages newly inserted
+    """
+    message_files = self.message_files()
+    if self.is_ingested(dbconn):
+      logger.debug(f'Already ingested, skipping {self.name}')
+      return 0
+    file_uuids = {msg_uuid_from_cache_filename(x): x for x in message_files}
+    existing = existing_msg_uuids(dbconn, file_uuids.keys())
+    todo_files = [x for msg_uuid, x in file_uuids.items() if msg_uuid not in existing]
+    logger.debug(f'{len(message_files)} message(s) in {self.name}, '
+                 f'{len(message_files) - len(todo_files)} already in database')
+    if writer:
+      stored = 0
+      pending = []
+      for batch in self._load_batches(todo_files, batch_size, batch_bytes):
+        pending.append(writer.submit(
+          lambda conn, batch=batch: insert_message_batch(conn, batch)))
+        stored += len(batch)
+      for future in pending:
+        future.result()
+      self._check_unmodified(message_files)
+      writer.submit(lambda conn: self.record_ingested(conn, len(message_files))).result()
+      return stored
+    stored = 0
+    # The folder is one unit of work: it is only logged as ingested if all inserts
+    # have been committed
+    with unit_of_work(dbconn) as conn:
+      for batch in self._load_batches(todo_files, batch_size, batch_bytes):
+        insert_message_batch(conn, batch)
+        stored += len(batch)
+      self._check_unmodified(message_files)
+      self.record_ingested(conn, len(message_files))
+    return stored
 
+  @staticmethod
+  def _load_batches(message_files, batch_size, batch_bytes):
     store_list = []
-    message_files = [x for x in self.name.glob('*.pickle')] # pylint: disable=unnecessary-comprehension
+    store_list_bytes = 0
+    progress = util_logger.ProgressReporter(logger, 'Loading cache files',
+                                            total=len(message_files))
     for ix, filename in enumerate(message_files):
-      logger.debug(f'Loading file {ix + 1}/{len(message_files)}: {filename}')
-      store_list.append(load_pickle_object_as_data(filename))
-      # logger.debug(f"{msg['ar3mr_ts']} in " )
-      if ((ix + 1) % batchsize == 0) or (ix + 1 == len(message_files)):
-        logger.debug(f'Reached limit to insert in DB: {len(store_list)}')
-        msg_ins = messagedata.insert(None)
-        try:
-          dbconn.execute(msg_ins, store_list)
-        except Exception as e:
-          dumpfile = Path(f'exceptiion_dump_{uuid.uuid4()}.pkl')
-          with open(dumpfile,'wb') as f:
-            pickle.dump(store_list, f)
-          logger.error(f'Error in storing message to database {e}, dump in {dumpfile}')
-          raise
-        store_list.clear()
-        logger.debug('Insert done')
-    if len([x for x in self.name.glob('*.pickle')]) != len(message_files): # pylint: disable=unnecessary-comprehension
+      progress.update()
+      msg = load_pickle_object_as_data(filename)
+      store_list.append(msg)
+      store_list_bytes += len(msg['raw_data'] or b'')
+      if len(store_list) >= batch_size or store_list_bytes >= batch_bytes or \
+          ix + 1 == len(message_files):
+        logger.debug('Reached limit to insert in DB: %d', len(store_list))
+        yield store_list
+        store_list = []
+        store_list_bytes = 0
+    progress.done()
+
+  def _check_unmodified(self, message_files):
+    if self.message_files() != message_files:
       raise Exception(f'Directory {self.name} has been modified since DB insert started')
-    return len(message_files)
+
+  def record_ingested(self, conn, message_count):
+    conn.execute(ingestlog.delete().where(
+      and_(ingestlog.c.email_account == self.email_account(),
+           ingestlog.c.cache_folder == self.name.name)))
+    conn.execute(ingestlog.insert(None), {'email_account': self.email_account(),
+                                          'cache_folder': self.name.name,
+                                          'message_count': message_count,
+                                          'ingest_ts': datetime.datetime.now()})
+
+
+def msg_uuid_from_cache_filename(filename: Path):
+  # Cache files are written as Msg_<uuid>.pickle, see retrieve_messages_to_cache
+  return filename.stem[len('Msg_'):]
 
 
 def msg_uuid_per_account(dbconn, email_account):
@@ -159,6 +293,137 @@ def msg_uuid_per_account(dbconn, email_account):
   return all_uuids
 
 
+def stream_raw_messages(dbconn, email_account=None, msg_uuids=None, after_id=0,
+                        batch_size=200):
+  """
+  Yields (id, msg_uuid, msg_ts, raw_data) in id order for an account and/or a list
+  of uuids, using a server-side cursor so that the blobs are never all held in memory
+  """
+  if msg_uuids is not None:
+    msg_uuids = list(msg_uuids)
+    for start in range(0, len(msg_uuids), UUID_QUERY_CHUNK):
+      yield from _stream_raw_messages(
+        dbconn, email_account, msg_uuids[start:start + UUID_QUERY_CHUNK], after_id,
+        batch_size)
+  else:
+    yield from _stream_raw_messages(dbconn, email_account, None, after_id, batch_size)
+
+
+def _stream_raw_messages(dbconn, email_account, msg_uuids, after_id, batch_size):
+  conditions = [messagedata.c.id > after_id]
+  if email_account is not None:
+    conditions.append(messagedata.c.email_account == email_account)
+  if msg_uuids is not None:
+    conditions.append(messagedata.c.msg_uuid.in_(msg_uuids))
+  smt = select([messagedata.c.id, messagedata.c.msg_uuid, messagedata.c.msg_ts,
+                messagedata.c.raw_data]).where(and_(*conditions)).order_by(
+    messagedata.c.id)
+  result = dbconn.execution_options(stream_results=True).execute(smt)
+  try:
+    while True:
+      rows = result.fetchmany(batch_size)
+      if not rows:
+        break
+      for row in rows:
+        yield row['id'], row['msg_uuid'], row['msg_ts'], row['raw_data']
+  finally:
+    result.close()
+
+
+def stream_raw_messages_for_account(dbconn, email_account, after_id=0, batch_size=200):
+  for msg_id, msg_uuid, _, raw_data in stream_raw_messages(
+      dbconn, email_account=email_account, after_id=after_id, batch_size=batch_size):
+    yield msg_id, msg_uuid, raw_data
+
+
+def existing_msg_uuids(dbconn, msg_uuids):
+  found = set()
+  msg_uuids = list(msg_uuids)
+  for start in range(0, len(msg_uuids), UUID_QUERY_CHUNK):
+    smt = select([messagedata.c.msg_uuid]).where(
+      messagedata.c.msg_uuid.in_(msg_uuids[start:start + UUID_QUERY_CHUNK]))
+    found.update(x['msg_uuid'] for x in dbconn.execute(smt).fetchall())
+  return found
+
+
+_insert_ignore_statements = {}
+
+
+def insert_ignore_statement(dialect_name, table=None, key='msg_uuid'):
+  """
+  INSERT statement for table (default messagedata) that silently skips rows whose
+  unique key column already exists
+  """
+  table = messagedata if table is None else table
+  cache_key = (dialect_name, table.name)
+  if cache_key not in _insert_ignore_statements:
+    key_column = table.c[key]
+    if dialect_name == 'postgresql':
+      smt = postgresql.insert(table).on_conflict_do_nothing(index_elements=[key_column])
+    elif dialect_name == 'sqlite':
+      if hasattr(sqlite, 'insert'):
+        smt = sqlite.insert(table).on_conflict_do_nothing(index_elements=[key_column])
+      else:
+        # SQLAlchemy < 1.4 has no ON CONFLICT for SQLite
+        smt = table.insert(None).prefix_with('OR IGNORE')
+    elif dialect_name == 'mysql':
+      smt = table.insert(None).prefix_with('IGNORE')
+    elif dialect_name == 'mssql':
+      columns = [x for x in table.columns if x.name != 'id']
+      smt = text(
+        f'MERGE INTO {table.name} WITH (HOLDLOCK) AS target '
+        f'USING (SELECT :{key} AS {key}) AS source '
+        f'ON target.{key} = source.{key} '
+        'WHEN NOT MATCHED THEN INSERT '
+        f"({', '.join(x.name for x in columns)}) "
+        f"VALUES ({', '.join(':' + x.name for x in columns)});").bindparams(
+        *[bindparam(x.name, type_=x.type) for x in columns])
+    else:
+      raise Exception(f'No idempotent insert for database dialect {dialect_name}')
+    _insert_ignore_statements[cache_key] = smt
+  return _insert_ignore_statements[cache_key]
+
+
+def insert_message_batch(dbconn, store_list):
+  # Imported here as these modules import this one
+  import addresses  # pylint: disable=import-outside-toplevel
+  import mailstats  # pylint: disable=import-outside-toplevel
+  import threads  # pylint: disable=import-outside-toplevel
+  msg_ins = insert_ignore_statement(dbconn.dialect.name)
+  # Messages already stored are skipped by the insert and must not be counted again
+  existing = existing_msg_uuids(dbconn, [x['msg_uuid'] for x in store_list])
+  try:
+    with metrics.timed('ar3mr_db_insert_batch_seconds', dialect=dbconn.dialect.name):
+      dbconn.execute(msg_ins, store_list)
+  except Exception as e:
+    dumpfile = Path(f'exceptiion_dump_{uuid.uuid4()}.pkl')
+    with open(dumpfile, 'wb') as f:
+      pickle.dump(store_list, f)
+    logger.error(f'Error in storing message to database {e}, dump in {dumpfile}')
+    raise
+  metrics.counter('ar3mr_db_insert_messages_total').inc(len(store_list))
+  metrics.counter('ar3mr_db_insert_bytes_total').inc(
+    sum(len(x['raw_data'] or b'') for x in store_list))
+  mailstats.record_inserted_messages(dbconn, store_list, existing)
+  addresses.link_inserted_messages(dbconn, store_list)
+  threads.thread_inserted_messages(dbconn, store_list)
+  index_chars = dbconn.get_execution_options().get(INDEX_AT_INGEST_OPTION)
+  if index_chars:
+    # Imported here as search_backends imports this module
+    import search_backends  # pylint: disable=import-outside-toplevel
+    search_backends.index_inserted_messages(dbconn, store_list, index_chars)
+
+
+def body_text_by_uuid(dbconn, msg_uuids):
+  """
+  Returns {msg_uuid: body text} from the text cache, see textextract
+  """
+  smt = select([messagedata.c.msg_uuid, messagetext.c.body_text]).select_from(
+    messagedata.join(messagetext, messagetext.c.message_id == messagedata.c.id)).where(
+    messagedata.c.msg_uuid.in_(list(msg_uuids)))
+  return {x['msg_uuid']: x['body_text'] for x in dbconn.execute(smt).fetchall()}
+
+
 def extract_msg_from_db_by_uuid(dbconn, msg_uuid):
   result = extract_msg_from_db_by_uuid_or_msgid(dbconn, 'uuid', msg_uuid)
   if len(result) > 1:
@@ -213,6 +478,101 @@ messagedata = Table('messagedata', metadata,
                     Column('gmail_data', LargeBinary(4294967295), nullable=True)
                     )
 
+# Searchable text extracted from messagedata.raw_data, see textextract
+messagetext = Table('messagetext', metadata,
+                    Column('message_id', Integer, primary_key=True, autoincrement=False),
+                    Column('body_text', Text(), nullable=True),
+                    Column('attachment_names', Text(), nullable=True)
+                    )
+
+# Cache folders that have been completely stored in messagedata
+ingestlog = Table('ingestlog', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('email_account', String(200), nullable=False),
+                  Column('cache_folder', String(200), nullable=False),
+                  Column('message_count', Integer, nullable=False),
+                  Column('ingest_ts', DateTime, nullable=False),
+                  UniqueConstraint('email_account', 'cache_folder')
+                  )
+
+# Distinct email addresses of senders and recipients, see addresses
+address = Table('address', metadata,
+                Column('id', Integer, primary_key=True),
+                Column('email', String(320), nullable=False, unique=True),
+                Column('display_name', Text(), nullable=True)
+                )
+
+# The addresses of a message by role (from, to, cc, bcc). The second index makes
+# the messages of a contact an index lookup
+messageaddress = Table('messageaddress', metadata,
+                       Column('message_id', Integer, nullable=False),
+                       Column('role', String(4), nullable=False),
+                       Column('address_id', Integer, nullable=False),
+                       PrimaryKeyConstraint('message_id', 'role', 'address_id'),
+                       Index('ix_messageaddress_address', 'address_id', 'role',
+                             'message_id')
+                       )
+
+# Conversations, see threads. gmail_thread_id is the threadId of Gmail messages,
+# other threads are built from the Message-ID, In-Reply-To and References headers
+thread = Table('thread', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('email_account', String(200), nullable=False),
+               Column('gmail_thread_id', String(50), nullable=True),
+               Column('subject', Text(), nullable=True),
+               Column('message_count', Integer, nullable=False),
+               Column('first_ts', DateTime, nullable=True),
+               Column('last_ts', DateTime, nullable=True),
+               Index('ix_thread_account_last', 'email_account', 'last_ts'),
+               Index('ix_thread_gmail', 'email_account', 'gmail_thread_id')
+               )
+
+# The thread of each message and its parent in the thread. msg_key and parent_key
+# are hashes of the Message-ID of the message and of the message it replies to
+messagethread = Table('messagethread', metadata,
+                      Column('message_id', Integer, primary_key=True, autoincrement=False),
+                      Column('thread_id', Integer, nullable=False),
+                      Column('parent_id', Integer, nullable=True),
+                      Column('msg_key', String(40), nullable=True),
+                      Column('parent_key', String(40), nullable=True),
+                      Column('msg_ts', DateTime, nullable=True),
+                      Index('ix_messagethread_thread', 'thread_id', 'msg_ts')
+                      )
+
+# Thread of every Message-ID seen or referenced in an account, so that messages
+# arriving before their parents still join the thread
+threadkey = Table('threadkey', metadata,
+                  Column('email_account', String(200), nullable=False),
+                  Column('msg_key', String(40), nullable=False),
+                  Column('thread_id', Integer, nullable=False),
+                  PrimaryKeyConstraint('email_account', 'msg_key'),
+                  Index('ix_threadkey_thread', 'thread_id')
+                  )
+
+# Number and stored bytes of the messages per account, source and month, see
+# mailstats. gmail_data_bytes is the size of the compressed Gmail metadata
+mailstats = Table('mailstats', metadata,
+                  Column('email_account', String(200), nullable=False),
+                  Column('source', String(50), nullable=False),
+                  Column('month', String(7), nullable=False),
+                  Column('message_count', Integer, nullable=False),
+                  Column('raw_bytes', BigInteger, nullable=False),
+                  Column('gmail_data_bytes', BigInteger, nullable=False),
+                  PrimaryKeyConstraint('email_account', 'source', 'month')
+                  )
+
+# High-water marks of search backends that index from the database, see search_backends
+searchstate = Table('searchstate', metadata,
+                    Column('backend', String(50), primary_key=True),
+                    Column('last_id', Integer, nullable=False)
+                    )
+
+# Settings and state the stored data depends on, by name, see load_setting
+reposetting = Table('reposetting', metadata,
+                    Column('name', String(50), primary_key=True),
+                    Column('value', Integer, nullable=False)
+                    )
+
 dbinfo = Table('dbinfo', metadata,
                Column('dbversion', Integer, nullable=False),
                Column('app_name', String(100), nullable=False),
@@ -222,6 +582,114 @@ dbinfo = Table('dbinfo', metadata,
                )
 
 
+def load_setting(conn, name: str, default=None):
+  row = conn.execute(select([reposetting.c.value]).where(
+    reposetting.c.name == name)).fetchone()
+  return row[0] if row else default
+
+
+def save_setting(conn, name: str, value: int):
+  conn.execute(reposetting.delete().where(reposetting.c.name == name))
+  conn.execute(reposetting.insert(None), {'name': name, 'value': value})
+
+
+class QueuedWriter:
+  """
+  Serialises database writes of concurrent producers through one thread and
+  connection. Queued work is committed in groups, one transaction per group. The
+  queue is kept short, as queued work may hold a whole insert batch
+  """
+
+  def __init__(self, db_engine, max_group=16, queue_size=4):
+    self.max_group = max_group
+    self._db_engine = db_engine
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='ar3mr-db-writer', daemon=True)
+    self._thread.start()
+
+  def submit(self, work):
+    """
+    Queues work, a callable taking a connection, and returns a Future of its result.
+    Raises if the writer has failed or was closed
+    """
+    if self._error is not None:
+      raise RuntimeError('The database writer has failed') from self._error
+    if not self._thread.is_alive():
+      raise RuntimeError('The database writer is closed')
+    future = concurrent.futures.Future()
+    self._queue.put((work, future))
+    return future
+
+  def execute(self, smt, params=None):
+    def execute_statement(conn):
+      # The result is not returned, its cursor belongs to the writer thread
+      conn.execute(smt, params)
+    return self.submit(execute_statement)
+
+  def flush(self):
+    self.submit(lambda conn: None).result()
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+
+  def _run(self):
+    try:
+      conn = self._db_engine.connect()
+    except Exception as e:  # pylint: disable=broad-except
+      logger.exception('The database writer could not connect')
+      self._fail_queued(e)
+      return
+    group = []
+    try:
+      stop = False
+      while not stop:
+        group = [self._queue.get()]
+        while len(group) < self.max_group:
+          try:
+            group.append(self._queue.get_nowait())
+          except queue.Empty:
+            break
+        stop = None in group
+        group = [x for x in group if x is not None]
+        if group:
+          self._commit_group(conn, group)
+    except Exception as e:  # pylint: disable=broad-except
+      logger.exception('The database writer failed')
+      for _, future in group:
+        if not future.done():
+          future.set_exception(e)
+      if not stop:
+        self._fail_queued(e)
+    finally:
+      conn.close()
+
+  def _fail_queued(self, error):
+    # Fails queued and later work until close, so that no producer waits forever
+    self._error = error
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      item[1].set_exception(error)
+
+  def _commit_group(self, conn, group):
+    try:
+      with conn.begin():
+        results = [work(conn) for work, _ in group]
+    except Exception as e:  # pylint: disable=broad-except
+      if len(group) > 1:
+        # Retry one by one so that only the failing work reports the error
+        for item in group:
+          self._commit_group(conn, [item])
+      else:
+        group[0][1].set_exception(e)
+      return
+    for (_, future), result in zip(group, results):
+      future.set_result(result)
+
+
 class DBEngine:
 
   """
@@ -229,8 +697,11 @@ class DBEngine:
   """
 
   def is_db_a_mailrepo(self):
-    inspector = inspect(self.conn(validate_as_mailrepo_db=False))
-    return dbinfo.name in inspector.get_table_names()
+    return DBEngine._is_mailrepo_engine(self.conn(validate_as_mailrepo_db=False))
+
+  @staticmethod
+  def _is_mailrepo_engine(db_engine):
+    return dbinfo.name in inspect(db_engine).get_table_names()
 
   @staticmethod
   def _load_credentials_file(cred_file: Path):
@@ -242,14 +713,15 @@ class DBEngine:
     if self.app_config.data['db_driver'] == 'sqlite':
       dbfile = self.app_config.data['db_driver_credentials']['sqlite_file_path']
       self.conn_description = f'SQLite DB {dbfile}'
-      db_engine = create_engine(f'sqlite:///{dbfile}')
+      db_engine = create_engine(f'sqlite:///{dbfile}', **self._pool_options())
+      event.listen(db_engine, 'connect', self._apply_sqlite_pragmas)
     elif self.app_config.data['db_driver'] == 'mssql_local':
       srv = self.app_config.data['db_driver_credentials']['host']
       db = self.app_config.data['db_driver_credentials']['database_name']
       self.conn_description = 'Local MS SQl: ' + db
       conn_string = f'{srv}/{db}?driver=SQL+Server+Native+Client+11.0' \
                     f'?Trusted_Connection=yes'
-      db_engine = create_engine(f'mssql+pyodbc://{conn_string}')
+      db_engine = create_engine(f'mssql+pyodbc://{conn_string}', **self._pool_options())
     elif self.app_config.data['db_driver'] == 'postgres':
       srv = self.app_config.data['db_driver_credentials']['host']
       login_creds = DBEngine._load_credentials_file(
@@ -258,7 +730,7 @@ class DBEngine:
       password = login_creds['password']
       db = self.app_config.data['db_driver_credentials']['database_name']
       conn_string = f'postgres://{username}:{password}@{srv}/{db}'
-      db_engine = create_engine(conn_string)
+      db_engine = create_engine(conn_string, **self._pool_options())
     elif self.app_config.data['db_driver'] == 'mysql':
       srv = self.app_config.data['db_driver_credentials']['host']
       login_creds = DBEngine._load_credentials_file(
@@ -269,45 +741,126 @@ class DBEngine:
       # Added +pymysql to make it work under Linux
       conn_string = f'mysql+pymysql://{username}:{password}' \
                     f'@{srv}/{db}?charset=utf8mb4&binary_prefix=true'
-      # , pool_recycle=3600
       # , isolation_level="READ UNCOMMITTED"
-      db_engine = create_engine(conn_string, pool_recycle=200)
+      db_engine = create_engine(conn_string, **self._pool_options())
     else:
       raise Exception('Unknown database driver ' + str(self.app_config.data['db_driver']))
+    if self.app_config.search_backend() == 'database':
+      db_engine.update_execution_options(**{
+        INDEX_AT_INGEST_OPTION: self.app_config.index_build_options()['body_max_chars']})
     return db_engine
 
+  def _pool_options(self):
+    driver = self.app_config.data['db_driver']
+    options = dict(DEFAULT_POOL_OPTIONS.get(driver, {}))
+    options.update(self.app_config.db_pool_options(driver))
+    if driver == 'sqlite':
+      ignored = [x for x in SQLITE_UNSUPPORTED_POOL_OPTIONS if x in options]
+      for name in ignored:
+        del options[name]
+      if ignored:
+        logger.warning(f'Ignoring db_pool options {ignored}, the SQLite pool is not sized')
+    logger.debug(f'Connection pool options for {driver}: {options}')
+    return options
+
+  @staticmethod
+  def _create_search_schema(conn):
+    # The database search backend indexes at ingest, so its tables must exist first
+    if conn.get_execution_options().get(INDEX_AT_INGEST_OPTION):
+      import search_backends  # pylint: disable=import-outside-toplevel
+      search_backends.ensure_schema(conn)
+
+  def _apply_sqlite_pragmas(self, dbapi_conn, connection_record):  # pylint: disable=unused-argument
+    cursor = dbapi_conn.cursor()
+    for pragma, value in self.app_config.sqlite_pragmas().items():
+      cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+  def writer(self):
+    """
+    Returns the shared QueuedWriter if writes are serialised through a writer thread
+    (SQLite by default), otherwise None and writers use pooled connections directly
+    """
+    if self.app_config.data['db_driver'] != 'sqlite' or \
+        not self.app_config.sqlite_writer_thread():
+      return None
+    self.conn()
+    with self._conn_lock:
+      if not self._writer:
+        self._writer = QueuedWriter(
+          self, queue_size=self.app_config.sqlite_writer_queue_size())
+    return self._writer
+
   def close(self):
-    if self._conn:
-      pass
-    # Todo implement when dealing with other databases
+    with self._conn_lock:
+      if self._writer:
+        self._writer.close()
+        self._writer = None
+      if self._conn:
+        self._conn.dispose()
+        self._conn = None
+        logger.debug(f'Disposed connection pool of {self.conn_description}')
 
   def __init__(self, app_config: ar3_mailrepo_config.AppConfig):
     self._conn = None
+    self._writer = None
+    self._conn_lock = threading.Lock()
     self.app_config = app_config
     self.conn_description = 'No Connection'
+    atexit.register(self.close)
 
   def description(self):
     return self.conn_description
 
   def populate_database(self):
+    import mailstats
     ins = dbinfo.insert(None)
-    metadata.create_all(self.conn(validate_as_mailrepo_db=False))
-    self._conn.execute(ins,
-                       {'dbversion': 1,
-                        'systemversion': versioninfo.current_system_version(),
-                        'rabatin_copyright': versioninfo.rabatin_copyright(),
-                        'prod_status': versioninfo.prod_status(),
-                        'app_name': versioninfo.app_name()
-                        })
+    with self.conn(validate_as_mailrepo_db=False).begin() as conn:
+      metadata.create_all(conn)
+      conn.execute(ins,
+                   {'dbversion': 1,
+                    'systemversion': versioninfo.current_system_version(),
+                    'rabatin_copyright': versioninfo.rabatin_copyright(),
+                    'prod_status': versioninfo.prod_status(),
+                    'app_name': versioninfo.app_name()
+                    })
+      # The ingest counts every message of a new database
+      mailstats.mark_complete(conn)
+      DBEngine._create_search_schema(conn)
     logger.debug('Populated Database as MailRepo')
 
   def establish_conn(self):
     self.conn(validate_as_mailrepo_db=False)
 
   def conn(self, validate_as_mailrepo_db=True):
+    """
+    Returns the shared SQLAlchemy engine. The engine owns the connection pool and
+    may be used from several threads at once
+    """
     if not self._conn:
-      self._conn = self._create_conn()
-      logger.debug('Creating Database Connection on demand')
-      if validate_as_mailrepo_db and not self.is_db_a_mailrepo():
-        raise Exception('Not a valid Mail Repo Database')
+      with self._conn_lock:
+        if not self._conn:
+          db_engine = self._create_conn()
+          logger.debug('Creating Database Connection on demand')
+          if validate_as_mailrepo_db:
+            if not DBEngine._is_mailrepo_engine(db_engine):
+              raise Exception('Not a valid Mail Repo Database')
+            # Creates tables added in later versions, existing tables are untouched
+            metadata.create_all(db_engine, checkfirst=True)
+            with db_engine.begin() as conn:
+              DBEngine._create_search_schema(conn)
+          self._conn = db_engine
     return self._conn
+
+  def connect(self):
+    """
+    Checks a connection out of the pool. Close it to return it to the pool
+    """
+    return self.conn().connect()
+
+  def begin(self):
+    """
+    Context manager running a unit of work in one transaction on a pooled connection
+    """
+    return self.conn().begin()
+
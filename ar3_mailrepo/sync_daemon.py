@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Continuous sync: keeps one authenticated connection per account open and streams
+new messages into the download pipeline as they arrive. IMAP accounts wait in IDLE
+on a key folder (or poll it), Gmail accounts poll the history API.
+"""
+
+import abc
+import datetime
+import logging
+import random
+import signal
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import ar3_mailrepo_lib
+import pipeline
+import storage
+
+logger = logging.getLogger('ar3_mailrepo.sync_daemon')
+
+
+class Backoff:
+  """
+  Exponential delay after consecutive failures, with random jitter so that accounts
+  failing together do not retry together
+  """
+
+  def __init__(self, initial: float, maximum: float, jitter=0.2):
+    self.initial = initial
+    self.maximum = maximum
+    self.jitter = jitter
+    self.failures = 0
+
+  def next_delay(self):
+    delay = min(self.maximum, self.initial * 2 ** self.failures)
+    self.failures += 1
+    return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+  def reset(self):
+    self.failures = 0
+
+
+class AccountSync(threading.Thread, abc.ABC):
+  """
+  Sync loop of one account. The connection, the dupe filter and the sync position
+  are kept between syncs; after an error the connection is opened again after a
+  backoff delay. Subclasses implement connected and sync_once
+  """
+
+  def __init__(self, emaillabel: str, credentials: dict,
+               sync_pipeline: pipeline.DownloadPipeline, db_engine: storage.DBEngine,
+               options: dict, stop_event: threading.Event):
+    super(AccountSync, self).__init__(name=f'ar3mr-sync-{emaillabel}', daemon=True)
+    self.emaillabel = emaillabel
+    self.credentials = credentials
+    self.pipeline = sync_pipeline
+    self.db_engine = db_engine
+    self.options = options
+    self.stop_event = stop_event
+    self.svr_conn = None
+    self.since_date = None
+    self.known_ids = None
+    self.backoff = Backoff(options['backoff_initial_seconds'],
+                           options['backoff_max_seconds'], options['jitter'])
+    self.status = {'state': 'starting', 'stored': 0, 'syncs': 0, 'last_sync': None,
+                   'errors': 0, 'last_error': None}
+
+  def _load_dupe_filter(self):
+    # Once per daemon run, later syncs add what they store
+    if self.known_ids is None:
+      self.since_date, self.known_ids = storage.create_dupefilter_list(
+        self.db_engine.conn(), self.emaillabel)
+
+  def _remember(self, messages):
+    for msg in messages:
+      self.known_ids.add(msg['ar3mr_id'])
+      yield msg
+
+  def store(self, results):
+    """
+    Queues the results of a retrieve method for storage. Returns the number of new
+    messages
+    """
+    self.pipeline.check_stored()
+    report = ar3_mailrepo_lib.new_download_report(
+      self.since_date or datetime.date(1970, 1, 1), self.known_ids)
+    count = self.pipeline.store_account_messages(
+      self.emaillabel, self._remember(self.svr_conn.stamp_messages(results, report)),
+      report)
+    # Queued messages are not counted as stored once the pipeline has failed
+    self.pipeline.check_stored()
+    self.status['stored'] += count
+    if count:
+      logger.info(f'{self.emaillabel}: {count} new message(s)')
+    return count
+
+  def connected(self):
+    pass
+
+  @abc.abstractmethod
+  def sync_once(self):
+    """
+    Stores new messages, then waits for the next sync
+    """
+
+  def _close(self):
+    if self.svr_conn:
+      self.svr_conn.close()
+      self.svr_conn = None
+
+  def run(self):
+    # Accounts start spread out instead of all logging in at once
+    if self.stop_event.wait(random.uniform(0, self.options['start_jitter_seconds'])):
+      return
+    while not self.stop_event.is_set():
+      try:
+        if self.svr_conn is None:
+          self.status['state'] = 'connecting'
+          self.svr_conn = ar3_mailrepo_lib.create_server_connection(self.credentials)
+          self.connected()
+        self.status['state'] = 'syncing'
+        self.sync_once()
+        self.status['syncs'] += 1
+        self.status['last_sync'] = datetime.datetime.now().isoformat()
+        self.backoff.reset()
+      except Exception as e:  # pylint: disable=broad-except
+        delay = self.backoff.next_delay()
+        logger.exception(f'Sync of {self.emaillabel} failed, retrying in {delay:.0f}s')
+        self.status.update({'state': 'backoff', 'last_error': str(e)})
+        self.status['errors'] += 1
+        try:
+          self._close()
+        except Exception:  # pylint: disable=broad-except
+          self.svr_conn = None
+        self.stop_event.wait(delay)
+    self._close()
+    self.status['state'] = 'stopped'
+
+
+class IMAPAccountSync(AccountSync):
+  """
+  Tracks the highest UID per folder, so a sync only fetches messages above it.
+  Waits in IDLE on the first of idle_folders if the server supports it, otherwise
+  polls them every noop_seconds. All folders are synced every poll_seconds
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(IMAPAccountSync, self).__init__(*args, **kwargs)
+    self.folders = []
+    self.idle_folders = []
+    # folder -> (UIDVALIDITY, highest UID stored), kept across reconnects
+    self.uid_state = {}
+    self.last_full_sync = None
+
+  def connected(self):
+    self._load_dupe_filter()
+    self.folders = [x['name'] for x in self.svr_conn.retrieve_folders()]
+    self.idle_folders = [x for x in self.options['idle_folders'] if x in self.folders]
+    self.last_full_sync = None
+
+  def sync_folder(self, folder: str):
+    uidvalidity = self.svr_conn.folder_uidvalidity(folder)
+    validity, last_uid = self.uid_state.get(folder, (None, None))
+    if validity != uidvalidity:
+      # New folder or renumbered UIDs: fetch since the dupe filter date, known
+      # messages are skipped by Message-ID
+      last_uid = None
+    highest = [last_uid]
+
+    def results():
+      for uid, result in self.svr_conn.retrieve_new_messages(
+          folder, last_uid, self.since_date, self.known_ids):
+        yield result
+        if 'is_error' in result:
+          # The mark stays below the failed message, the next sync fetches it again
+          return
+        highest[0] = max(highest[0] or 0, uid)
+
+    count = self.store(results())
+    if highest[0] is None:
+      self.uid_state.pop(folder, None)
+    else:
+      self.uid_state[folder] = (uidvalidity, highest[0])
+    return count
+
+  def sync_once(self):
+    poll_seconds = self.options['poll_seconds']
+    if self.last_full_sync is None or \
+        time.monotonic() - self.last_full_sync >= poll_seconds:
+      self.last_full_sync = time.monotonic()
+      folders = self.folders
+    else:
+      folders = self.idle_folders
+    for folder in folders:
+      self.sync_folder(folder)
+    wait_seconds = max(0.0, min(self.options['idle_seconds'], poll_seconds - (
+      time.monotonic() - self.last_full_sync)))
+    if self.idle_folders and self.svr_conn.supports_idle():
+      self.status['state'] = 'idle'
+      self.svr_conn.idle(self.idle_folders[0], wait_seconds, self.stop_event)
+    else:
+      self.status['state'] = 'waiting'
+      self.stop_event.wait(min(wait_seconds, self.options['noop_seconds']))
+
+
+class GmailAccountSync(AccountSync):
+  """
+  Polls users.history for added messages every gmail_poll_seconds. A full download
+  only runs at the start and when the history has expired
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(GmailAccountSync, self).__init__(*args, **kwargs)
+    self.history_id = None
+
+  def _full_sync(self):
+    self._load_dupe_filter()
+    # Taken before the download, so that nothing added during it is missed, and
+    # kept once the download is stored: after a failure it runs again
+    history_id = self.svr_conn.current_history_id()
+    self.store(self.svr_conn.retrieve_messages(self.since_date, self.known_ids))
+    self.history_id = history_id
+
+  def connected(self):
+    if self.history_id is None:
+      self._full_sync()
+
+  def sync_once(self):
+    try:
+      history_id, message_ids = self.svr_conn.list_history_message_ids(self.history_id)
+    except HttpError as e:
+      if e.resp.status != 404:
+        raise
+      logger.info(f'History of {self.emaillabel} has expired, downloading again')
+      self._full_sync()
+    else:
+      self.store(self.svr_conn.retrieve_messages_by_id(message_ids, self.known_ids))
+      self.history_id = history_id
+    self.status['state'] = 'waiting'
+    self.stop_event.wait(self.options['gmail_poll_seconds'])
+
+
+def create_account_sync(emaillabel: str, credentials: dict, *args):
+  if credentials['protocol'] == 'imap4':
+    return IMAPAccountSync(emaillabel, credentials, *args)
+  if credentials['protocol'] == 'gmail':
+    return GmailAccountSync(emaillabel, credentials, *args)
+  raise RuntimeError('Unkown Protocol ' + credentials['protocol'])
+
+
+class SyncDaemon:
+  """
+  Runs an AccountSync thread per account, all feeding one download pipeline
+  """
+
+  def __init__(self, db_engine: storage.DBEngine, emaillabels, credentials_for,
+               sync_pipeline: pipeline.DownloadPipeline, options: dict):
+    self.db_engine = db_engine
+    self.emaillabels = list(emaillabels)
+    self.credentials_for = credentials_for
+    self.pipeline = sync_pipeline
+    self.options = options
+    self.stop_event = threading.Event()
+    self.accounts = {}
+
+  def start(self):
+    self.pipeline.start()
+    for emaillabel in self.emaillabels:
+      account = create_account_sync(emaillabel, self.credentials_for(emaillabel),
+                                    self.pipeline, self.db_engine, self.options,
+                                    self.stop_event)
+      self.accounts[emaillabel] = account
+      account.start()
+    logger.info(f'Sync daemon started for {len(self.accounts)} account(s)')
+
+  def stop(self):
+    self.stop_event.set()
+    for account in self.accounts.values():
+      account.join()
+    self.pipeline.stop()
+    logger.info('Sync daemon stopped')
+
+  def status(self):
+    return {'accounts': {x: dict(y.status) for x, y in self.accounts.items()},
+            'pipeline': self.pipeline.progress()}
+
+  def run_forever(self):
+    """
+    Runs until interrupted or terminated, logging the status every
+    status_interval_seconds
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+    self.start()
+    try:
+      while not self.stop_event.wait(self.options['status_interval_seconds']):
+        if self.pipeline.write_error:
+          logger.error('Storing messages failed, stopping the sync daemon')
+          break
+        for emaillabel, status in self.status()['accounts'].items():
+          logger.info(f"{emaillabel}: {status['state']}, {status['stored']} stored, "
+                      f"{status['errors']} error(s), last sync {status['last_sync']}")
+    except KeyboardInterrupt:
+      logger.info('Interrupted, stopping the sync daemon')
+    finally:
+      self.stop()
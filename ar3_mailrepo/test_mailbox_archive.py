@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the mbox and Maildir export and import
+"""
+
+import mailbox
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine, select
+
+import mailbox_archive
+import storage
+
+RAW_MESSAGES = [
+  b'Message-ID: <1@example.com>\r\nSubject: Invoice\r\n\r\nPlease pay\r\n',
+  b'Message-ID: <2@example.com>\r\n\r\nNo subject\r\n',
+]
+
+
+class TestArchiveRoundTrip(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.root = Path(self.tmpdir.name)
+    self.db_engine = create_engine(f"sqlite:///{self.root / 'archive.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+    source = mailbox.Maildir(str(self.root / 'source'), factory=None, create=True)
+    for raw_data in RAW_MESSAGES:
+      source.add(raw_data)
+    source.close()
+    self.assertEqual(mailbox_archive.import_messages(
+      self.db_engine, 'maildir', self.root / 'source', 'a@example.com'), (2, 0))
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def test_export_keeps_raw_data(self):
+    for archive_format in ('maildir', 'mbox'):
+      archive_path = self.root / f'export.{archive_format}'
+      self.assertEqual(mailbox_archive.export_messages(
+        self.db_engine, archive_format, archive_path), 2)
+      self.assertEqual(mailbox_archive.import_messages(
+        self.db_engine, archive_format, archive_path, 'a@example.com'), (0, 2))
+
+  def test_missing_subject_is_null(self):
+    md = storage.messagedata
+    subjects = self.db_engine.execute(
+      select([md.c.msg_subj]).order_by(md.c.msg_id)).fetchall()
+    self.assertEqual(subjects, [('Invoice',), (None,)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the message statistics kept by the ingest
+"""
+
+import datetime
+import unittest
+
+from sqlalchemy import create_engine
+
+import mailstats
+import storage
+
+
+def _row(msg_uuid, email_account='a@example.com', source='imap4', msg_ts=None,
+         raw_data=b'raw', gmail_data=None):
+  return {'msg_uuid': msg_uuid, 'email_account': email_account, 'msg_id': msg_uuid,
+          'msg_ts': msg_ts, 'msg_subj': 'Subject', 'msg_from': 'x@example.com',
+          'msg_to': email_account, 'source': source, 'dnload_ts': None,
+          'raw_data': raw_data, 'gmail_data': gmail_data}
+
+
+class TestMailStats(unittest.TestCase):
+
+  def setUp(self):
+    self.db_engine = create_engine('sqlite://')
+    storage.metadata.create_all(self.db_engine)
+
+  def store(self, rows):
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, rows)
+
+  def stats(self):
+    return {(x['email_account'], x['source'], x['month']):
+            tuple(x[name] for name in mailstats.COUNTERS)
+            for x in mailstats.monthly_stats(self.db_engine)}
+
+  def test_ingest_counts_messages(self):
+    self.store([_row('u1', msg_ts=datetime.datetime(2021, 3, 1), raw_data=b'12345'),
+                _row('u2', msg_ts=datetime.datetime(2021, 3, 9), raw_data=b'123'),
+                _row('u3', source='gmail', msg_ts=datetime.datetime(2021, 4, 1),
+                     raw_data=None, gmail_data=b'1234567'),
+                _row('u4', email_account='b@example.com')])
+    self.assertEqual(self.stats(), {
+      ('a@example.com', 'imap4', '2021-03'): (2, 8, 0),
+      ('a@example.com', 'gmail', '2021-04'): (1, 0, 7),
+      ('b@example.com', 'imap4', mailstats.NO_MONTH): (1, 3, 0)})
+    self.assertEqual(mailstats.account_totals(self.db_engine, 'a@example.com'), [
+      {'email_account': 'a@example.com', 'message_count': 3, 'raw_bytes': 8,
+       'gmail_data_bytes': 7}])
+
+  def test_stored_messages_are_counted_once(self):
+    self.store([_row('u1'), _row('u1')])
+    self.store([_row('u1'), _row('u2')])
+    self.assertEqual(self.stats(), {('a@example.com', 'imap4', mailstats.NO_MONTH):
+                                    (2, 6, 0)})
+
+  def test_rebuild_matches_ingest(self):
+    self.store([_row('u1', msg_ts=datetime.datetime(2021, 3, 1), raw_data=b'12345'),
+                _row('u2', source='gmail', gmail_data=b'12'),
+                _row('u3', email_account='b@example.com', raw_data=None)])
+    ingested = self.stats()
+    self.assertEqual(mailstats.rebuild(self.db_engine, batch_size=2), 3)
+    self.assertEqual(self.stats(), ingested)
+
+  def test_complete_after_rebuild(self):
+    # Messages stored before the statistics were kept are not in them
+    self.store([_row('u1')])
+    self.db_engine.execute(storage.mailstats.delete())
+    self.assertFalse(mailstats.is_complete(self.db_engine))
+    mailstats.rebuild(self.db_engine)
+    self.assertTrue(mailstats.is_complete(self.db_engine))
+    self.store([_row('u2')])
+    mailstats.rebuild(self.db_engine)
+    self.assertEqual(self.stats(), {('a@example.com', 'imap4', mailstats.NO_MONTH):
+                                    (2, 6, 0)})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the download pipeline writer and index threads
+"""
+
+import datetime
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import ar3_mailrepo_config
+import pipeline
+import storage
+
+
+def _stamped(number):
+  # A message as yielded by ServerConnection.download_messages
+  return {'ar3mr_uuid': f'uuid-{number}', 'ar3mr_email_account': 'a@example.com',
+          'ar3mr_id': f'<{number}@example.com>',
+          'ar3mr_ts': datetime.datetime(2021, 5, 1, 12, number),
+          'ar3mr_subj': f'Message {number}', 'ar3mr_from': 'x@example.com',
+          'ar3mr_to': 'a@example.com', 'ar3mr_source': 'imap4',
+          'ar3mr_downloadtime': datetime.datetime(2021, 5, 2),
+          'ar3mr_raw': f'Subject: Message {number}\r\n\r\nBody\r\n'.encode(),
+          'ar3mr_gmail_data': None}
+
+
+class _FlakyBackend:
+  """
+  Backend whose first update fails
+  """
+
+  def __init__(self):
+    self.calls = 0
+    self.updated = threading.Event()
+
+  def update(self, dbconn):  # pylint: disable=unused-argument
+    self.calls += 1
+    if self.calls == 1:
+      raise RuntimeError('index is locked')
+    self.updated.set()
+    return 1
+
+
+class TestDownloadPipeline(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.db_engine = storage.DBEngine(ar3_mailrepo_config.AppConfig.from_dict({
+      'db_driver': 'sqlite',
+      'db_driver_credentials': {
+        'sqlite_file_path': str(Path(self.tmpdir.name) / 'pipeline.sqlite')},
+    }))
+    self.db_engine.populate_database()
+
+  def tearDown(self):
+    self.db_engine.close()
+    self.tmpdir.cleanup()
+
+  def test_failed_index_update_is_retried(self):
+    backend = _FlakyBackend()
+    download = pipeline.DownloadPipeline(self.db_engine, None, backend=backend,
+                                         flush_seconds=0.01, index_interval=0.05)
+    download.start()
+    try:
+      self.assertEqual(download.store_messages(iter([_stamped(1), _stamped(2)])), 2)
+      self.assertTrue(backend.updated.wait(5))
+    finally:
+      download.stop()
+    self.assertGreaterEqual(backend.calls, 2)
+    self.assertEqual(download.stats[pipeline.STAGE_INDEX].items, 1)
+
+  def test_messages_are_stored(self):
+    download = pipeline.DownloadPipeline(self.db_engine, None, flush_seconds=0.01)
+    download.start()
+    download.store_messages(iter([_stamped(x) for x in range(5)]))
+    download.stop()
+    self.assertEqual(self.db_engine.conn().execute(
+      'SELECT count(*) FROM messagedata').scalar(), 5)
+
+  def test_write_error_is_reported(self):
+    self.db_engine.conn().execute('DROP TABLE messagedata')
+    download = pipeline.DownloadPipeline(self.db_engine, None, flush_seconds=0.01)
+    download.start()
+    download.store_messages(iter([_stamped(1)]))
+    deadline = time.monotonic() + 5
+    while not download.write_error and time.monotonic() < deadline:
+      time.sleep(0.01)
+    with self.assertRaises(RuntimeError):
+      download.check_stored()
+    with self.assertRaises(RuntimeError):
+      download.stop()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the queued SQLite writer thread
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine, select
+
+import storage
+
+
+class _UnreachableEngine:
+
+  def connect(self):
+    raise OSError('database is unreachable')
+
+
+class TestQueuedWriter(unittest.TestCase):
+
+  def setUp(self):
+    # A file, as every thread gets its own in-memory database
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.db_engine = create_engine(f"sqlite:///{Path(self.tmpdir.name) / 'writer.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def test_work_is_committed(self):
+    writer = storage.QueuedWriter(self.db_engine, queue_size=2)
+    futures = [writer.execute(storage.searchstate.insert(None),
+                              {'backend': f'b{i}', 'last_id': i}) for i in range(5)]
+    writer.flush()
+    writer.close()
+    self.assertEqual([x.result(timeout=5) for x in futures], [None] * 5)
+    self.assertEqual(self.db_engine.execute(
+      select([storage.searchstate.c.last_id])).fetchall(), [(i,) for i in range(5)])
+
+  def test_failing_work_only_fails_its_future(self):
+    writer = storage.QueuedWriter(self.db_engine)
+    good = writer.submit(lambda conn: 1)
+    bad = writer.submit(lambda conn: conn.execute('select * from no_such_table'))
+    writer.flush()
+    self.assertEqual(good.result(timeout=5), 1)
+    with self.assertRaises(Exception):
+      bad.result(timeout=5)
+    writer.close()
+
+  def test_failed_connect_fails_all_work(self):
+    writer = storage.QueuedWriter(_UnreachableEngine(), queue_size=1)
+    futures = []
+    for _ in range(3):
+      try:
+        futures.append(writer.submit(lambda conn: None))
+      except RuntimeError:
+        break
+    for future in futures:
+      with self.assertRaises(OSError):
+        future.result(timeout=5)
+    with self.assertRaises(RuntimeError):
+      writer.submit(lambda conn: None)
+    with self.assertRaises(RuntimeError):
+      writer.flush()
+    writer.close()
+
+  def test_closed_writer_rejects_work(self):
+    writer = storage.QueuedWriter(self.db_engine)
+    writer.close()
+    with self.assertRaises(RuntimeError):
+      writer.submit(lambda conn: None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the query translation of the database search backend
+"""
+
+import datetime
+import email.message
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+import search_backends
+import storage
+
+
+def _store_row(email_account, subject, body):
+  msg = email.message.EmailMessage()
+  msg['From'] = 'sender@example.com'
+  msg['To'] = email_account
+  msg['Subject'] = subject
+  msg['Message-ID'] = f'<{uuid.uuid4()}@example.com>'
+  msg.set_content(body)
+  return {'msg_uuid': str(uuid.uuid4()), 'email_account': email_account,
+          'msg_id': msg['Message-ID'], 'msg_ts': datetime.datetime(2021, 3, 1),
+          'msg_subj': subject, 'msg_from': msg['From'], 'msg_to': msg['To'],
+          'source': 'imap4', 'dnload_ts': datetime.datetime(2021, 3, 2),
+          'raw_data': msg.as_bytes(), 'gmail_data': None}
+
+
+class TestParsedQuery(unittest.TestCase):
+
+  def test_terms_and_fields(self):
+    parsed = search_backends._ParsedQuery('invoice subject:"march report"')
+    self.assertEqual(parsed.fts5_match(), '"invoice" msg_subj : "march report"')
+    self.assertEqual(parsed.websearch(), 'invoice "march report"')
+
+  def test_account_restriction_is_not_a_term(self):
+    parsed = search_backends._ParsedQuery('account:Alice@Example.com invoice')
+    self.assertEqual(parsed.accounts, ['alice@example.com'])
+    self.assertEqual(parsed.fts5_match(), '"invoice"')
+
+  def test_operators(self):
+    parsed = search_backends._ParsedQuery('ham OR eggs NOT spam')
+    self.assertEqual(parsed.fts5_match(), '"ham" OR "eggs" NOT "spam"')
+    self.assertEqual(parsed.websearch(), 'ham OR eggs -spam')
+    parsed = search_backends._ParsedQuery('ham AND eggs')
+    self.assertEqual(parsed.fts5_match(), '"ham" "eggs"')
+
+  def test_leading_not(self):
+    for query_string in ('NOT spam', 'account:x@example.com NOT spam'):
+      parsed = search_backends._ParsedQuery(query_string)
+      with self.assertRaises(RuntimeError):
+        parsed.fts5_match()
+      self.assertEqual(parsed.websearch(), '-spam')
+
+  def test_quotes_are_escaped(self):
+    parsed = search_backends._ParsedQuery('say"hi')
+    self.assertEqual(parsed.fts5_match(), '"say""hi"')
+
+  def test_unsupported_field(self):
+    with self.assertRaises(RuntimeError):
+      search_backends._ParsedQuery('date:2021')
+
+
+class TestDatabaseSearchSqlite(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.db_engine = create_engine(f"sqlite:///{Path(self.tmpdir.name) / 'search.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+    rows = [_store_row('a@example.com', 'Invoice March', 'Please pay the invoice'),
+            _store_row('a@example.com', 'Invoice April', 'Invoice, spam offer inside'),
+            _store_row('b@example.com', 'Lunch', 'Spam and eggs for lunch')]
+    self.uuids = [x['msg_uuid'] for x in rows]
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, rows)
+    self.backend = search_backends.DatabaseBackend(self.db_engine, text_workers=1)
+    self.backend.build(self.db_engine)
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def test_search(self):
+    self.assertEqual(sorted(self.backend.search_uuids('invoice')), sorted(self.uuids[:2]))
+    self.assertEqual(self.backend.search_uuids('invoice NOT spam'), [self.uuids[0]])
+    self.assertEqual(sorted(self.backend.search_uuids('spam')), sorted(self.uuids[1:]))
+    self.assertEqual(self.backend.search_uuids('account:b@example.com spam'),
+                     [self.uuids[2]])
+
+  def test_field_search(self):
+    self.assertEqual(self.backend.search_uuids('subject:lunch'), [self.uuids[2]])
+
+  def test_leading_not(self):
+    with self.assertRaises(RuntimeError):
+      self.backend.search_uuids('NOT spam')
+
+  def test_account_only(self):
+    self.assertEqual(sorted(self.backend.search_uuids('account:a@example.com')),
+                     sorted(self.uuids[:2]))
+    page = self.backend.search('account:B@example.com', highlight=True)
+    self.assertEqual((page.total, [x.msg_uuid for x in page.hits]), (1, [self.uuids[2]]))
+    self.assertEqual(self.backend.search_uuids(''), [])
+
+  def test_maintain_reports_stats(self):
+    report, = self.backend.maintain(optimize=True)
+    self.assertEqual(report['action'], 'optimize')
+    for stats in (report['before'], report['after']):
+      self.assertEqual(stats['doc_count'], len(self.uuids))
+      self.assertGreater(stats['pages'], 0)
+      self.assertGreater(stats['size_bytes'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the search service over a whoosh index
+"""
+
+import http.server
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+import search_service
+import searcher
+import storage
+from test_search_query import _store_row
+
+
+class TestSearchService(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.db_engine = create_engine(f"sqlite:///{Path(self.tmpdir.name) / 'service.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+    self.row = _store_row('a@example.com', 'Lunch', 'Spam and eggs for lunch')
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, [self.row])
+    self.index_root = Path(self.tmpdir.name) / 'index'
+    searcher.build_index_from_scratch(self.index_root, self.db_engine, text_workers=1)
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def test_body_is_highlighted(self):
+    service = search_service.SearchService(
+      self.index_root,
+      body_text_loader=lambda uuids: storage.body_text_by_uuid(self.db_engine, uuids))
+    try:
+      hit, = service.search('eggs', highlight=True)['hits']
+    finally:
+      service.close()
+    self.assertEqual(hit['msg_uuid'], self.row['msg_uuid'])
+    self.assertIn('eggs', hit['highlights']['msg_body'].lower())
+
+
+class _NotJSONHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self.send_response(502)
+    self.end_headers()
+    self.wfile.write(b'<html>Bad Gateway</html>')
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    pass
+
+
+class TestQueryService(unittest.TestCase):
+
+  def test_error_that_is_not_json(self):
+    server = http.server.HTTPServer(('127.0.0.1', 0), _NotJSONHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      with self.assertRaisesRegex(RuntimeError, '502'):
+        search_service.query_service('eggs', port=server.server_address[1])
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_no_service(self):
+    server = http.server.HTTPServer(('127.0.0.1', 0), _NotJSONHandler)
+    port = server.server_address[1]
+    server.server_close()
+    with self.assertRaises(ConnectionError):
+      search_service.query_service('eggs', port=port)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the search over an index sharded by account
+"""
+
+import datetime
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+import search_shards
+import storage
+from test_search_query import _store_row
+
+
+class TestShardedSearch(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    root = Path(self.tmpdir.name)
+    self.db_engine = create_engine(f"sqlite:///{root / 'shards.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+    rows = [_store_row('a@example.com', 'Report one', 'x'),
+            _store_row('b@example.com', 'Report two', 'x'),
+            _store_row('a@example.com', 'Report three', 'x'),
+            _store_row('b@example.com', 'Report four', 'x')]
+    # Message three has no date
+    for row, day in zip(rows, [5, 4, None, 6]):
+      row['msg_ts'] = datetime.datetime(2021, 3, day) if day else None
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, rows)
+    self.index_root = root / 'index'
+    search_shards.build_index(self.index_root, self.db_engine,
+                              shard_by=search_shards.SHARD_BY_ACCOUNT, text_workers=1)
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def subjects(self, sort_by):
+    page = search_shards.search(self.index_root, 'report', sort_by=sort_by)
+    return [x.msg_subj for x in page.hits]
+
+  def test_merge_by_date(self):
+    # As whoosh sorts a single index, a missing date comes first when newest first
+    self.assertEqual(self.subjects('date'),
+                     ['Report three', 'Report four', 'Report one', 'Report two'])
+
+  def test_merge_by_account(self):
+    self.assertEqual(self.subjects('account')[:2], ['Report one', 'Report three'])
+    self.assertEqual(set(self.subjects('account')[2:]), {'Report two', 'Report four'})
+
+  def test_account_query(self):
+    page = search_shards.search(self.index_root, 'report account:b@example.com')
+    self.assertEqual({x.msg_subj for x in page.hits}, {'Report two', 'Report four'})
+
+
+if __name__ == '__main__':
+  unittest.main()
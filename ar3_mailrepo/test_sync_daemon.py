@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the sync daemon resuming after failures, against the fake servers
+"""
+
+import datetime
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from googleapiclient.errors import HttpError
+from sqlalchemy import select
+
+import ar3_mailrepo_config
+import ar3_mailrepo_lib
+import fake_servers
+import pipeline
+import storage
+import sync_daemon
+
+EMAIL_ACCOUNT = 'sync@example.com'
+
+
+def _message(number):
+  date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=number)
+  return fake_servers.StoredMessage(
+    (f'Message-ID: <{number}@example.com>\r\n'
+     f'Date: {date.strftime("%a, %d %b %Y %H:%M:%S +0000")}\r\n'
+     f'From: sender@example.com\r\nTo: {EMAIL_ACCOUNT}\r\n'
+     f'Subject: Message {number}\r\n\r\nBody {number}\r\n').encode())
+
+
+class _SyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    app_config = ar3_mailrepo_config.AppConfig.from_dict({
+      'db_driver': 'sqlite',
+      'db_driver_credentials': {
+        'sqlite_file_path': str(Path(self.tmpdir.name) / 'sync.sqlite')},
+    })
+    self.db_engine = storage.DBEngine(app_config)
+    self.db_engine.populate_database()
+    self.options = app_config.sync_daemon_options()
+    self.pipeline = pipeline.DownloadPipeline(self.db_engine, None, flush_seconds=0.05)
+    self.pipeline.start()
+    self.pipeline_running = True
+    self.server = None
+
+  def tearDown(self):
+    if self.pipeline_running:
+      self.pipeline.stop()
+    self.db_engine.close()
+    if self.server:
+      self.server.stop()
+    self.tmpdir.cleanup()
+
+  def account_sync(self, sync_class):
+    credentials = self.server.connection_credentials(EMAIL_ACCOUNT)
+    account = sync_class(EMAIL_ACCOUNT, credentials, self.pipeline, self.db_engine,
+                         self.options, threading.Event())
+    account.svr_conn = ar3_mailrepo_lib.create_server_connection(credentials)
+    return account
+
+  def stored_ids(self):
+    # Stopping the pipeline stores what is queued
+    self.pipeline.stop()
+    self.pipeline_running = False
+    md = storage.messagedata
+    return sorted(x[0] for x in self.db_engine.conn().execute(select([md.c.msg_id])))
+
+
+class TestIMAPResume(_SyncTest):
+
+  def test_failed_fetch_is_retried(self):
+    self.server = fake_servers.FakeIMAPServer(
+      {'INBOX': [_message(x) for x in (3, 2, 1)]}).start()
+    account = self.account_sync(sync_daemon.IMAPAccountSync)
+    account.connected()
+    self.server.fail_fetch(2)
+    self.assertEqual(account.sync_folder('INBOX'), 1)
+    self.assertEqual(account.uid_state['INBOX'][1], 1)
+    self.assertEqual(account.sync_folder('INBOX'), 2)
+    self.assertEqual(account.uid_state['INBOX'][1], 3)
+    self.assertEqual(self.stored_ids(), ['<1@example.com>', '<2@example.com>',
+                                         '<3@example.com>'])
+
+  def test_failed_first_fetch_keeps_no_mark(self):
+    self.server = fake_servers.FakeIMAPServer({'INBOX': [_message(1)]}).start()
+    account = self.account_sync(sync_daemon.IMAPAccountSync)
+    account.connected()
+    self.server.fail_fetch(1)
+    self.assertEqual(account.sync_folder('INBOX'), 0)
+    self.assertNotIn('INBOX', account.uid_state)
+    self.assertEqual(account.sync_folder('INBOX'), 1)
+
+
+class TestGmailResume(_SyncTest):
+
+  def test_failed_full_sync_runs_again(self):
+    self.server = fake_servers.FakeGmailServer(
+      {'INBOX': [_message(x) for x in (1, 2, 3)]}).start()
+    account = self.account_sync(sync_daemon.GmailAccountSync)
+    self.server.fail_call('messages_list')
+    with self.assertRaises(HttpError):
+      account.connected()
+    self.assertIsNone(account.history_id)
+    account.connected()
+    self.assertEqual(account.history_id, '3')
+    self.assertEqual(len(self.stored_ids()), 3)
+
+  def test_history_sync_after_full_sync(self):
+    self.server = fake_servers.FakeGmailServer({'INBOX': [_message(1)]}).start()
+    account = self.account_sync(sync_daemon.GmailAccountSync)
+    account.connected()
+    self.server.add_message(_message(2))
+    self.options['gmail_poll_seconds'] = 0
+    account.sync_once()
+    self.assertEqual(account.history_id, '2')
+    self.assertEqual(len(self.stored_ids()), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the text cache and its invalidation when body_max_chars changes
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine, func, select
+
+import search_backends
+import storage
+import textextract
+from test_search_query import _store_row
+
+# 'ferret' is beyond the first 50 characters of the body
+BODY = 'The quarterly numbers are attached, see the notes. The ferret ate them.'
+
+
+class TestTextCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.db_engine = create_engine(f"sqlite:///{Path(self.tmpdir.name) / 'text.sqlite'}")
+    storage.metadata.create_all(self.db_engine)
+    self.row = _store_row('a@example.com', 'Numbers', BODY)
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, [self.row])
+
+  def tearDown(self):
+    self.db_engine.dispose()
+    self.tmpdir.cleanup()
+
+  def cached_length(self):
+    return self.db_engine.execute(
+      select([func.max(func.length(storage.messagetext.c.body_text))])).scalar()
+
+  def test_unchanged_limit_keeps_the_cache(self):
+    self.assertEqual(textextract.fill_text_cache(self.db_engine, workers=1), 1)
+    self.assertFalse(textextract.check_max_chars(self.db_engine, 20000))
+    self.assertEqual(textextract.fill_text_cache(self.db_engine, workers=1), 0)
+
+  def test_changed_limit_extracts_again(self):
+    textextract.fill_text_cache(self.db_engine, workers=1, max_chars=20000)
+    self.assertGreater(self.cached_length(), 50)
+    self.assertEqual(textextract.fill_text_cache(self.db_engine, workers=1, max_chars=50), 1)
+    self.assertEqual(self.cached_length(), 50)
+    with storage.unit_of_work(self.db_engine) as conn:
+      self.assertEqual(storage.load_setting(conn, textextract.MAX_CHARS_SETTING), 50)
+
+  def test_database_index_is_rebuilt(self):
+    search_backends.DatabaseBackend(self.db_engine, text_workers=1).build(self.db_engine)
+    backend = search_backends.DatabaseBackend(self.db_engine, text_workers=1,
+                                              body_max_chars=50)
+    self.assertEqual(backend.search_uuids('ferret'), [self.row['msg_uuid']])
+    self.assertEqual(backend.update(self.db_engine), 1)
+    self.assertEqual(backend.search_uuids('ferret'), [])
+    self.assertEqual(backend.search_uuids('quarterly'), [self.row['msg_uuid']])
+    self.assertEqual(backend.update(self.db_engine), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
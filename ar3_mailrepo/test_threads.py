@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Unit Tests of the conversation thread index
+"""
+
+import datetime
+import gzip
+import json
+import unittest
+
+from sqlalchemy import create_engine, select
+
+import storage
+import threads
+
+
+def _raw(message_id, references=None, in_reply_to=None):
+  headers = [f'Message-ID: <{message_id}>']
+  if references:
+    headers.append('References: ' + ' '.join(f'<{x}>' for x in references))
+  if in_reply_to:
+    headers.append(f'In-Reply-To: <{in_reply_to}>')
+  return ('\r\n'.join(headers) + '\r\n\r\nbody\r\n').encode()
+
+
+def _gmail_data(thread_id, padding=0):
+  # As stored by storage.msgdata_from_message; padding puts threadId further back
+  return gzip.compress(json.dumps({'raw': 'x' * padding, 'id': 'm',
+                                   'threadId': thread_id}).encode())
+
+
+class TestThreadHeaders(unittest.TestCase):
+
+  def test_references_give_the_ancestors(self):
+    own_key, ancestors = threads.parse_thread_headers(_raw('c@x', references=['a@x', 'b@x'],
+                                                           in_reply_to='b@x'))
+    self.assertEqual(own_key, threads.message_key('c@x'))
+    self.assertEqual(ancestors, [threads.message_key('a@x'), threads.message_key('b@x')])
+
+  def test_in_reply_to_without_references(self):
+    _, ancestors = threads.parse_thread_headers(_raw('c@x', in_reply_to='b@x'))
+    self.assertEqual(ancestors, [threads.message_key('b@x')])
+
+  def test_no_headers(self):
+    self.assertEqual(threads.parse_thread_headers(None), (None, []))
+
+  def test_base_subject(self):
+    self.assertEqual(threads.base_subject('Re: AW: Fwd:  Quarterly\n  report'),
+                     'Quarterly report')
+    self.assertIsNone(threads.base_subject('Re:'))
+
+  def test_gmail_thread_id(self):
+    self.assertEqual(threads.gmail_thread_id(_gmail_data('17a')), '17a')
+    self.assertEqual(threads.gmail_thread_id(_gmail_data('17b', padding=20000)), '17b')
+    self.assertIsNone(threads.gmail_thread_id(None))
+    self.assertIsNone(threads.gmail_thread_id(b'not gzip'))
+
+
+class TestThreading(unittest.TestCase):
+
+  def setUp(self):
+    self.db_engine = create_engine('sqlite://')
+    storage.metadata.create_all(self.db_engine)
+    self.next_day = 1
+
+  def store(self, message_id, subject, email_account='a@example.com', references=None,
+            in_reply_to=None, gmail_thread=None, day=None):
+    """
+    Stores a message through the ingest path. Returns its messagedata id
+    """
+    day = day or self.next_day
+    self.next_day = day + 1
+    row = {'msg_uuid': f'uuid-{email_account}-{message_id}', 'email_account': email_account,
+           'msg_id': message_id, 'msg_ts': datetime.datetime(2021, 1, day),
+           'msg_subj': subject, 'msg_from': 'x@example.com', 'msg_to': email_account,
+           'source': 'gmail' if gmail_thread else 'imap4', 'dnload_ts': None,
+           'raw_data': _raw(message_id, references, in_reply_to),
+           'gmail_data': _gmail_data(gmail_thread) if gmail_thread else None}
+    with storage.unit_of_work(self.db_engine) as conn:
+      storage.insert_message_batch(conn, [row])
+    return self.db_engine.execute(select([storage.messagedata.c.id]).where(
+      storage.messagedata.c.msg_uuid == row['msg_uuid'])).scalar()
+
+  def thread_rows(self):
+    return [dict(x) for x in self.db_engine.execute(
+      storage.thread.select().order_by(storage.thread.c.id)).fetchall()]
+
+  def test_reply_chain(self):
+    root = self.store('a@x', 'Plans')
+    reply = self.store('b@x', 'Re: Plans', references=['a@x'])
+    reply2 = self.store('c@x', 'Re: Re: Plans', references=['a@x', 'b@x'])
+    messages = threads.conversation(self.db_engine, msg_uuid='uuid-a@example.com-c@x')
+    self.assertEqual([(x['id'], x['parent_id'], x['depth']) for x in messages],
+                     [(root, None, 0), (reply, root, 1), (reply2, reply, 2)])
+    thread, = self.thread_rows()
+    self.assertEqual((thread['message_count'], thread['subject']), (3, 'Plans'))
+    self.assertEqual(thread['first_ts'], datetime.datetime(2021, 1, 1))
+    self.assertEqual(thread['last_ts'], datetime.datetime(2021, 1, 3))
+
+  def test_replies_stored_before_the_parent_are_adopted(self):
+    reply2 = self.store('c@x', 'Re: Plans', references=['a@x', 'b@x'], day=3)
+    reply = self.store('b@x', 'Re: Plans', references=['a@x'], day=2)
+    root = self.store('a@x', 'Plans', day=1)
+    parents = {x['id']: x['parent_id'] for x in
+               threads.conversation(self.db_engine, thread_id=self.thread_rows()[0]['id'])}
+    self.assertEqual(parents, {root: None, reply: root, reply2: reply})
+    thread, = self.thread_rows()
+    self.assertEqual((thread['message_count'], thread['subject']), (3, 'Plans'))
+
+  def test_missing_parent_points_to_the_nearest_stored_ancestor(self):
+    root = self.store('a@x', 'Plans')
+    reply2 = self.store('c@x', 'Re: Plans', references=['a@x', 'b@x'])
+    parents = {x['id']: x['parent_id'] for x in
+               threads.conversation(self.db_engine, thread_id=self.thread_rows()[0]['id'])}
+    self.assertEqual(parents[reply2], root)
+    reply = self.store('b@x', 'Re: Plans', references=['a@x'])
+    parents = {x['id']: x['parent_id'] for x in
+               threads.conversation(self.db_engine, thread_id=self.thread_rows()[0]['id'])}
+    self.assertEqual(parents[reply2], reply)
+
+  def test_message_joining_two_threads_merges_them(self):
+    self.store('a@x', 'First', day=1)
+    self.store('b@x', 'Second', day=2)
+    self.assertEqual(len(self.thread_rows()), 2)
+    self.store('c@x', 'Re: Second', references=['a@x', 'b@x'], day=3)
+    thread, = self.thread_rows()
+    self.assertEqual((thread['message_count'], thread['subject']), (3, 'First'))
+    keys = self.db_engine.execute(select([storage.threadkey.c.thread_id]).distinct()) \
+      .fetchall()
+    self.assertEqual(keys, [(thread['id'],)])
+
+  def test_accounts_are_threaded_apart(self):
+    self.store('a@x', 'Plans', email_account='a@example.com')
+    self.store('b@x', 'Re: Plans', email_account='b@example.com', references=['a@x'])
+    self.assertEqual(len(self.thread_rows()), 2)
+
+  def test_gmail_messages_follow_the_thread_id(self):
+    self.store('a@x', 'Plans', gmail_thread='t1')
+    self.store('b@x', 'Re: Plans', gmail_thread='t1', in_reply_to='a@x')
+    self.store('c@x', 'Re: Plans', gmail_thread='t2', in_reply_to='a@x')
+    rows = self.thread_rows()
+    self.assertEqual([(x['gmail_thread_id'], x['message_count']) for x in rows],
+                     [('t1', 2), ('t2', 1)])
+    messages = threads.conversation(self.db_engine, thread_id=rows[0]['id'])
+    self.assertEqual(messages[1]['parent_id'], messages[0]['id'])
+
+  def test_threads_by_last_activity(self):
+    self.store('a@x', 'Old', day=1)
+    self.store('b@x', 'New', day=5)
+    self.store('c@x', 'Re: Old', references=['a@x'], day=9)
+    self.assertEqual([x['subject'] for x in threads.threads_by_last_activity(
+      self.db_engine, 'a@example.com')], ['Old', 'New'])
+    self.assertEqual([x['subject'] for x in threads.threads_by_last_activity(
+      self.db_engine, 'a@example.com', limit=1, offset=1)], ['New'])
+
+  def test_backfill_matches_ingest(self):
+    self.store('a@x', 'Plans')
+    self.store('b@x', 'Re: Plans', references=['a@x'])
+    self.store('c@x', 'Other')
+    before = threads.conversation(self.db_engine, msg_uuid='uuid-a@example.com-b@x')
+    self.assertEqual(threads.backfill(self.db_engine), 0)
+    for table in (storage.thread, storage.messagethread, storage.threadkey):
+      self.db_engine.execute(table.delete())
+    self.assertEqual(threads.backfill(self.db_engine), 3)
+    self.assertEqual(threads.conversation(self.db_engine, msg_uuid='uuid-a@example.com-b@x'),
+                     before)
+    self.assertEqual(len(self.thread_rows()), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Extraction of searchable body text and attachment names from raw messages,
+cached in the messagetext table so that reindexing does not parse MIME again
+"""
+
+import collections
+import concurrent.futures
+import email
+import email.policy
+import html.parser
+import logging
+import os
+import time
+
+import sqlalchemy
+
+import metrics
+import storage
+
+logger = logging.getLogger('ar3_mailrepo.textextract')
+
+# Setting holding the body_max_chars the text cache was extracted with
+MAX_CHARS_SETTING = 'messagetext_max_chars'
+
+
+class _HTMLTextExtractor(html.parser.HTMLParser):
+
+  """
+  Collects the text content of an HTML document, without scripts and styles
+  """
+
+  SKIP_TAGS = {'script', 'style', 'head'}
+
+  def __init__(self):
+    super(_HTMLTextExtractor, self).__init__(convert_charrefs=True)
+    self.parts = []
+    self._skip_depth = 0
+
+  def handle_starttag(self, tag, attrs):
+    if tag in self.SKIP_TAGS:
+      self._skip_depth += 1
+
+  def handle_endtag(self, tag):
+    if tag in self.SKIP_TAGS and self._skip_depth > 0:
+      self._skip_depth -= 1
+
+  def handle_data(self, data):
+    if not self._skip_depth:
+      self.parts.append(data)
+
+
+def html_to_text(html_str: str):
+  extractor = _HTMLTextExtractor()
+  try:
+    extractor.feed(html_str)
+    extractor.close()
+  except Exception:  # pylint: disable=broad-except
+    pass
+  return ' '.join(' '.join(extractor.parts).split())
+
+
+def _part_text(part):
+  try:
+    return part.get_content()
+  except Exception:  # pylint: disable=broad-except
+    # Unknown charsets and broken transfer encodings
+    payload = part.get_payload(decode=True) or b''
+    return payload.decode('utf-8', errors='replace')
+
+
+def extract_text(raw_data: bytes, max_chars: int):
+  """
+  Returns (body_text, attachment_names) of a raw message. The body is the text/plain
+  parts, or the HTML parts converted to text if there is no plain text, truncated
+  to max_chars
+  """
+  if not raw_data:
+    return '', ''
+  msg = email.message_from_bytes(raw_data, policy=email.policy.default)
+  plain_parts = []
+  html_parts = []
+  attachment_names = []
+  for part in msg.walk():
+    if part.is_multipart():
+      continue
+    filename = part.get_filename()
+    if filename:
+      attachment_names.append(str(filename))
+      continue
+    content_type = part.get_content_type()
+    if content_type == 'text/plain':
+      plain_parts.append(_part_text(part))
+    elif content_type == 'text/html':
+      html_parts.append(_part_text(part))
+  if plain_parts:
+    body_text = '\n'.join(plain_parts)
+  else:
+    body_text = '\n'.join(html_to_text(x) for x in html_parts)
+  return body_text[:max_chars].replace('\x00', ''), ' '.join(attachment_names)
+
+
+def extract_batch(rows, max_chars):
+  # Runs in the worker processes
+  results = []
+  for msg_id, raw_data in rows:
+    try:
+      body_text, attachment_names = extract_text(raw_data, max_chars)
+    except Exception as e:  # pylint: disable=broad-except
+      logger.error(f'Text extraction failed for message id {msg_id}: {e}')
+      body_text, attachment_names = '', ''
+    results.append({'message_id': msg_id, 'body_text': body_text,
+                    'attachment_names': attachment_names})
+  return results
+
+
+def _rows_without_text(dbconn, after_id, batch_size):
+  md = storage.messagedata
+  mt = storage.messagetext
+  smt = sqlalchemy.select([md.c.id, md.c.raw_data]).select_from(
+    md.outerjoin(mt, mt.c.message_id == md.c.id)).where(
+    sqlalchemy.and_(md.c.id > after_id, mt.c.message_id.is_(None))).order_by(md.c.id)
+  result = dbconn.execution_options(stream_results=True).execute(smt)
+  try:
+    while True:
+      rows = result.fetchmany(batch_size)
+      if not rows:
+        break
+      yield [(x[0], x[1]) for x in rows]
+  finally:
+    result.close()
+
+
+def check_max_chars(dbconn, max_chars: int):
+  """
+  Records the body length limit of the text cache. If the cache was extracted with
+  another limit it is cleared, and True is returned: search indexes built from it
+  must then be rebuilt. A cache from before the limit was recorded is taken to match
+  """
+  with storage.unit_of_work(dbconn) as conn:
+    cached_max_chars = storage.load_setting(conn, MAX_CHARS_SETTING)
+    if cached_max_chars == max_chars:
+      return False
+    storage.save_setting(conn, MAX_CHARS_SETTING, max_chars)
+    if cached_max_chars is None:
+      return False
+    logger.warning(f'The text cache was extracted with body_max_chars '
+                   f'{cached_max_chars}, extracting it again with {max_chars} and '
+                   f'rebuilding the search index')
+    conn.execute(storage.messagetext.delete())
+    return True
+
+
+def fill_text_cache(dbconn, after_id=0, workers=None, max_chars=20000, batch_size=200):
+  """
+  Extracts the text of all messages above after_id that are not in messagetext yet,
+  in a pool of worker processes. All messages are extracted again if max_chars
+  differs from the limit of the cache, see check_max_chars. Returns the number of
+  messages extracted
+  """
+  if check_max_chars(dbconn, max_chars):
+    after_id = 0
+  start = time.perf_counter()
+  count = 0
+  in_flight = collections.deque()
+
+  def store(future):
+    nonlocal count
+    results = future.result()
+    with storage.unit_of_work(dbconn) as conn:
+      conn.execute(storage.messagetext.insert(None), results)
+    count += len(results)
+    metrics.counter('ar3mr_text_extracted_total').inc(len(results))
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    max_in_flight = (workers or os.cpu_count()) * 2
+    for rows in _rows_without_text(dbconn, after_id, batch_size):
+      in_flight.append(pool.submit(extract_batch, rows, max_chars))
+      # Results are stored in submission order, which bounds memory to the
+      # batches in flight
+      while len(in_flight) >= max_in_flight:
+        store(in_flight.popleft())
+    while in_flight:
+      store(in_flight.popleft())
+  if count:
+    elapsed = time.perf_counter() - start
+    logger.debug(f'Extracted text of {count} message(s) in {elapsed:.1f}s, '
+                 f'{count / max(elapsed, 1e-6):.0f} msgs/s')
+  return count
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Conversation threads of the stored messages, kept in the thread, messagethread and
+threadkey tables so that a conversation or the latest threads are an indexed lookup
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import re
+import zlib
+
+from sqlalchemy import and_, bindparam, exists, func, select, util
+
+import addresses
+import storage
+import util_logger
+
+logger = logging.getLogger('ar3_mailrepo.threads')
+
+_MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+_SUBJECT_PREFIX = re.compile(r'^(\s*(re|fwd?|aw|wg|sv|antw)\s*(\[\d+\])?\s*:)+', re.IGNORECASE)
+_GMAIL_THREAD_ID = re.compile(rb'"threadId":\s*"([^"]+)"')
+
+# threadId comes before the raw message in the stored Gmail JSON, so usually only
+# the start of gmail_data needs to be decompressed
+_GMAIL_PREFIX_BYTES = 4096
+
+
+def message_key(message_id: str):
+  return hashlib.sha1(message_id.encode('utf-8', 'replace')).hexdigest()
+
+
+def base_subject(subject):
+  """
+  Subject without the Re: / Fwd: prefixes of replies and forwards
+  """
+  return ' '.join(_SUBJECT_PREFIX.sub('', subject or '').split()) or None
+
+
+def _message_ids(value):
+  if not value:
+    return []
+  value = str(value)
+  found = _MESSAGE_ID.findall(value)
+  return found if found else [x.strip('<>') for x in value.split() if x.strip('<>')]
+
+
+def parse_thread_headers(raw_data: bytes):
+  """
+  Returns (key of the Message-ID, [keys of the ancestors]) of a raw message. The
+  ancestors are the References, oldest first, or else the first In-Reply-To, so the
+  last one is the parent
+  """
+  if not raw_data:
+    return None, []
+  headers = addresses.parse_headers(raw_data)
+  own = _message_ids(headers.get('Message-ID'))
+  own_key = message_key(own[0]) if own else None
+  references = _message_ids(headers.get('References')) or \
+               _message_ids(headers.get('In-Reply-To'))[:1]
+  ancestors = []
+  for msg_key in (message_key(x) for x in references):
+    if msg_key != own_key and msg_key not in ancestors:
+      ancestors.append(msg_key)
+  return own_key, ancestors
+
+
+def gmail_thread_id(gmail_data: bytes):
+  """
+  threadId from the gzip compressed Gmail JSON of messagedata.gmail_data
+  """
+  if not gmail_data:
+    return None
+  try:
+    prefix = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(
+      gmail_data, _GMAIL_PREFIX_BYTES)
+  except zlib.error:
+    return None
+  match = _GMAIL_THREAD_ID.search(prefix)
+  if match:
+    return match.group(1).decode('ascii', 'replace')
+  try:
+    return json.loads(gzip.decompress(gmail_data)).get('threadId')
+  except (OSError, ValueError, AttributeError):
+    return None
+
+
+def _thread_statements():
+  t = storage.thread
+  mt = storage.messagethread
+  tk = storage.threadkey
+  return {
+    'gmail_thread': select([t.c.id]).where(and_(
+      t.c.email_account == bindparam('email_account'),
+      t.c.gmail_thread_id == bindparam('gmail_thread_id'))).order_by(t.c.id).limit(1),
+    'thread_keys': select([tk.c.msg_key, tk.c.thread_id]).where(and_(
+      tk.c.email_account == bindparam('email_account'),
+      tk.c.msg_key.in_(bindparam('msg_keys', expanding=True)))),
+    'ancestors': select([mt.c.message_id, mt.c.msg_key]).where(and_(
+      mt.c.thread_id == bindparam('thread'),
+      mt.c.msg_key.in_(bindparam('msg_keys', expanding=True)))),
+    'adopt_children': mt.update().where(and_(
+      mt.c.thread_id == bindparam('thread'), mt.c.parent_key == bindparam('parent'),
+      mt.c.message_id != bindparam('message'))).values(parent_id=bindparam('message')),
+    'new_thread': t.insert(None),
+    'new_keys': tk.insert(None),
+    'new_message': mt.insert(None),
+    'update_thread': t.update().where(t.c.id == bindparam('thread')),
+    'thread_stats': select([
+      mt.c.thread_id, func.count().label('message_count'),
+      func.min(mt.c.msg_ts).label('first_ts'), func.max(mt.c.msg_ts).label('last_ts')])
+      .where(mt.c.thread_id.in_(bindparam('threads', expanding=True)))
+      .group_by(mt.c.thread_id),
+  }
+
+
+_statements = _thread_statements()
+
+# Compiled forms of the statements above. Threading runs several small statements per
+# message, where compiling them again each time would cost more than executing them
+_compiled_cache = util.LRUCache(100)
+
+
+class _BatchThreader:
+  """
+  Adds the messages of one batch to their threads, on one connection
+  """
+
+  def __init__(self, conn):
+    self.conn = conn.execution_options(compiled_cache=_compiled_cache)
+    # Thread id: (msg_ts, base subject) of its oldest new message
+    self.touched = {}
+    self.gmail_threads = {}
+
+  def _new_thread(self, email_account, gmail_id, subject):
+    result = self.conn.execute(_statements['new_thread'], {
+      'email_account': email_account, 'gmail_thread_id': gmail_id,
+      'subject': subject, 'message_count': 0})
+    return result.inserted_primary_key[0]
+
+  def _gmail_thread(self, email_account, gmail_id, subject):
+    cache_key = (email_account, gmail_id)
+    if cache_key not in self.gmail_threads:
+      row = self.conn.execute(_statements['gmail_thread'], {
+        'email_account': email_account, 'gmail_thread_id': gmail_id}).fetchone()
+      self.gmail_threads[cache_key] = row['id'] if row else \
+        self._new_thread(email_account, gmail_id, subject)
+    return self.gmail_threads[cache_key]
+
+  def _merge(self, keep, others):
+    mt = storage.messagethread
+    tk = storage.threadkey
+    t = storage.thread
+    # The merged thread keeps the subject of the thread with the oldest message
+    oldest = self.conn.execute(select([t.c.subject]).where(and_(
+      t.c.id.in_([keep] + others), t.c.first_ts.isnot(None))).order_by(
+      t.c.first_ts).limit(1)).fetchone()
+    if oldest:
+      self.conn.execute(t.update().where(t.c.id == keep).values(subject=oldest['subject']))
+    self.conn.execute(mt.update().where(mt.c.thread_id.in_(others)).values(thread_id=keep))
+    self.conn.execute(tk.update().where(tk.c.thread_id.in_(others)).values(thread_id=keep))
+    self.conn.execute(t.delete().where(t.c.id.in_(others)))
+    for other in others:
+      self._touch(keep, *self.touched.pop(other, (None, None)))
+
+  def _thread_keys(self, email_account, msg_keys):
+    if not msg_keys:
+      return {}
+    return {x['msg_key']: x['thread_id'] for x in self.conn.execute(
+      _statements['thread_keys'], {'email_account': email_account,
+                                   'msg_keys': msg_keys}).fetchall()}
+
+  def _header_thread(self, email_account, found, subject):
+    if not found:
+      return self._new_thread(email_account, None, subject)
+    thread_ids = sorted(set(found.values()))
+    if len(thread_ids) > 1:
+      # The message connects conversations that were threaded apart so far
+      self._merge(thread_ids[0], thread_ids[1:])
+    return thread_ids[0]
+
+  def _parent_id(self, thread_id, ancestors):
+    # The nearest stored ancestor, so a missing parent does not cut the thread apart.
+    # Once the parent itself is stored, it takes over as parent, see add
+    rows = self.conn.execute(_statements['ancestors'], {
+      'thread': thread_id, 'msg_keys': ancestors}).fetchall()
+    stored = {x['msg_key']: x['message_id'] for x in rows}
+    for msg_key in reversed(ancestors):
+      if msg_key in stored:
+        return stored[msg_key]
+    return None
+
+  def _touch(self, thread_id, msg_ts, subject):
+    oldest = self.touched.get(thread_id)
+    if oldest is None or oldest[0] is None or (msg_ts is not None and msg_ts < oldest[0]):
+      self.touched[thread_id] = (msg_ts, subject)
+
+  def add(self, msg):
+    email_account = msg['email_account']
+    own_key, ancestors = parse_thread_headers(msg['raw_data'])
+    msg_keys = ([own_key] if own_key else []) + ancestors
+    subject = base_subject(msg['msg_subj'])
+    # Message-IDs not in threadkey yet cannot belong to a stored message or reply
+    found = self._thread_keys(email_account, msg_keys)
+    gmail_id = gmail_thread_id(msg['gmail_data'])
+    if gmail_id:
+      thread_id = self._gmail_thread(email_account, gmail_id, subject)
+    else:
+      thread_id = self._header_thread(email_account, found, subject)
+    missing = [x for x in msg_keys if x not in found]
+    if missing:
+      self.conn.execute(_statements['new_keys'], [
+        {'email_account': email_account, 'msg_key': x, 'thread_id': thread_id}
+        for x in missing])
+    parent_id = None
+    if any(x in found for x in ancestors):
+      parent_id = self._parent_id(thread_id, ancestors)
+    self.conn.execute(_statements['new_message'], {
+      'message_id': msg['id'], 'thread_id': thread_id, 'parent_id': parent_id,
+      'msg_key': own_key, 'parent_key': ancestors[-1] if ancestors else None,
+      'msg_ts': msg['msg_ts']})
+    if own_key in found:
+      # Replies stored before this message now get it as their parent
+      self.conn.execute(_statements['adopt_children'], {
+        'thread': thread_id, 'parent': own_key, 'message': msg['id']})
+    self._touch(thread_id, msg['msg_ts'], subject)
+
+  def update_threads(self):
+    """
+    Message counts and first and last activity of the threads of the batch. The
+    subject is that of the oldest message
+    """
+    thread_ids = list(self.touched)
+    for start in range(0, len(thread_ids), storage.UUID_QUERY_CHUNK):
+      rows = self.conn.execute(_statements['thread_stats'], {
+        'threads': thread_ids[start:start + storage.UUID_QUERY_CHUNK]}).fetchall()
+      for row in rows:
+        values = {'thread': row['thread_id'], 'message_count': row['message_count'],
+                  'first_ts': row['first_ts'], 'last_ts': row['last_ts']}
+        msg_ts, subject = self.touched[row['thread_id']]
+        if msg_ts is not None and msg_ts == row['first_ts'] and subject:
+          values['subject'] = subject
+        self.conn.execute(_statements['update_thread'], values)
+
+
+def _sort_key(msg):
+  return msg['msg_ts'] is None, msg['msg_ts'] or datetime.datetime.min, msg['id']
+
+
+def thread_messages(conn, messages):
+  """
+  Adds messages, given as dicts of the messagedata id, email_account, msg_ts,
+  msg_subj, raw_data and gmail_data, to their threads. Gmail messages are threaded
+  by their threadId, all others by the Message-ID, In-Reply-To and References headers
+  """
+  threader = _BatchThreader(conn)
+  for msg in sorted(messages, key=_sort_key):
+    threader.add(msg)
+  threader.update_threads()
+  return len(messages)
+
+
+def _not_threaded():
+  return ~exists().where(storage.messagethread.c.message_id == storage.messagedata.c.id)
+
+
+def thread_inserted_messages(conn, store_list):
+  """
+  Ingest hook, see storage.insert_message_batch: threads the messages just inserted,
+  in the same transaction
+  """
+  md = storage.messagedata
+  msg_by_uuid = {x['msg_uuid']: x for x in store_list}
+  rows = conn.execute(select([md.c.id, md.c.msg_uuid]).where(and_(
+    md.c.msg_uuid.in_(list(msg_by_uuid)), _not_threaded()))).fetchall()
+  if rows:
+    thread_messages(conn, [dict(msg_by_uuid[x['msg_uuid']], id=x['id']) for x in rows])
+
+
+def backfill(dbconn, batch_size=200):
+  """
+  Threads the messages stored before the thread tables existed. Can be re-run,
+  threaded messages are skipped. Returns the number of messages read
+  """
+  md = storage.messagedata
+  progress = util_logger.ProgressReporter(logger, 'Threading messages')
+  after_id = 0
+  while True:
+    rows = dbconn.execute(select([
+      md.c.id, md.c.email_account, md.c.msg_ts, md.c.msg_subj, md.c.raw_data,
+      md.c.gmail_data]).where(and_(md.c.id > after_id, _not_threaded()))
+                          .order_by(md.c.id).limit(batch_size)).fetchall()
+    if not rows:
+      break
+    with storage.unit_of_work(dbconn) as conn:
+      thread_messages(conn, [dict(x) for x in rows])
+    after_id = rows[-1]['id']
+    progress.update(len(rows))
+  progress.done()
+  logger.debug(f'Threaded {progress.count} message(s)')
+  return progress.count
+
+
+def _with_depth(messages):
+  parents = {x['id']: x['parent_id'] for x in messages}
+  depths = {}
+
+  def depth(msg_id):
+    seen = set()
+    chain = []
+    while msg_id in parents and msg_id not in depths and msg_id not in seen:
+      seen.add(msg_id)
+      chain.append(msg_id)
+      msg_id = parents[msg_id]
+    level = depths.get(msg_id, -1)
+    for item in reversed(chain):
+      level += 1
+      depths[item] = level
+    return depths[chain[0]] if chain else depths[msg_id]
+
+  for msg in messages:
+    msg['depth'] = depth(msg['id'])
+  return messages
+
+
+def conversation(dbconn, thread_id=None, msg_uuid=None):
+  """
+  Messages of a thread, given by its id or by the msg_uuid of one of its messages,
+  oldest first. Dicts of the messagedata id, msg_uuid, msg_ts, msg_from, msg_subj,
+  parent_id and depth in the reply tree
+  """
+  md = storage.messagedata
+  mt = storage.messagethread
+  if thread_id is None:
+    thread_id = select([mt.c.thread_id]).select_from(
+      md.join(mt, mt.c.message_id == md.c.id)).where(
+      md.c.msg_uuid == msg_uuid).as_scalar()
+  smt = select([md.c.id, md.c.msg_uuid, md.c.msg_ts, md.c.msg_from, md.c.msg_subj,
+                mt.c.parent_id]).select_from(mt.join(md, md.c.id == mt.c.message_id)) \
+    .where(mt.c.thread_id == thread_id).order_by(mt.c.msg_ts, mt.c.message_id)
+  return _with_depth([dict(x) for x in dbconn.execute(smt).fetchall()])
+
+
+def threads_by_last_activity(dbconn, email_account=None, limit=20, offset=0):
+  """
+  Threads with the latest message first, as dicts of the thread columns
+  """
+  t = storage.thread
+  smt = select([t])
+  if email_account:
+    smt = smt.where(t.c.email_account == email_account)
+  smt = smt.order_by(t.c.last_ts.desc(), t.c.id.desc()).limit(limit).offset(offset)
+  return [dict(x) for x in dbconn.execute(smt).fetchall()]
@@ -21,6 +21,7 @@ Utility functions to operate mail repo
 """
 import collections
 import json
+import re
 import uuid
 from pathlib import Path
 
@@ -76,11 +77,21 @@ def list_avilable_cache_data_for_email(datacache_root_path: Path, emaillabel: st
     yield datafolder.name
 
 
-def safe_create_path(create_root_path: Path, new_stem: Path):
+def safe_folder_name(name: str):
+  # Only characters that are valid in a file name everywhere, no path separators
+  return re.sub(r'[^A-Za-z0-9@._-]', '_', name).strip('.') or '_'
+
+
+def safe_new_path(create_root_path: Path, new_stem: Path):
   cnt = 0
   test_stem = new_stem
   while (Path(create_root_path / test_stem)).exists():
     cnt += 1
     test_stem = Path(f'{new_stem}({cnt})')
-  Path(create_root_path / test_stem).mkdir(parents=True)
   return Path(create_root_path / test_stem)
+
+
+def safe_create_path(create_root_path: Path, new_stem: Path):
+  new_path = safe_new_path(create_root_path, new_stem)
+  new_path.mkdir(parents=True)
+  return new_path
@@ -20,15 +20,46 @@
 Logging Utilities
 """
 
+import atexit
 import logging
 import logging.handlers
+import os
 import platform
+import queue
 import sys
+import time
 
+_listener = None
 
-def apply_logger_handler(screenoutput=True):
+
+class _ProcessLocalQueueHandler(logging.handlers.QueueHandler):
+  """
+  Queues records for the listener thread. Forked worker processes have no listener,
+  so there the records go to the handlers directly
+  """
+
+  def __init__(self, log_queue, handlers):
+    super(_ProcessLocalQueueHandler, self).__init__(log_queue)
+    self.pid = os.getpid()
+    self.direct_handlers = handlers
+
+  def emit(self, record):
+    if os.getpid() == self.pid:
+      super(_ProcessLocalQueueHandler, self).emit(record)
+      return
+    for handler in self.direct_handlers:
+      if record.levelno >= handler.level:
+        handler.handle(record)
+
+
+def apply_logger_handler(screenoutput=True, level=logging.DEBUG, queued=True):
+  """
+  With queued, records are written by a background thread, so the file and screen
+  output do not hold up download and ingest loops. Queued records are flushed at exit
+  """
+  global _listener  # pylint: disable=global-statement
   logger = logging.getLogger('ar3_mailrepo')
-  logger.setLevel(logging.DEBUG)
+  logger.setLevel(level)
 
   fulllogfilename = 'ar3_mailrepo.log'
 
@@ -43,9 +74,70 @@ def apply_logger_handler(screenoutput=True):
   generalformatter = logging.Formatter(
     '%(asctime)s [%(levelname)s:%(name)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
   filehandler.setFormatter(generalformatter)
-  logger.addHandler(filehandler)
+  handlers = [filehandler]
 
   if screenoutput:
     screenhandler = logging.StreamHandler(sys.stdout)
     screenhandler.setFormatter(generalformatter)
-    logger.addHandler(screenhandler)
+    handlers.append(screenhandler)
+
+  if not queued:
+    for handler in handlers:
+      logger.addHandler(handler)
+    return
+
+  log_queue = queue.SimpleQueue()
+  logger.addHandler(_ProcessLocalQueueHandler(log_queue, handlers))
+  _listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                             respect_handler_level=True)
+  _listener.start()
+  atexit.register(stop_logging)
+
+
+def stop_logging():
+  """
+  Writes out the queued records and stops the background thread
+  """
+  global _listener  # pylint: disable=global-statement
+  if _listener is not None:
+    _listener.stop()
+    _listener = None
+
+
+class ProgressReporter:
+  """
+  Logs the progress of a loop at most every interval seconds, instead of a line
+  per item
+  """
+
+  def __init__(self, logger: logging.Logger, description: str, total=None,
+               interval=5.0, level=logging.INFO):
+    self.logger = logger
+    self.description = description
+    self.total = total
+    self.interval = interval
+    self.level = level
+    self.count = 0
+    self._start = time.monotonic()
+    self._next_report = self._start + interval
+
+  def _report(self, now: float):
+    rate = self.count / max(now - self._start, 1e-9)
+    of_total = f'/{self.total}' if self.total is not None else ''
+    self.logger.log(self.level, '%s: %d%s (%.1f/s)', self.description, self.count,
+                    of_total, rate)
+
+  def update(self, count=1):
+    self.count += count
+    now = time.monotonic()
+    if now >= self._next_report:
+      self._next_report = now + self.interval
+      self._report(now)
+
+  def done(self):
+    """
+    Logs the final count, if the loop ran long enough to report progress
+    """
+    now = time.monotonic()
+    if now - self._start >= self.interval:
+      self._report(now)
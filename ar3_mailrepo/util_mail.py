@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------
+# Copyright 2016-2021 Arthur Rabatin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ---------------------------------------------------------------------------
+
+"""
+Header-only message parsing, for paths that must not pay for a full MIME parse
+"""
+
+import datetime
+import email.parser
+import email.policy
+import email.utils
+
+_header_parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+
+
+def parse_headers(raw_data: bytes):
+  return _header_parser.parsebytes(raw_data)
+
+
+def header_str(headers, name):
+  try:
+    value = headers.get(name)
+  except Exception:  # pylint: disable=broad-except
+    # Some malformed headers raise on access with the default policy
+    return None
+  return str(value) if value is not None else None
+
+
+def address_tuples(headers, *names):
+  values = []
+  for name in names:
+    try:
+      values.extend(str(x) for x in headers.get_all(name, failobj=[]))
+    except Exception:  # pylint: disable=broad-except
+      pass
+  return email.utils.getaddresses(values)
+
+
+def header_date(headers):
+  date_str = header_str(headers, 'date')
+  if not date_str:
+    return None
+  try:
+    msg_date = email.utils.parsedate_to_datetime(date_str)
+  except (TypeError, ValueError, IndexError):
+    return None
+  if msg_date.tzinfo:
+    # Stored timestamps are naive UTC, as produced by mailparser
+    msg_date = msg_date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+  return msg_date
+
+
+def join_address_tuples(tuples):
+  # Same flattening of (name, address) tuples as the downloaders apply
+  return ' '.join([y for x in tuples for y in x])